@@ -0,0 +1,388 @@
+"""In-process stand-ins for the parts of the Twitter and Slack APIs that the bot talks to.
+
+Both servers can be slowed down and rate limited, and the Twitter one generates a configurable volume of
+tweets while it runs, remembering when each piece of content was created so end-to-end latency can be
+measured when it shows up in Slack.
+"""
+import asyncio
+import json
+import random
+import re
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+
+from aiohttp import web
+
+
+TIMELINE_PAGE_SIZE = 200
+# Like Twitter, streams send a blank line when there's been nothing else to send for a while.
+STREAM_KEEPALIVE_SEC = 5
+TWEET_URL_PATTERN = re.compile(r'/status/(?P<tweet_id>\d+)')
+OAUTH_TOKEN_PATTERN = re.compile(r'oauth_token="(?P<token>[^"]*)"')
+
+
+class _Server:
+    _app: web.Application
+    _runner: Optional[web.AppRunner]
+    port: Optional[int]
+
+    def __init__(self) -> None:
+        self._app = web.Application()
+        self._runner = None
+        self.port = None
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self._app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = int(self._runner.addresses[0][1])
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeTwitter(_Server):
+    """Serves ``statuses/user_timeline``, ``users/show`` and ``users/lookup``, with rate limit headers like
+    Twitter's on the timelines and lookups (each endpoint and access token gets a window of its own), and a
+    chunked ``statuses/filter`` stream that can be taken down with ``set_streaming_available``.
+
+    While running, it posts ``tweets_per_sec`` tweets spread over the given users. A ``retweet_ratio`` share of
+    them are retweets of a small pool of popular tweets, which is what the bot's dedup has to deal with.
+    """
+    _latency_sec: float
+    _rate_limit: int
+    _window_sec: float
+    _tweets_per_sec: float
+    _retweet_ratio: float
+    _user_ids: Sequence[int]
+    _tweets: Dict[int, List[Dict[str, Any]]]
+    _next_tweet_id: int
+    _popular_tweets: List[Dict[str, Any]]
+    # Keyed by endpoint and access token, when each window started, and how many requests were made in it.
+    _windows: Dict[Tuple[str, str], Tuple[float, int]]
+    _generator: Optional[asyncio.Task]
+    # The tweets waiting to be sent down each open stream. None tells the stream to close.
+    _streams: List['asyncio.Queue[Optional[Dict[str, Any]]]']
+    _streaming_available: bool
+    _suspended_user_ids: Set[int]
+    _deleted_tweet_ids: Set[int]
+
+    # When each tweet (or retweeted tweet) first showed up, keyed by the ID in its URL.
+    content_created_at: Dict[int, float]
+    requests: int
+    stream_connections: int
+
+    def __init__(
+        self,
+        *,
+        user_ids: Sequence[int],
+        first_tweet_id: int,
+        latency_sec: float = 0.0,
+        rate_limit: int = 900,
+        window_sec: float = 15 * 60,
+        tweets_per_sec: float = 1.0,
+        retweet_ratio: float = 0.0,
+    ) -> None:
+        super().__init__()
+        self._latency_sec = latency_sec
+        self._rate_limit = rate_limit
+        self._window_sec = window_sec
+        self._tweets_per_sec = tweets_per_sec
+        self._retweet_ratio = retweet_ratio
+        self._user_ids = user_ids
+        self._tweets = {}
+        self._next_tweet_id = first_tweet_id
+        self._popular_tweets = [
+            self._make_tweet(user_id=user_id, retweeted_status=None)
+            for user_id in random.sample(list(user_ids), min(10, len(user_ids)))
+        ]
+        self._windows = {}
+        self._generator = None
+        self._streams = []
+        self._streaming_available = True
+        self._suspended_user_ids = set()
+        self._deleted_tweet_ids = set()
+        self.content_created_at = {}
+        self.requests = 0
+        self.stream_connections = 0
+
+        self._app.router.add_get('/api/1.1/statuses/user_timeline.json', self._user_timeline)
+        self._app.router.add_get('/api/1.1/users/show.json', self._users_show)
+        self._app.router.add_post('/api/1.1/users/lookup.json', self._users_lookup)
+        self._app.router.add_post('/stream/1.1/statuses/filter.json', self._statuses_filter)
+        # Peony asks for these when it starts up.
+        self._app.router.add_get('/api/1.1/account/verify_credentials.json', self._empty)
+        self._app.router.add_get('/api/1.1/help/configuration.json', self._empty)
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.port}/{{api}}/{{version}}'
+
+    async def start(self) -> None:
+        await super().start()
+        self._generator = asyncio.create_task(self._generate_tweets())
+
+    async def stop(self) -> None:
+        if self._generator is not None:
+            self._generator.cancel()
+        self.set_streaming_available(False)
+        await super().stop()
+
+    def set_streaming_available(self, available: bool) -> None:
+        """While streaming isn't available, open streams are closed and new ones are turned away with a 503.
+        """
+        self._streaming_available = available
+        if not available:
+            for stream in self._streams:
+                stream.put_nowait(None)
+
+    def suspend(self, user_id: int) -> None:
+        """Until the user is unsuspended, their timeline answers with the error Twitter gives for suspended accounts.
+        """
+        self._suspended_user_ids.add(user_id)
+
+    def unsuspend(self, user_id: int) -> None:
+        self._suspended_user_ids.discard(user_id)
+
+    def delete_tweet(self, tweet_id: int) -> None:
+        """Like on Twitter, a deleted tweet still takes up room in timeline pages, but doesn't show up in them.
+        """
+        self._deleted_tweet_ids.add(tweet_id)
+
+    def post_tweet(self, user_id: int, *, retweeted_status: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Adds a tweet (with a photo) to the user's timeline, and sends it down the open streams.
+        """
+        tweet = self._make_tweet(user_id=user_id, retweeted_status=retweeted_status)
+        self._tweets.setdefault(user_id, []).append(tweet)
+        for stream in self._streams:
+            stream.put_nowait(tweet)
+
+        content_id = retweeted_status['id'] if retweeted_status else tweet['id']
+        self.content_created_at.setdefault(content_id, time.time())
+        return tweet
+
+    async def _generate_tweets(self) -> None:
+        if self._tweets_per_sec <= 0:
+            return
+
+        while True:
+            await asyncio.sleep(random.expovariate(self._tweets_per_sec))
+
+            retweeted_status = None
+            if self._popular_tweets and random.random() < self._retweet_ratio:
+                retweeted_status = random.choice(self._popular_tweets)
+
+            self.post_tweet(random.choice(self._user_ids), retweeted_status=retweeted_status)
+
+    def _make_tweet(self, *, user_id: int, retweeted_status: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        self._next_tweet_id += 1
+        tweet = {
+            'id': self._next_tweet_id,
+            'full_text': 'x' * 140,
+            'user': {'id': user_id, 'screen_name': f'user{user_id}'},
+            'entities': {'media': [{'type': 'photo'}]},
+        }
+        if retweeted_status:
+            tweet['retweeted_status'] = retweeted_status
+        return tweet
+
+    def _take_from_rate_limit(self, request: web.Request) -> Tuple[bool, Dict[str, str]]:
+        match = OAUTH_TOKEN_PATTERN.search(request.headers.get('Authorization', ''))
+        key = (request.path, match.group('token') if match else '')
+
+        now = time.time()
+        window_started_at, window_requests = self._windows.get(key, (now, 0))
+        if now - window_started_at >= self._window_sec:
+            window_started_at, window_requests = now, 0
+
+        allowed = window_requests < self._rate_limit
+        if allowed:
+            window_requests += 1
+        self._windows[key] = (window_started_at, window_requests)
+
+        return allowed, {
+            'x-rate-limit-limit': str(self._rate_limit),
+            'x-rate-limit-remaining': str(self._rate_limit - window_requests),
+            'x-rate-limit-reset': str(int(window_started_at + self._window_sec)),
+        }
+
+    async def _user_timeline(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self._latency_sec)
+
+        allowed, headers = self._take_from_rate_limit(request)
+        if not allowed:
+            return web.json_response(
+                {'errors': [{'code': 88, 'message': 'Rate limit exceeded'}]},
+                status=429,
+                headers=headers,
+            )
+
+        user_id = int(request.query['user_id'])
+        if user_id in self._suspended_user_ids:
+            return web.json_response(
+                {'errors': [{'code': 63, 'message': 'User has been suspended.'}]},
+                status=403,
+                headers=headers,
+            )
+
+        since_id = int(request.query.get('since_id') or 0)
+        max_id = int(request.query.get('max_id') or 0)
+        count = int(request.query.get('count', TIMELINE_PAGE_SIZE))
+
+        timeline: List[Dict[str, Any]] = []
+        for tweet in reversed(self._tweets.get(user_id, [])):
+            if tweet['id'] <= since_id or len(timeline) >= count:
+                break
+            if not max_id or tweet['id'] <= max_id:
+                timeline.append(tweet)
+
+        timeline = [tweet for tweet in timeline if tweet['id'] not in self._deleted_tweet_ids]
+        return web.json_response(timeline, headers=headers)
+
+    async def _statuses_filter(self, request: web.Request) -> web.StreamResponse:
+        if not self._streaming_available:
+            return web.json_response({'errors': [{'code': 130, 'message': 'Over capacity'}]}, status=503)
+
+        follow = {int(user_id) for user_id in str((await request.post())['follow']).split(',')}
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        stream: 'asyncio.Queue[Optional[Dict[str, Any]]]' = asyncio.Queue()
+        self._streams.append(stream)
+        self.stream_connections += 1
+        try:
+            while True:
+                try:
+                    tweet = await asyncio.wait_for(stream.get(), timeout=STREAM_KEEPALIVE_SEC)
+                except asyncio.TimeoutError:
+                    await response.write(b'\r\n')
+                    continue
+
+                if tweet is None:
+                    break
+                if tweet['user']['id'] in follow:
+                    await response.write(json.dumps(tweet).encode('utf-8') + b'\r\n')
+        finally:
+            self._streams.remove(stream)
+
+        return response
+
+    async def _users_show(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self._latency_sec)
+        screen_name = request.query['screen_name']
+        return web.json_response({'id': int(screen_name.replace('user', '')), 'screen_name': screen_name})
+
+    async def _users_lookup(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self._latency_sec)
+
+        allowed, headers = self._take_from_rate_limit(request)
+        if not allowed:
+            return web.json_response(
+                {'errors': [{'code': 88, 'message': 'Rate limit exceeded'}]},
+                status=429,
+                headers=headers,
+            )
+
+        screen_names = str((await request.post())['screen_name']).split(',')
+        users = [
+            {'id': int(screen_name.lower().replace('user', '')), 'screen_name': screen_name}
+            for screen_name in screen_names
+            if screen_name.lower().startswith('user') and screen_name[4:].isdigit()
+        ]
+        if not users:
+            return web.json_response(
+                {'errors': [{'code': 17, 'message': 'No user matches for specified terms.'}]},
+                status=404,
+                headers=headers,
+            )
+        return web.json_response(users, headers=headers)
+
+    async def _empty(self, request: web.Request) -> web.Response:
+        return web.json_response({})
+
+
+class ReceivedMessage(NamedTuple):
+    received_at: float
+    channel: str
+    text: str
+    thread_ts: Optional[str] = None
+
+
+class FakeSlack(_Server):
+    """Serves ``chat.postMessage``, answering with a 429 and ``Retry-After`` when a channel gets more than
+    ``messages_per_sec`` messages in a second (or never, if it's 0).
+    """
+    _latency_sec: float
+    _messages_per_sec: float
+    _posted_at: Dict[str, List[float]]
+
+    received: List[ReceivedMessage]
+    rate_limited: int
+
+    def __init__(
+        self,
+        *,
+        latency_sec: float = 0.0,
+        messages_per_sec: float = 0.0,
+    ) -> None:
+        super().__init__()
+        self._latency_sec = latency_sec
+        self._messages_per_sec = messages_per_sec
+        self._posted_at = {}
+        self.received = []
+        self.rate_limited = 0
+
+        self._app.router.add_post('/api/chat.postMessage', self._post_message)
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.port}/api/'
+
+    async def _post_message(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self._latency_sec)
+
+        if request.content_type == 'application/json':
+            body = await request.json()
+        else:
+            body = dict(await request.post())
+
+        channel = body['channel']
+        now = time.time()
+        if self._messages_per_sec > 0:
+            recent = [posted_at for posted_at in self._posted_at.get(channel, []) if now - posted_at < 1]
+            if len(recent) >= self._messages_per_sec:
+                self.rate_limited += 1
+                return web.json_response(
+                    {'ok': False, 'error': 'ratelimited'},
+                    status=429,
+                    headers={'Retry-After': '1'},
+                )
+            self._posted_at[channel] = recent + [now]
+
+        self.received.append(ReceivedMessage(
+            received_at=now,
+            channel=channel,
+            text=body['text'],
+            thread_ts=body.get('thread_ts'),
+        ))
+        return web.json_response({'ok': True, 'channel': channel, 'ts': f'{now:.6f}'})
+
+    def latencies_sec(self, content_created_at: Dict[int, float]) -> List[float]:
+        latencies = []
+        for message in self.received:
+            for match in TWEET_URL_PATTERN.finditer(message.text):
+                created_at = content_created_at.get(int(match.group('tweet_id')))
+                if created_at is not None:
+                    latencies.append(message.received_at - created_at)
+        return latencies
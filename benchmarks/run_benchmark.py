@@ -0,0 +1,263 @@
+"""Runs a real TOTHCBot against fake Twitter and Slack servers and a temporary SQLite DB, and reports how it did.
+
+    python -m benchmarks.run_benchmark --subscriptions 10000 --duration 120
+"""
+import argparse
+import asyncio
+import datetime
+import functools
+import logging
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import List
+from typing import NamedTuple
+
+import databases
+import sqlalchemy
+
+from benchmarks.fake_servers import FakeSlack
+from benchmarks.fake_servers import FakeTwitter
+from tothc import bots
+from tothc import models
+from tothc.bots import TOTHCBot
+from tothc.clients import twitter
+from tothc.logging import configure_logging
+
+
+log = logging.getLogger(__name__)
+
+# Synthetic users get IDs counting up from here, and their cursors start at the first tweet ID, so that the
+# bot treats everything the fake Twitter generates as new.
+FIRST_USER_ID = 1000
+FIRST_TWEET_ID = 1000000
+
+SEED_CHUNK_SIZE = 5000
+CHANNEL = '#benchmark'
+
+# The connection methods that each count as one DB operation.
+DB_OPERATIONS = ('execute', 'execute_many', 'fetch_all', 'fetch_one', 'fetch_val', 'iterate')
+
+
+class BenchmarkResult(NamedTuple):
+    cycle_durations_sec: List[float]
+    polled_user_count: int
+    db_operation_count: int
+    twitter_request_count: int
+    generated_content_count: int
+    delivered_message_count: int
+    slack_rate_limited_count: int
+    latencies_sec: List[float]
+    peak_rss_mb: float
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--subscriptions', type=int, default=1000, help='How many synthetic subscriptions to seed.')
+    parser.add_argument('--duration', type=float, default=60, help='How many seconds to run the bot for.')
+
+    parser.add_argument('--twitter-latency', type=float, default=0.05, help='Seconds per fake Twitter request.')
+    parser.add_argument(
+        '--twitter-rate-limit',
+        type=int,
+        default=900,
+        help='Timeline requests per 15 minute window, for each credential.',
+    )
+    parser.add_argument('--twitter-credentials', type=int, default=1, help='How many Twitter credentials the bot gets.')
+    parser.add_argument('--tweets-per-sec', type=float, default=5.0, help='How fast the fake Twitter generates tweets.')
+    parser.add_argument('--retweet-ratio', type=float, default=0.2, help='Share of generated tweets that are retweets.')
+
+    parser.add_argument('--slack-latency', type=float, default=0.05, help='Seconds per fake Slack request.')
+    parser.add_argument(
+        '--slack-rate-limit',
+        type=float,
+        default=1.0,
+        help='Messages per second per channel before the fake Slack answers with a 429, or 0 for no limit.',
+    )
+
+    parser.add_argument('--poll-concurrency', type=int, default=bots.DEFAULT_POLL_CONCURRENCY)
+    parser.add_argument('--streaming', action='store_true', help="Follow the subscriptions through the fake stream too.")
+    parser.add_argument('--digest-window', type=float, help='Turns on digest mode, with this many seconds per digest.')
+    parser.add_argument('--digest-max-tweets', type=int, default=bots.DEFAULT_DIGEST_MAX_TWEETS)
+    parser.add_argument('--digest-style', choices=bots.DIGEST_STYLES, default=bots.DIGEST_MESSAGE)
+    parser.add_argument('--verbose', action='store_true', help="Show the bot's own logs.")
+
+    return parser.parse_args()
+
+
+def seed_subscriptions(sqlite_db_path: Path, user_ids: List[int], channel: str) -> None:
+    engine = sqlalchemy.create_engine(f'sqlite:///{sqlite_db_path}')
+    now = datetime.datetime.utcnow()
+    with engine.begin() as conn:
+        for start in range(0, len(user_ids), SEED_CHUNK_SIZE):
+            chunk = user_ids[start:start + SEED_CHUNK_SIZE]
+            conn.execute(
+                models.twitter_subscriptions.insert(),
+                [
+                    {
+                        'user_id': user_id,
+                        'screen_name': f'user{user_id}',
+                        'screen_name_lower': f'user{user_id}',
+                        'subscribed_at': now,
+                        'latest_tweet_id': FIRST_TWEET_ID,
+                    }
+                    for user_id in chunk
+                ],
+            )
+            conn.execute(
+                models.channel_subscriptions.insert(),
+                [{'channel': channel, 'user_id': user_id, 'subscribed_at': now} for user_id in chunk],
+            )
+
+
+def count_calls(method: Callable, counter: List[int]) -> Callable:
+    @functools.wraps(method)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        counter[0] += 1
+        return method(*args, **kwargs)
+
+    return wrapper
+
+
+async def run_benchmark(args: argparse.Namespace, sqlite_db_path: Path) -> BenchmarkResult:
+    user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + args.subscriptions))
+
+    fake_twitter = FakeTwitter(
+        user_ids=user_ids,
+        first_tweet_id=FIRST_TWEET_ID,
+        latency_sec=args.twitter_latency,
+        rate_limit=args.twitter_rate_limit,
+        tweets_per_sec=args.tweets_per_sec,
+        retweet_ratio=args.retweet_ratio,
+    )
+    fake_slack = FakeSlack(latency_sec=args.slack_latency, messages_per_sec=args.slack_rate_limit)
+    await fake_twitter.start()
+    await fake_slack.start()
+
+    bot = TOTHCBot(
+        twitter_tokens=[
+            twitter.OAuth10aTokens(
+                consumer_key='benchmark',
+                consumer_secret='benchmark',
+                access_token=f'benchmark{index}',
+                access_token_secret='benchmark',
+            )
+            for index in range(args.twitter_credentials)
+        ],
+        slack_token='benchmark',
+        slack_channel=CHANNEL,
+        database_url=f'sqlite:///{sqlite_db_path}',
+        loop=asyncio.get_event_loop(),
+        poll_concurrency=args.poll_concurrency,
+        twitter_base_url=fake_twitter.base_url,
+        slack_base_url=fake_slack.base_url,
+        streaming_enabled=args.streaming,
+        digest=(
+            bots.DigestSettings(window_sec=args.digest_window, max_tweets=args.digest_max_tweets, style=args.digest_style)
+            if args.digest_window is not None else None
+        ),
+    )
+    await bot.initialize()
+    seed_subscriptions(sqlite_db_path, user_ids, CHANNEL)
+
+    db_operation_count = [0]
+    for name in DB_OPERATIONS:
+        setattr(databases.core.Connection, name, count_calls(getattr(databases.core.Connection, name), db_operation_count))
+
+    cycle_durations_sec = []
+    polled_user_count = 0
+    run_pipeline = bot._pipeline.run
+
+    async def timed_pipeline_run(user_ids: List[int]) -> Any:
+        nonlocal polled_user_count
+        report = await run_pipeline(user_ids)
+        cycle_durations_sec.append(report.duration_sec)
+        polled_user_count += len(user_ids)
+        return report
+
+    bot._pipeline.run = timed_pipeline_run  # type: ignore
+
+    polling = asyncio.create_task(bot.run_polling())
+    try:
+        await asyncio.sleep(args.duration)
+    finally:
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+        await bot._datastore.disconnect()
+        await fake_twitter.stop()
+        await fake_slack.stop()
+
+    # On Linux, ru_maxrss is in kilobytes.
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return BenchmarkResult(
+        cycle_durations_sec=cycle_durations_sec,
+        polled_user_count=polled_user_count,
+        db_operation_count=db_operation_count[0],
+        twitter_request_count=fake_twitter.requests,
+        generated_content_count=len(fake_twitter.content_created_at),
+        delivered_message_count=len(fake_slack.received),
+        slack_rate_limited_count=fake_slack.rate_limited,
+        latencies_sec=fake_slack.latencies_sec(fake_twitter.content_created_at),
+        peak_rss_mb=peak_rss_mb,
+    )
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def print_report(args: argparse.Namespace, result: BenchmarkResult) -> None:
+    cycles = result.cycle_durations_sec
+    print(f'Subscriptions:         {args.subscriptions}')
+    print(f'Duration:              {args.duration:.0f}s')
+    print(f'Poll cycles:           {len(cycles)} ({result.polled_user_count} user polls)')
+    if cycles:
+        print(
+            f'Cycle time:            mean {statistics.mean(cycles):.3f}s, '
+            f'p95 {percentile(cycles, 0.95):.3f}s, max {max(cycles):.3f}s',
+        )
+        print(f'DB ops per cycle:      {result.db_operation_count / len(cycles):.1f} ({result.db_operation_count} total)')
+    print(f'Twitter requests:      {result.twitter_request_count}')
+    print(f'Content generated:     {result.generated_content_count}')
+    latencies = result.latencies_sec
+    # Digests post several tweets per message, so the tweets that made it to Slack are counted by their links.
+    print(
+        f'Slack messages:        {result.delivered_message_count} ({len(latencies)} tweets, '
+        f'{result.slack_rate_limited_count} rate limited)',
+    )
+    if latencies:
+        print(
+            f'Tweet-to-Slack:        p50 {percentile(latencies, 0.5):.2f}s, '
+            f'p95 {percentile(latencies, 0.95):.2f}s, max {max(latencies):.2f}s',
+        )
+    print(f'Peak RSS:              {result.peak_rss_mb:.1f} MB')
+
+
+def main() -> None:
+    args = parse_args()
+
+    if args.verbose:
+        configure_logging()
+    else:
+        logging.basicConfig(level=logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite_db_path = Path(directory) / 'benchmark.db'
+        started_at = time.monotonic()
+        result = asyncio.get_event_loop().run_until_complete(run_benchmark(args, sqlite_db_path))
+        log.info('Benchmark took %.1fs', time.monotonic() - started_at)
+
+    print_report(args, result)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
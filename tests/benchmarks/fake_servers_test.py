@@ -0,0 +1,125 @@
+import asyncio
+
+import aiohttp
+
+from benchmarks.fake_servers import FakeSlack
+from benchmarks.fake_servers import FakeTwitter
+
+
+def _run_server(server, test):
+    async def run():
+        await server.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await test(session, f'http://127.0.0.1:{server.port}')
+        finally:
+            await server.stop()
+
+    return asyncio.run(run())
+
+
+def _auth(token):
+    return {'Authorization': f'OAuth oauth_token="{token}"'}
+
+
+def test_fake_twitter_timeline():
+    fake_twitter = FakeTwitter(user_ids=[], first_tweet_id=100, tweets_per_sec=0)
+    for user_id in (1, 1, 2, 1):
+        fake_twitter.post_tweet(user_id)
+
+    async def test(session, url):
+        async def timeline(**params):
+            async with session.get(f'{url}/api/1.1/statuses/user_timeline.json', params=params, headers=_auth('a')) as r:
+                return [tweet['id'] for tweet in await r.json()]
+
+        return [
+            await timeline(user_id=1),
+            await timeline(user_id=1, since_id=101),
+            await timeline(user_id=1, max_id=102),
+            await timeline(user_id=1, count=1),
+            await timeline(user_id=2),
+        ]
+
+    assert _run_server(fake_twitter, test) == [[104, 102, 101], [104, 102], [102, 101], [104], [103]]
+    assert set(fake_twitter.content_created_at) == {101, 102, 103, 104}
+
+
+def test_fake_twitter_rate_limits_each_token():
+    fake_twitter = FakeTwitter(user_ids=[1], first_tweet_id=100, rate_limit=2, tweets_per_sec=0)
+
+    async def test(session, url):
+        results = []
+        for token in ('a', 'a', 'a', 'b'):
+            async with session.get(
+                f'{url}/api/1.1/statuses/user_timeline.json',
+                params={'user_id': 1},
+                headers=_auth(token),
+            ) as response:
+                results.append((response.status, response.headers['x-rate-limit-remaining']))
+        return results
+
+    assert _run_server(fake_twitter, test) == [(200, '1'), (200, '0'), (429, '0'), (200, '1')]
+
+
+def test_fake_twitter_suspends_users():
+    fake_twitter = FakeTwitter(user_ids=[1], first_tweet_id=100, tweets_per_sec=0)
+    fake_twitter.suspend(1)
+
+    async def test(session, url):
+        async with session.get(
+            f'{url}/api/1.1/statuses/user_timeline.json',
+            params={'user_id': 1},
+            headers=_auth('a'),
+        ) as response:
+            return response.status, await response.json()
+
+    status, data = _run_server(fake_twitter, test)
+
+    assert status == 403
+    assert data['errors'][0]['code'] == 63
+
+
+def test_fake_twitter_users_lookup():
+    fake_twitter = FakeTwitter(user_ids=[], first_tweet_id=100, tweets_per_sec=0)
+
+    async def test(session, url):
+        results = []
+        for screen_names in ('user1,User2,nobody', 'nobody'):
+            async with session.post(f'{url}/api/1.1/users/lookup.json', data={'screen_name': screen_names}) as response:
+                results.append((response.status, await response.json()))
+        return results
+
+    (found_status, found), (missing_status, _) = _run_server(fake_twitter, test)
+
+    assert found_status == 200
+    assert found == [{'id': 1, 'screen_name': 'user1'}, {'id': 2, 'screen_name': 'User2'}]
+    assert missing_status == 404
+
+
+def test_fake_slack_rate_limits_each_channel():
+    fake_slack = FakeSlack(messages_per_sec=1)
+
+    async def test(session, url):
+        statuses = []
+        for channel in ('C1', 'C1', 'C2'):
+            async with session.post(f'{url}/api/chat.postMessage', json={'channel': channel, 'text': 'Hi'}) as response:
+                statuses.append((response.status, response.headers.get('Retry-After')))
+        return statuses
+
+    assert _run_server(fake_slack, test) == [(200, None), (429, '1'), (200, None)]
+    assert [(message.channel, message.text) for message in fake_slack.received] == [('C1', 'Hi'), ('C2', 'Hi')]
+    assert fake_slack.rate_limited == 1
+
+
+def test_fake_slack_latencies():
+    fake_slack = FakeSlack()
+
+    async def test(session, url):
+        text = 'https://www.twitter.com/user1/status/101 https://www.twitter.com/user1/status/999'
+        async with session.post(f'{url}/api/chat.postMessage', json={'channel': 'C1', 'text': text}):
+            pass
+
+    _run_server(fake_slack, test)
+    received_at = fake_slack.received[0].received_at
+
+    assert fake_slack.latencies_sec({101: received_at - 2}) == [2]
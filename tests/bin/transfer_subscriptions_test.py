@@ -0,0 +1,63 @@
+import asyncio
+import io
+
+from benchmarks.fake_servers import FakeTwitter
+from tothc import datastores
+from tothc import managers
+from tothc.bin import transfer_subscriptions
+from tothc.clients import twitter
+
+
+def _run_import(tmp_path, text, **kwargs):
+    """Imports the JSON Lines ``text`` into a fresh DB, looking users up on a fake Twitter, and returns how many
+    rows were imported and skipped, the records that ended up in the DB, and the fake Twitter.
+    """
+    async def run():
+        fake_twitter = FakeTwitter(user_ids=[], first_tweet_id=1000, tweets_per_sec=0, **kwargs)
+        datastore = datastores.Datastore(f'sqlite:///{tmp_path / "tothc.db"}')
+        await fake_twitter.start()
+        await datastore.connect()
+        try:
+            await datastore.ensure_initialized()
+            client = twitter.Client(
+                auths=[twitter.OAuth10aTokens('test', 'test', 'test', 'test')],
+                base_url=fake_twitter.base_url,
+            )
+            counts = await transfer_subscriptions.import_subscriptions(
+                datastore,
+                client,
+                io.StringIO(text),
+                'jsonl',
+                '#general',
+            )
+            async with datastore.connection() as conn:
+                records = await managers.TwitterSubscriptionManager.list_subscription_records(
+                    conn,
+                    after_user_id=None,
+                    limit=100,
+                )
+            return counts, records
+        finally:
+            await datastore.disconnect()
+            await fake_twitter.stop()
+
+    return asyncio.run(run())
+
+
+def test_import_looks_up_screen_names(tmp_path):
+    counts, records = _run_import(tmp_path, '{"screen_name": "@User1"}\n{"screen_name": "nobody"}\n{}\n')
+
+    assert counts == (1, 2)
+    assert [(record.user_id, record.screen_name, record.channel) for record in records] == [(1, 'User1', '#general')]
+
+
+def test_import_waits_out_lookup_rate_limits(tmp_path, monkeypatch):
+    monkeypatch.setattr(transfer_subscriptions, 'IMPORT_CHUNK_SIZE', 2)
+    monkeypatch.setattr(transfer_subscriptions, 'RATE_LIMIT_MARGIN_SEC', 0.1)
+    text = ''.join(f'{{"screen_name": "user{user_id}"}}\n' for user_id in range(1, 6))
+
+    # Every chunk after the first needs a lookup of its own, and each one has to wait for the window to reset.
+    counts, records = _run_import(tmp_path, text, rate_limit=1, window_sec=1)
+
+    assert counts == (5, 0)
+    assert [record.user_id for record in records] == [1, 2, 3, 4, 5]
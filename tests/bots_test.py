@@ -0,0 +1,163 @@
+import asyncio
+import time
+
+from benchmarks.fake_servers import FakeSlack
+from benchmarks.fake_servers import FakeTwitter
+from tothc import managers
+from tothc.bots import TOTHCBot
+from tothc.clients import slack
+from tothc.clients import twitter
+
+
+CHANNEL = 'C1'
+FIRST_TWEET_ID = 1000
+
+
+def _run_bot(tmp_path, test, **kwargs):
+    """Runs ``test(bot, fake_twitter, fake_slack)`` against a bot that talks to fake servers, with a fresh DB.
+    """
+    async def run():
+        fake_twitter = FakeTwitter(user_ids=[], first_tweet_id=FIRST_TWEET_ID, tweets_per_sec=0)
+        fake_slack = FakeSlack()
+        await fake_twitter.start()
+        await fake_slack.start()
+
+        bot = TOTHCBot(
+            twitter_tokens=[twitter.OAuth10aTokens('test', 'test', 'test', 'test')],
+            slack_token='test',
+            slack_channel=CHANNEL,
+            database_url=f'sqlite:///{tmp_path / "tothc.db"}',
+            loop=asyncio.get_event_loop(),
+            twitter_base_url=fake_twitter.base_url,
+            slack_base_url=fake_slack.base_url,
+            **kwargs,
+        )
+        await bot.initialize()
+        try:
+            return await test(bot, fake_twitter, fake_slack)
+        finally:
+            await bot._datastore.disconnect()
+            await fake_twitter.stop()
+            await fake_slack.stop()
+
+    return asyncio.run(run())
+
+
+async def _wait_for(condition, timeout_sec=10.0):
+    deadline = time.monotonic() + timeout_sec
+    while not condition():
+        assert time.monotonic() < deadline, 'Timed out'
+        await asyncio.sleep(0.05)
+
+
+async def _run_until(coroutine, condition, timeout_sec=10.0):
+    task = asyncio.ensure_future(coroutine)
+    try:
+        await _wait_for(lambda: condition() or task.done(), timeout_sec)
+        if task.done():
+            task.result()
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def test_outbox_loop_delivers_in_order(tmp_path):
+    async def test(bot, fake_twitter, fake_slack):
+        async with bot._datastore.writer() as conn:
+            await managers.OutboxManager.add_messages(
+                conn,
+                messages=[slack.OutgoingMessage(channel=f'C{i % 2}', text=str(i)) for i in range(6)],
+            )
+
+        await _run_until(bot._outbox_loop(), lambda: len(fake_slack.received) == 6)
+        async with bot._datastore.connection() as conn:
+            pending = await managers.OutboxManager.list_pending(conn, limit=10, max_attempts=3)
+        return fake_slack.received, pending
+
+    received, pending = _run_bot(tmp_path, test)
+
+    assert [message.text for message in received if message.channel == 'C0'] == ['0', '2', '4']
+    assert [message.text for message in received if message.channel == 'C1'] == ['1', '3', '5']
+    # Everything was marked as sent.
+    assert pending == []
+
+
+async def _subscribe(bot, user_ids, latest_tweet_id=FIRST_TWEET_ID, channel=CHANNEL):
+    """Subscribes the channel to the users, as if they'd last been polled at ``latest_tweet_id``.
+    """
+    async with bot._datastore.writer() as conn:
+        await managers.TwitterSubscriptionManager.import_subscriptions(
+            conn,
+            records=[
+                managers.SubscriptionRecord(
+                    user_id=user_id,
+                    screen_name=f'user{user_id}',
+                    latest_tweet_id=latest_tweet_id,
+                    tweets_per_day=None,
+                    channel=channel,
+                    filter_rule=None,
+                )
+                for user_id in user_ids
+            ],
+        )
+        await managers.ChannelSubscriptionManager.import_subscriptions(
+            conn,
+            subscriptions=[managers.ChannelSubscription(channel=channel, user_id=user_id) for user_id in user_ids],
+        )
+
+
+def test_polls_and_delivers(tmp_path):
+    async def test(bot, fake_twitter, fake_slack):
+        await _subscribe(bot, [1, 2])
+        tweets = [fake_twitter.post_tweet(1), fake_twitter.post_tweet(2), fake_twitter.post_tweet(1)]
+
+        await _run_until(bot.run_polling(), lambda: len(fake_slack.received) == 3)
+        async with bot._datastore.connection() as conn:
+            cursors = await managers.TwitterSubscriptionManager.get_latest_tweet_ids_for_user_ids(conn, user_ids=[1, 2])
+        return tweets, fake_slack.received, cursors
+
+    tweets, received, cursors = _run_bot(tmp_path, test)
+
+    assert sorted(message.text for message in received) == sorted(
+        f'<https://www.twitter.com/user{tweet["user"]["id"]}|user{tweet["user"]["id"]}> tweeted '
+        f'<https://www.twitter.com/user{tweet["user"]["id"]}/status/{tweet["id"]}>'
+        for tweet in tweets
+    )
+    assert {message.channel for message in received} == {CHANNEL}
+    assert cursors == {1: tweets[2]['id'], 2: tweets[1]['id']}
+
+
+def test_unsubscribing_stops_polling(tmp_path):
+    async def test(bot, fake_twitter, fake_slack):
+        await bot.subscribe_to_twitter_users(['user1', 'user2'], CHANNEL)
+        await bot.subscribe_to_twitter_users(['user2'], 'C2')
+
+        await bot.unsubscribe_from_twitter_users(['user1', 'user2'], CHANNEL)
+        return set(bot._scheduler.user_ids)
+
+    # Another channel still wants user 2's tweets.
+    assert _run_bot(tmp_path, test) == {2}
+
+
+def test_deleted_cursor_tweet_does_not_start_a_backfill(tmp_path):
+    async def test(bot, fake_twitter, fake_slack):
+        cursor_tweet = fake_twitter.post_tweet(1)
+        await _subscribe(bot, [1], latest_tweet_id=cursor_tweet['id'])
+        fake_twitter.delete_tweet(cursor_tweet['id'])
+        tweets = [fake_twitter.post_tweet(1), fake_twitter.post_tweet(1)]
+
+        backfills = []
+        update_backfill = bot._catch_up_scheduler.update
+
+        def recording_update_backfill(backfill):
+            backfills.append(backfill)
+            update_backfill(backfill)
+
+        bot._catch_up_scheduler.update = recording_update_backfill
+        await _run_until(bot.run_polling(), lambda: len(fake_slack.received) == 2)
+        return tweets, fake_slack.received, backfills
+
+    tweets, received, backfills = _run_bot(tmp_path, test)
+
+    assert sorted(message.text.rsplit('/', 1)[-1] for message in received) == [f'{tweet["id"]}>' for tweet in tweets]
+    assert backfills == []
@@ -0,0 +1,49 @@
+from tothc import caches
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_entries_expire():
+    clock = FakeClock()
+    cache = caches.TTLCache(maxsize=10, ttl_sec=10, clock=clock)
+    cache.set('a', 1)
+    clock.now = 5
+    cache.set('b', 2)
+
+    clock.now = 9.9
+    assert cache.get('a') == 1
+    clock.now = 10
+    assert cache.get('a') is None
+    assert 'a' not in cache
+    assert cache.get('b') == 2
+    assert len(cache) == 1
+
+    # Setting an entry again starts its TTL over.
+    cache.set('b', 3)
+    clock.now = 19.9
+    assert cache.get('b') == 3
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = caches.TTLCache(maxsize=2, ttl_sec=10, clock=FakeClock())
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert 'a' in cache
+    cache.set('c', 3)
+
+    assert [key for key in 'abc' if key in cache] == ['a', 'c']
+
+
+def test_pop():
+    cache = caches.TTLCache(maxsize=2, ttl_sec=10, clock=FakeClock())
+    cache.set('a', 1)
+
+    assert cache.pop('a') == 1
+    assert cache.pop('a') is None
+    assert len(cache) == 0
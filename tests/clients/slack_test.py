@@ -0,0 +1,137 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+from slack.errors import SlackApiError
+
+from tothc.clients import slack
+
+
+def test_message_intake_drops_duplicates():
+    async def test():
+        intake = slack.MessageIntake()
+        offered = [
+            intake.offer({'client_msg_id': 'a', 'text': 'subscribe foo'}),
+            intake.offer({'client_msg_id': 'a', 'text': 'subscribe foo'}),
+            intake.offer({'channel': 'C1', 'ts': '1.0'}),
+            intake.offer({'channel': 'C2', 'ts': '1.0'}),
+            intake.offer({'channel': 'C1', 'ts': '1.0'}),
+        ]
+        return offered, intake.qsize()
+
+    assert asyncio.run(test()) == ([True, False, True, True, False], 3)
+
+
+def test_message_intake_drops_overflow():
+    async def test():
+        intake = slack.MessageIntake(maxsize=1)
+        offered = [intake.offer({'client_msg_id': 'a'}), intake.offer({'client_msg_id': 'b'})]
+        await intake.get()
+        # The dropped message wasn't seen, so a redelivery of it gets in.
+        offered.append(intake.offer({'client_msg_id': 'b'}))
+        return offered
+
+    assert asyncio.run(test()) == [True, False, True]
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeClient:
+    """Posts messages after ``delay_sec`` (by channel), failing with whatever's queued up in ``errors``.
+    """
+    def __init__(self, delay_sec=None, errors=None):
+        self.delay_sec = delay_sec or {}
+        self.errors = errors or []
+        self.posted = []
+        self.attempted_at = []
+
+    async def post_message(self, channel, text, thread_ts=None):
+        self.attempted_at.append(time.monotonic())
+        await asyncio.sleep(self.delay_sec.get(channel, 0))
+        if self.errors:
+            raise self.errors.pop(0)
+        self.posted.append((channel, text))
+        return {'ts': f'ts-{text}'}
+
+
+@pytest.fixture(autouse=True)
+def fast_delivery(monkeypatch):
+    monkeypatch.setattr(slack, 'CHANNEL_MESSAGES_PER_SEC', 1000.0)
+    monkeypatch.setattr(slack, 'DELIVERY_BACKOFF_BASE_SEC', 0.001)
+
+
+def _deliver(client, messages):
+    async def deliver():
+        queue = slack.DeliveryQueue(client)
+        futures = [await queue.put(message) for message in messages]
+        return await asyncio.gather(*futures)
+
+    return asyncio.run(deliver())
+
+
+def test_delivery_keeps_channel_order():
+    client = FakeClient()
+    messages = [slack.OutgoingMessage(channel=f'C{i % 2}', text=str(i)) for i in range(10)]
+
+    assert _deliver(client, messages) == [f'ts-{i}' for i in range(10)]
+    assert [text for channel, text in client.posted if channel == 'C0'] == ['0', '2', '4', '6', '8']
+    assert [text for channel, text in client.posted if channel == 'C1'] == ['1', '3', '5', '7', '9']
+
+
+def test_delivery_pauses_for_retry_after():
+    client = FakeClient(errors=[SlackApiError('Slow down', FakeResponse(429, {'Retry-After': '0.2'}))])
+
+    assert _deliver(client, [slack.OutgoingMessage(channel='C1', text='1')]) == ['ts-1']
+    assert client.attempted_at[1] - client.attempted_at[0] >= 0.2
+
+
+def test_delivery_drops_rejected_messages():
+    client = FakeClient(errors=[SlackApiError('No such channel', FakeResponse(404))])
+    messages = [slack.OutgoingMessage(channel='C1', text='1'), slack.OutgoingMessage(channel='C1', text='2')]
+
+    assert _deliver(client, messages) == [None, 'ts-2']
+    assert len(client.attempted_at) == 2
+
+
+def test_delivery_gives_up():
+    client = FakeClient(errors=[aiohttp.ClientError()] * slack.MAX_DELIVERY_ATTEMPTS)
+    messages = [slack.OutgoingMessage(channel='C1', text='1'), slack.OutgoingMessage(channel='C1', text='2')]
+
+    assert _deliver(client, messages) == [None, 'ts-2']
+    assert len(client.attempted_at) == slack.MAX_DELIVERY_ATTEMPTS + 1
+
+
+def test_slow_channel_doesnt_hold_up_others():
+    client = FakeClient(delay_sec={'C1': 10})
+
+    async def deliver():
+        queue = slack.DeliveryQueue(client)
+        slow = await queue.put(slack.OutgoingMessage(channel='C1', text='1'))
+        fast = await queue.put(slack.OutgoingMessage(channel='C2', text='2'))
+        ts = await asyncio.wait_for(fast, timeout=1)
+        return ts, slow.done()
+
+    assert asyncio.run(deliver()) == ('ts-2', False)
+
+
+def test_cancelled_sender_resolves_waiting_messages():
+    client = FakeClient(delay_sec={'C1': 10})
+
+    async def deliver():
+        queue = slack.DeliveryQueue(client)
+        futures = [await queue.put(slack.OutgoingMessage(channel='C1', text=str(i))) for i in range(3)]
+        await asyncio.sleep(0.01)
+        for sender in list(queue._senders.values()):
+            sender.task.cancel()
+        timestamps = await asyncio.wait_for(asyncio.gather(*futures), timeout=1)
+
+        # The channel gets a new sender.
+        client.delay_sec = {}
+        return timestamps, await (await queue.put(slack.OutgoingMessage(channel='C1', text='3')))
+
+    assert asyncio.run(deliver()) == ([None, None, None], 'ts-3')
@@ -0,0 +1,374 @@
+import asyncio
+import json
+import time
+
+import peony.exceptions
+import pytest
+
+from benchmarks.fake_servers import FakeTwitter
+from tothc.clients import twitter
+
+
+def _tweet_data(id, user_id=10, **kwargs):
+    return {'id': id, 'full_text': 'Hi', 'user': {'id': user_id, 'screen_name': f'user{user_id}'}, **kwargs}
+
+
+@pytest.mark.parametrize(
+    ('text', 'expected'),
+    (
+        ('[]', []),
+        (' [ ] ', []),
+        ('[1]', [1]),
+        ('[1, "two", {"three": [3]}, null]', [1, 'two', {'three': [3]}, None]),
+        ('\n[\n  {"a": "]"} ,\n  [1, [2]]\n]\n', [{'a': ']'}, [1, [2]]]),
+    ),
+)
+def test_iter_json_array(text, expected):
+    assert list(twitter.iter_json_array(text)) == expected
+
+
+@pytest.mark.parametrize('text', ('', '{}', '[1 2]', '[1,', '[1,]'))
+def test_iter_json_array_rejects(text):
+    with pytest.raises(ValueError):
+        list(twitter.iter_json_array(text))
+
+
+def test_iter_json_array_is_lazy():
+    elements = twitter.iter_json_array('[1, 2, oops]')
+
+    assert next(elements) == 1
+    assert next(elements) == 2
+    with pytest.raises(ValueError):
+        next(elements)
+
+
+def test_loads_compacts_tweets():
+    data = twitter.loads(json.dumps([_tweet_data(2), {'not': 'a tweet'}]).encode('utf-8'))
+
+    assert isinstance(data[0], twitter.Tweet)
+    assert (data[0].id, data[0].user_id, data[0].screen_name) == (2, 10, 'user10')
+    assert data[0].raw is None
+    assert data[1] == {'not': 'a tweet'}
+
+
+def test_loads_leaves_objects_to_peony():
+    data = twitter.loads('{"id": 10, "screen_name": "user10"}')
+
+    assert data['id'] == 10
+    assert data.screen_name == 'user10'
+
+
+def test_tweet_from_data():
+    tweet = twitter.Tweet.from_data(_tweet_data(
+        3,
+        entities={'media': [{'type': 'photo'}, {'type': 'photo'}]},
+        extended_entities={'media': [{'type': 'photo'}, {'type': 'video'}]},
+        in_reply_to_user_id=20,
+        is_quote_status=True,
+        favorite_count=5,
+    ))
+
+    assert tweet.media_count == 2
+    assert tweet.media_types == frozenset({'photo', 'video'})
+    assert tweet.in_reply_to_user_id == 20
+    assert tweet.is_quote
+    assert tweet.like_count == 5
+    assert not tweet.is_retweet()
+    assert tweet.url_of_content() == 'https://www.twitter.com/user10/status/3'
+
+
+def test_retweet_from_data():
+    tweet = twitter.Tweet.from_data(
+        _tweet_data(4, retweeted_status={**_tweet_data(1, user_id=20), 'favorite_count': 100}, favorite_count=0),
+        keep_raw=True,
+    )
+
+    assert tweet.is_retweet()
+    assert not tweet.is_self_retweet()
+    assert (tweet.retweeted_status_id, tweet.retweeted_user_id, tweet.retweeted_screen_name) == (1, 20, 'user20')
+    # Retweets show the counts of the tweet they retweet.
+    assert tweet.like_count == 100
+    assert tweet.url_of_content() == 'https://www.twitter.com/user20/status/1'
+    assert tweet.raw['id'] == 4
+
+
+def test_tweets_have_no_dict():
+    tweet = twitter.Tweet(id=1, user_id=10, screen_name='user10')
+
+    assert not hasattr(tweet, '__dict__')
+    with pytest.raises(AttributeError):
+        tweet.text = 'Hi'
+
+
+def test_timeline_from_data():
+    timeline = twitter.Timeline.from_data([twitter.Tweet(id=2, user_id=10, screen_name='user10'), _tweet_data(1)])
+
+    assert [tweet.id for tweet in timeline.tweets] == [2, 1]
+    assert all(isinstance(tweet, twitter.Tweet) for tweet in timeline.tweets)
+
+
+def _make_client(credential_count):
+    async def make():
+        return twitter.Client(auths=_auths(credential_count))
+
+    return asyncio.run(make())
+
+
+def test_credential_budget():
+    credential = _make_client(1)._credentials[0]
+    assert credential.budget(now=0) == twitter.TIMELINE_WINDOW_REQUESTS
+
+    credential.update_rate_limit(twitter.RateLimit(limit=900, remaining=10, reset_at=100))
+    credential.in_flight = 3
+    assert credential.budget(now=50) == 7
+    # Once the window resets, the whole limit is available again.
+    assert credential.budget(now=100) == 897
+
+
+def test_credential_update_rate_limit():
+    credential = _make_client(1)._credentials[0]
+    credential.update_rate_limit(twitter.RateLimit(limit=900, remaining=10, reset_at=100))
+
+    # A response from earlier in the same window arrived late.
+    credential.update_rate_limit(twitter.RateLimit(limit=900, remaining=50, reset_at=100))
+    assert credential.rate_limit.remaining == 10
+    # A response from the previous window arrived late.
+    credential.update_rate_limit(twitter.RateLimit(limit=900, remaining=5, reset_at=50))
+    assert credential.rate_limit == twitter.RateLimit(limit=900, remaining=10, reset_at=100)
+
+    credential.update_rate_limit(twitter.RateLimit(limit=900, remaining=899, reset_at=1000))
+    assert credential.rate_limit.remaining == 899
+
+
+def test_credential_park():
+    credential = _make_client(1)._credentials[0]
+    credential.park(twitter.RateLimit(limit=900, remaining=3, reset_at=100), now=10)
+
+    assert credential.is_parked(99)
+    assert not credential.is_parked(100)
+    assert credential.budget(50) == 0
+
+    # Without rate limit headers, it waits out a whole window.
+    credential.park(None, now=200)
+    assert credential.parked_until == 200 + twitter.DEFAULT_PARK_SEC
+    assert credential.rate_limit == twitter.RateLimit(limit=900, remaining=0, reset_at=200 + twitter.DEFAULT_PARK_SEC)
+
+
+def test_pick_credential():
+    client = _make_client(3)
+    first, second, third = client._credentials
+    first.update_rate_limit(twitter.RateLimit(limit=900, remaining=100, reset_at=1000))
+    second.update_rate_limit(twitter.RateLimit(limit=900, remaining=300, reset_at=1000))
+    third.update_rate_limit(twitter.RateLimit(limit=900, remaining=200, reset_at=1000))
+
+    assert client._pick_credential(now=0, user_id=1) is second
+    # Users stick to the credential they were first fetched with.
+    second.update_rate_limit(twitter.RateLimit(limit=900, remaining=1, reset_at=1000))
+    assert client._pick_credential(now=0, user_id=1) is second
+    assert client._pick_credential(now=0, user_id=2) is third
+
+    # Until it's parked, and they move to the next best one for good.
+    second.park(None, now=0)
+    assert client._pick_credential(now=0, user_id=1) is third
+    second.update_rate_limit(twitter.RateLimit(limit=900, remaining=900, reset_at=2000))
+    assert client._pick_credential(now=twitter.DEFAULT_PARK_SEC, user_id=1) is third
+
+    first.park(None, now=10)
+    third.park(None, now=0)
+    with pytest.raises(twitter.RateLimited) as e:
+        client._pick_credential(now=20)
+    assert e.value.retry_at == twitter.DEFAULT_PARK_SEC
+
+
+def test_get_user_timeline_parks_rate_limited_credentials():
+    async def test(client, fake_twitter):
+        fake_twitter.post_tweet(1)
+        credentials = [
+            (await client.get_user_timeline_by_user_id(user_id)).rate_limit.credential
+            for user_id in (1, 1, 2, 1)
+        ]
+        parked = [credential.is_parked(time.time()) for credential in client._credentials]
+        with pytest.raises(twitter.RateLimited):
+            await client.get_user_timeline_by_user_id(1)
+        return credentials, parked
+
+    credentials, parked = _run_client(test, credential_count=2, rate_limit=2)
+
+    # User 1 moves to the second credential once the first one runs out, and then that one runs out too.
+    assert credentials == [0, 0, 1, 1]
+    assert parked == [True, False]
+
+
+def test_user_cache_forgets_old_screen_names():
+    user_cache = twitter.UserCache()
+    user_cache.add(twitter.User(id=1, screen_name='Old'))
+    user_cache.add(twitter.User(id=1, screen_name='New'))
+    # Only the case changed.
+    user_cache.add(twitter.User(id=2, screen_name='same'))
+    user_cache.add(twitter.User(id=2, screen_name='Same'))
+
+    assert user_cache.get(1) == twitter.User(id=1, screen_name='New')
+    assert user_cache.get_by_screen_name('old') is None
+    assert user_cache.get_by_screen_name('NEW') == twitter.User(id=1, screen_name='New')
+    assert user_cache.get_by_screen_name('same') == twitter.User(id=2, screen_name='Same')
+    assert len(user_cache) == 2
+
+
+def _auths(count):
+    return [twitter.OAuth10aTokens('test', 'test', f'token{i}', 'test') for i in range(count)]
+
+
+def _run_client(test, credential_count=1, **kwargs):
+    async def run():
+        fake_twitter = FakeTwitter(user_ids=[], first_tweet_id=1000, tweets_per_sec=0, **kwargs)
+        await fake_twitter.start()
+        try:
+            client = twitter.Client(auths=_auths(credential_count), base_url=fake_twitter.base_url)
+            return await test(client, fake_twitter)
+        finally:
+            await fake_twitter.stop()
+
+    return asyncio.run(run())
+
+
+def test_get_users_by_screen_names():
+    async def test(client, fake_twitter):
+        lookups = []
+        lookup_users = client._lookup_users
+
+        async def counting_lookup_users(screen_names):
+            lookups.append(len(screen_names))
+            return await lookup_users(screen_names)
+
+        client._lookup_users = counting_lookup_users
+        first = await client.get_users_by_screen_names([f'User{user_id}' for user_id in range(1, 151)])
+        # Cached users are found by any case of their screen name, and unknown names are left out.
+        second = await client.get_users_by_screen_names(['USER2', 'nobody', 'user1', 'user151'])
+        return first, second, lookups
+
+    first, second, lookups = _run_client(test)
+
+    assert first == [twitter.User(id=user_id, screen_name=f'User{user_id}') for user_id in range(1, 151)]
+    assert second == [
+        twitter.User(id=2, screen_name='User2'),
+        twitter.User(id=1, screen_name='User1'),
+        twitter.User(id=151, screen_name='user151'),
+    ]
+    assert lookups == [twitter.USERS_LOOKUP_BATCH_SIZE, 150 - twitter.USERS_LOOKUP_BATCH_SIZE, 2]
+
+
+def _iter_user_timeline(**kwargs):
+    """Posts tweets 1001 to 1010 (or ``tweet_count``), deletes ``deleted_tweet_ids``, and pages through the timeline.
+    Returns the IDs of each page's tweets, whether it reached since_id, and how many requests it took.
+    """
+    tweet_count = kwargs.pop('tweet_count', 10)
+    deleted_tweet_ids = kwargs.pop('deleted_tweet_ids', ())
+
+    async def test(client, fake_twitter):
+        for _ in range(tweet_count):
+            fake_twitter.post_tweet(1)
+        for tweet_id in deleted_tweet_ids:
+            fake_twitter.delete_tweet(tweet_id)
+
+        pages = [
+            ([tweet.id for tweet in page.timeline.tweets], page.reached_since_id)
+            async for page in client.iter_user_timeline(1, **kwargs)
+        ]
+        return pages, fake_twitter.requests
+
+    return _run_client(test)
+
+
+def test_iter_user_timeline_reaches_since_id():
+    assert _iter_user_timeline(since_id=1007) == ([([1010, 1009, 1008], True)], 1)
+    assert _iter_user_timeline(since_id=1007, max_id=1009) == ([([1009, 1008], True)], 1)
+    assert _iter_user_timeline(since_id=1010) == ([([], True)], 1)
+
+
+def test_iter_user_timeline_pages_back_to_since_id():
+    pages, requests = _iter_user_timeline(tweet_count=twitter.TIMELINE_PAGE_SIZE + 10, since_id=1005, max_pages=3)
+
+    assert pages == [
+        (list(range(1210, 1010, -1)), False),
+        (list(range(1010, 1005, -1)), True),
+    ]
+    assert requests == 2
+
+
+def test_iter_user_timeline_stops_after_max_pages():
+    pages, requests = _iter_user_timeline(tweet_count=twitter.TIMELINE_PAGE_SIZE + 10, since_id=1005)
+
+    assert pages == [(list(range(1210, 1010, -1)), False)]
+    assert requests == 1
+
+
+def test_iter_user_timeline_checks_for_a_deleted_cursor_tweet():
+    # The short page doesn't have since_id's tweet in it, so only the next one tells that it was deleted.
+    assert _iter_user_timeline(since_id=1007, deleted_tweet_ids=[1007]) == (
+        [([1010, 1009, 1008], False), ([], True)],
+        2,
+    )
+
+
+def test_iter_user_timeline_checks_for_deleted_tweets_in_the_way():
+    pages, requests = _iter_user_timeline(
+        tweet_count=twitter.TIMELINE_PAGE_SIZE + 10,
+        since_id=1005,
+        deleted_tweet_ids=[1100],
+    )
+
+    assert pages == [
+        ([tweet_id for tweet_id in range(1210, 1010, -1) if tweet_id != 1100], False),
+        (list(range(1010, 1005, -1)), True),
+    ]
+    assert requests == 2
+
+
+def test_iter_filtered_stream():
+    async def test(client, fake_twitter):
+        events = []
+        async for event in client.iter_filtered_stream([1, 2]):
+            events.append(event)
+            if event.connected:
+                fake_twitter.post_tweet(3)
+                fake_twitter.post_tweet(2)
+            elif event.tweet is not None:
+                break
+        return events, client.user_cache.get(2)
+
+    events, cached_user = _run_client(test)
+
+    assert [(event.connected, event.tweet and event.tweet.user_id) for event in events] == [(True, None), (False, 2)]
+    assert cached_user == twitter.User(id=2, screen_name='user2')
+
+
+class FakeResponse:
+    def __init__(self, status):
+        self.status = status
+
+
+@pytest.mark.parametrize(
+    ('exception', 'expected'),
+    (
+        (peony.exceptions.PeonyException(data={'errors': [{'code': 63, 'message': 'Suspended'}]}), 'suspended'),
+        (peony.exceptions.PeonyException(data={'errors': [{'code': 50, 'message': 'Not found'}]}), 'gone'),
+        # Protected timelines don't come with an error code.
+        (peony.exceptions.PeonyException(response=FakeResponse(401), data=''), 'protected'),
+        (peony.exceptions.PeonyException(data={'errors': [{'code': 88, 'message': 'Rate limited'}]}), None),
+        (peony.exceptions.PeonyException(response=FakeResponse(500), data=''), None),
+    ),
+)
+def test_classify_account_error(exception, expected):
+    assert twitter.classify_account_error(exception) == expected
+
+
+def test_get_user_timeline_of_suspended_user():
+    async def test(client, fake_twitter):
+        fake_twitter.suspend(1)
+        with pytest.raises(twitter.AccountUnavailable) as e:
+            await client.get_user_timeline_by_user_id(1)
+        return e.value
+
+    exception = _run_client(test)
+
+    assert (exception.user_id, exception.reason) == (1, 'suspended')
@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from tothc import commands
+from tothc.clients import slack
+
+
+def _command(name, *screen_names):
+    return commands.Command(
+        name=name,
+        screen_names=list(screen_names),
+        channel='C1',
+        text=f'{name} {" ".join(screen_names)}',
+        received_at=0.0,
+    )
+
+
+def test_dispatcher_orders_commands_about_the_same_user():
+    events = []
+    unblock = {}
+
+    async def handler(command):
+        events.append(('start', command.text))
+        if command.text in unblock:
+            await unblock[command.text].wait()
+        events.append(('end', command.text))
+
+    async def test():
+        unblock['subscribe foo'] = asyncio.Event()
+        dispatcher = commands.CommandDispatcher(handler, worker_count=3)
+        runner = asyncio.ensure_future(dispatcher.run())
+
+        await dispatcher.dispatch(_command('subscribe', 'foo'))
+        await dispatcher.dispatch(_command('unsubscribe', 'FOO', 'bar'))
+        await dispatcher.dispatch(_command('subscribe', 'baz'))
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+        # The unsubscribe waits for the subscribe about the same user, but the other user doesn't.
+        assert events == [('start', 'subscribe foo'), ('start', 'subscribe baz'), ('end', 'subscribe baz')]
+
+        unblock['subscribe foo'].set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        runner.cancel()
+
+    asyncio.run(test())
+
+    assert events[3:] == [
+        ('end', 'subscribe foo'),
+        ('start', 'unsubscribe FOO bar'),
+        ('end', 'unsubscribe FOO bar'),
+    ]
+
+
+def test_dispatcher_keeps_going_after_failures():
+    handled = []
+
+    async def handler(command):
+        handled.append(command.text)
+        if command.name == 'subscribe':
+            raise RuntimeError('Oops')
+
+    async def test():
+        dispatcher = commands.CommandDispatcher(handler, worker_count=1)
+        runner = asyncio.ensure_future(dispatcher.run())
+        await dispatcher.dispatch(_command('subscribe', 'foo'))
+        await dispatcher.dispatch(_command('unsubscribe', 'foo'))
+        for _ in range(10):
+            await asyncio.sleep(0)
+        runner.cancel()
+
+    asyncio.run(test())
+
+    assert handled == ['subscribe foo', 'unsubscribe foo']
+
+
+@pytest.mark.parametrize(
+    ('arguments', 'expected'),
+    (
+        ('foo', ['foo']),
+        ('@foo, bar\nbaz', ['foo', 'bar', 'baz']),
+        ('Foo foo FOO bar', ['Foo', 'bar']),
+        ('<https://twitter.com/foo|twitter.com/foo> https://twitter.com/Bar/status/1', ['foo', 'Bar']),
+        ('this_is_too_long_to_be_a_username', []),
+        ('!!! ,,', []),
+    ),
+)
+def test_parse_screen_names(arguments, expected):
+    assert commands.parse_screen_names(arguments) == expected
+
+
+@pytest.mark.parametrize(
+    ('text', 'expected'),
+    (
+        ('subscribe foo, @bar', ('subscribe', ['foo', 'bar'], None)),
+        ('unsubscribe foo', ('unsubscribe', ['foo'], None)),
+        ('filter foo photos,videos -replies', ('filter', ['foo'], 'photos,videos -replies')),
+        ('filter foo', ('filter', ['foo'], None)),
+        ('<@U123> subscribe foo', ('subscribe', ['foo'], None)),
+        (' <@U123>: unsubscribe foo', ('unsubscribe', ['foo'], None)),
+    ),
+)
+def test_parse_command(text, expected):
+    command = commands.parse_command(slack.IncomingMessage(data={'text': text, 'channel': 'C1'}, received_at=1.0))
+
+    assert (command.name, command.screen_names, command.filter_rule) == expected
+    assert command.channel == 'C1'
+
+
+@pytest.mark.parametrize(
+    'text',
+    (
+        '',
+        'hello',
+        'subscribe',
+        'subscribe !!!',
+        'we should filter those out',
+        'Did you subscribe foo?',
+        '<@U123> we should unsubscribe foo',
+    ),
+)
+def test_parse_command_ignores_other_messages(text):
+    assert commands.parse_command(slack.IncomingMessage(data={'text': text, 'channel': 'C1'}, received_at=1.0)) is None
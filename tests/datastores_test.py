@@ -0,0 +1,37 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from tothc import datastores
+
+
+async def _run(datastore, coroutine_function):
+    await datastore.connect()
+    try:
+        await datastore.ensure_initialized()
+        return await coroutine_function(datastore)
+    finally:
+        await datastore.disconnect()
+
+
+def test_sqlite_readers_cant_write(tmp_path):
+    async def write_through_reader(datastore):
+        async with datastore.connection() as conn:
+            await conn.execute("INSERT INTO leases (name, expires_at) VALUES ('x', '2020-01-01')")
+
+    with pytest.raises(sqlite3.OperationalError):
+        asyncio.run(_run(datastores.Datastore(f'sqlite:///{tmp_path / "tothc.db"}'), write_through_reader))
+
+
+def test_sqlite_writers_share_a_connection(tmp_path):
+    async def write_twice(datastore):
+        async with datastore.writer() as first:
+            await first.execute("INSERT INTO leases (name, expires_at) VALUES ('x', '2020-01-01')")
+        async with datastore.writer() as second:
+            await second.execute("INSERT INTO leases (name, expires_at) VALUES ('y', '2020-01-01')")
+        async with datastore.connection() as conn:
+            rows = await conn.fetch_all('SELECT name FROM leases ORDER BY name')
+        return first is second, [row['name'] for row in rows]
+
+    assert asyncio.run(_run(datastores.Datastore(f'sqlite:///{tmp_path / "tothc.db"}'), write_twice)) == (True, ['x', 'y'])
@@ -0,0 +1,126 @@
+import pytest
+
+from tothc import filters
+from tothc.clients import twitter
+
+
+def _tweet(**kwargs):
+    kwargs.setdefault('id', 1)
+    kwargs.setdefault('user_id', 10)
+    kwargs.setdefault('screen_name', 'someone')
+    return twitter.Tweet(**kwargs)
+
+
+PHOTO = _tweet(id=1, media_count=1, media_types=frozenset({'photo'}), like_count=2000)
+VIDEO = _tweet(id=2, media_count=1, media_types=frozenset({'video'}), like_count=100)
+TEXT = _tweet(id=3, like_count=5000)
+PHOTO_REPLY = _tweet(id=4, media_count=1, media_types=frozenset({'photo'}), in_reply_to_user_id=20)
+SELF_RETWEET = _tweet(
+    id=5,
+    media_count=1,
+    media_types=frozenset({'photo'}),
+    retweeted_status_id=50,
+    retweeted_user_id=10,
+)
+OTHER_RETWEET = _tweet(
+    id=6,
+    media_count=1,
+    media_types=frozenset({'photo'}),
+    retweeted_status_id=60,
+    retweeted_user_id=20,
+)
+TWEETS = [PHOTO, VIDEO, TEXT, PHOTO_REPLY, SELF_RETWEET, OTHER_RETWEET]
+
+
+def _kept(rule):
+    return [tweet.id for tweet, keep in zip(TWEETS, filters.compile_rule(rule)(TWEETS)) if keep]
+
+
+@pytest.mark.parametrize(
+    ('rule', 'expected'),
+    (
+        ('', None),
+        ('  DEFAULT ', None),
+        ('Photos', 'photos'),
+        ('photos ,  videos   -replies', 'photos,videos -replies'),
+        ('likes>=1.5K', 'likes>=1.5k'),
+    ),
+)
+def test_normalize_rule(rule, expected):
+    assert filters.normalize_rule(rule) == expected
+
+
+@pytest.mark.parametrize(
+    'rule',
+    (
+        'selfies',
+        'likes>',
+        'likes>>1',
+        'likes=1g',
+        'media>1',
+        'photos,',
+        '-',
+        'photos,,videos',
+        'likes>1;__import__',
+        '().__class__.__mro__',
+        'photos or True',
+        'tweet.raw',
+    ),
+)
+def test_normalize_rule_rejects(rule):
+    with pytest.raises(filters.FilterRuleError):
+        filters.normalize_rule(rule)
+
+
+def test_parse_rule():
+    assert filters.parse_rule('photos,likes>1k -replies') == (
+        filters.Term(
+            negated=False,
+            alternatives=(
+                filters.Kind(name='photos'),
+                filters.Count(name='likes', comparison='>', threshold=1000),
+            ),
+        ),
+        filters.Term(negated=True, alternatives=(filters.Kind(name='replies'),)),
+    )
+
+
+def test_parse_rule_default():
+    assert filters.parse_rule(None) == filters.parse_rule(filters.DEFAULT_RULE)
+
+
+@pytest.mark.parametrize(
+    ('rule', 'expected'),
+    (
+        (None, [1, 2, 4, 6]),
+        ('all', [1, 2, 3, 4, 5, 6]),
+        ('photos', [1, 4, 5, 6]),
+        ('photos,videos -replies', [1, 2, 5, 6]),
+        ('retweets -self-retweets', [6]),
+        ('likes>1k', [1, 3]),
+        ('likes>=2k', [1, 3]),
+        ('likes=100', [2]),
+        ('likes<100', [4, 5, 6]),
+        ('media likes<=100', [2, 4, 5, 6]),
+        ('-media', [3]),
+        ('quotes', []),
+    ),
+)
+def test_compile_rule(rule, expected):
+    assert _kept(rule) == expected
+
+
+def test_compile_rule_is_cached():
+    assert filters.compile_rule('photos') is filters.compile_rule('photos')
+
+
+def test_route_tweets():
+    routed = filters.route_tweets(TWEETS, {'C1': 'photos', 'C2': 'videos', 'C3': 'photos'})
+
+    assert [(tweet.id, channels) for tweet, channels in routed] == [
+        (1, ('C1', 'C3')),
+        (2, ('C2',)),
+        (4, ('C1', 'C3')),
+        (5, ('C1', 'C3')),
+        (6, ('C1', 'C3')),
+    ]
@@ -0,0 +1,34 @@
+import logging
+
+from tothc.logging import RateLimitFilter
+
+
+def _record(msg, created, level=logging.INFO):
+    record = logging.makeLogRecord({'name': 'tothc.test', 'msg': msg, 'levelno': level})
+    record.created = created
+    return record
+
+
+def test_rate_limit_filter():
+    rate_limit = RateLimitFilter(records_per_period=2, period_sec=10)
+
+    assert [rate_limit.filter(_record('Polled %s', created)) for created in (0, 1, 2, 3)] == [True, True, False, False]
+    assert rate_limit.filter(_record('Something else', 4))
+    assert rate_limit.filter(_record('Failed', 5, level=logging.WARNING))
+
+    record = _record('Polled %s', 10)
+    assert rate_limit.filter(record)
+    assert record.getMessage() == 'Polled %s (2 more like this were dropped)'
+
+
+def test_rate_limit_filter_forgets_old_messages():
+    rate_limit = RateLimitFilter(records_per_period=1, period_sec=10)
+    for created in range(100):
+        rate_limit.filter(_record(f'Polled user {created}', created))
+    rate_limit.filter(_record('Busy', 100))
+    rate_limit.filter(_record('Busy', 101))
+
+    rate_limit.filter(_record('Polled user 0', 120))
+
+    # Only the messages from the last period, and the one that dropped a record.
+    assert set(rate_limit._periods) == {('tothc.test', 'Busy'), ('tothc.test', 'Polled user 0')}
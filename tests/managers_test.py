@@ -0,0 +1,288 @@
+import asyncio
+import datetime
+
+import databases.core
+import pytest
+from sqlalchemy.dialects import sqlite
+
+from tothc import datastores
+from tothc import managers
+from tothc.clients import slack
+from tothc.clients import twitter
+
+
+@pytest.fixture
+def datastore(tmp_path):
+    return datastores.Datastore(f'sqlite:///{tmp_path / "tothc.db"}')
+
+
+@pytest.fixture
+def bound_parameter_counts(monkeypatch):
+    """Records how many parameters each statement binds, since the SQLite we test against might allow more than the
+    999 that older builds do.
+    """
+    counts = []
+    execute = databases.core.Connection.execute
+
+    async def counting_execute(self, query, values=None):
+        if not isinstance(query, str):
+            counts.append(len(query.compile(dialect=sqlite.dialect()).params))
+        return await execute(self, query, values)
+
+    monkeypatch.setattr(databases.core.Connection, 'execute', counting_execute)
+    return counts
+
+
+def _run(datastore, coroutine_function):
+    async def run():
+        await datastore.connect()
+        try:
+            await datastore.ensure_initialized()
+            return await coroutine_function()
+        finally:
+            await datastore.disconnect()
+
+    return asyncio.run(run())
+
+
+async def _add_digest_messages(datastore, channel, user_id, count):
+    async with datastore.writer() as conn:
+        await managers.OutboxManager.add_messages(
+            conn,
+            messages=[slack.OutgoingMessage(channel=channel, text=f'{user_id}-{i}') for i in range(count)],
+            digest_user_ids=[user_id] * count,
+        )
+
+
+def test_list_ready_digests(datastore):
+    async def test():
+        await _add_digest_messages(datastore, 'C1', 1, 3)
+        await _add_digest_messages(datastore, 'C2', 2, 2)
+        await _add_digest_messages(datastore, 'C1', 3, 1)
+        # Not a digest.
+        async with datastore.writer() as conn:
+            await managers.OutboxManager.add_messages(conn, messages=[slack.OutgoingMessage(channel='C1', text='x')])
+
+        async with datastore.connection() as conn:
+            all_ready = await managers.OutboxManager.list_ready_digests(
+                conn,
+                created_before=datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+                min_size=2,
+                limit=2,
+                max_attempts=3,
+            )
+            full = await managers.OutboxManager.list_ready_digests(
+                conn,
+                created_before=datetime.datetime.utcnow() - datetime.timedelta(hours=1),
+                min_size=3,
+                limit=10,
+                max_attempts=3,
+            )
+        return all_ready, full
+
+    all_ready, full = _run(datastore, test)
+
+    # The oldest two digests, each cut down to two messages.
+    assert [message.message.text for message in all_ready] == ['1-0', '1-1', '2-0', '2-1']
+    assert [message.message.text for message in full] == ['1-0', '1-1', '1-2']
+
+
+def test_import_subscriptions_across_chunks(datastore):
+    # More rows than fit in one INSERT, and more user IDs than fit in one IN.
+    user_ids = range(1, 1001)
+    records = [
+        managers.SubscriptionRecord(
+            user_id=user_id,
+            screen_name=f'User{user_id}',
+            latest_tweet_id=user_id * 10,
+            tweets_per_day=None,
+            channel='C1',
+            filter_rule=None,
+        )
+        for user_id in user_ids
+    ]
+
+    async def test():
+        async with datastore.writer() as conn:
+            await managers.TwitterSubscriptionManager.import_subscriptions(conn, records=records)
+            await managers.ChannelSubscriptionManager.import_subscriptions(
+                conn,
+                subscriptions=[managers.ChannelSubscription(channel='C1', user_id=user_id) for user_id in user_ids],
+            )
+            # Importing again changes only the rules that differ.
+            await managers.ChannelSubscriptionManager.import_subscriptions(
+                conn,
+                subscriptions=[managers.ChannelSubscription(channel='C1', user_id=1, filter_rule='photos')],
+            )
+
+        async with datastore.connection() as conn:
+            exported = await managers.TwitterSubscriptionManager.list_subscription_records(
+                conn,
+                after_user_id=None,
+                limit=len(records),
+            )
+            channel_subscriptions = await managers.ChannelSubscriptionManager.list_channel_subscriptions(conn)
+        return exported, channel_subscriptions
+
+    exported, channel_subscriptions = _run(datastore, test)
+
+    assert exported[1:] == records[1:]
+    assert exported[0] == records[0]._replace(filter_rule='photos')
+    assert sorted(channel_subscriptions) == sorted(
+        [managers.ChannelSubscription(channel='C1', user_id=1, filter_rule='photos')]
+        + [managers.ChannelSubscription(channel='C1', user_id=user_id) for user_id in user_ids[1:]],
+    )
+
+
+def test_outbox_attempts(datastore):
+    async def test():
+        async with datastore.writer() as conn:
+            await managers.OutboxManager.add_messages(
+                conn,
+                messages=[slack.OutgoingMessage(channel='C1', text=str(i)) for i in range(3)],
+            )
+            first, second, third = await managers.OutboxManager.list_pending(conn, limit=10, max_attempts=2)
+            await managers.OutboxManager.mark_sent(conn, ids=[first.id])
+            given_up = [
+                await managers.OutboxManager.record_failed_attempts(conn, ids=[second.id, third.id], max_attempts=2),
+                await managers.OutboxManager.record_failed_attempts(conn, ids=[second.id], max_attempts=2),
+            ]
+            pending = await managers.OutboxManager.list_pending(conn, limit=10, max_attempts=2)
+
+            # Nothing's old enough to delete yet.
+            await managers.OutboxManager.delete_finished_before(
+                conn,
+                before=datetime.datetime.utcnow() - datetime.timedelta(hours=1),
+                max_attempts=2,
+            )
+            kept = await conn.fetch_all('SELECT id FROM outbox')
+            await managers.OutboxManager.delete_finished_before(
+                conn,
+                before=datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+                max_attempts=2,
+            )
+            left = await conn.fetch_all('SELECT id FROM outbox')
+        return (first, second, third), given_up, pending, len(kept), [row['id'] for row in left]
+
+    (first, second, third), given_up, pending, kept_count, left_ids = _run(datastore, test)
+
+    assert [message.message.text for message in (first, second, third)] == ['0', '1', '2']
+    assert given_up[0] == []
+    assert [message.id for message in given_up[1]] == [second.id]
+    assert given_up[1][0].attempts == 2
+    # Sent and given up messages are done with, and the third still has an attempt left.
+    assert [message.id for message in pending] == [third.id]
+    assert kept_count == 3
+    assert left_ids == [third.id]
+
+
+def test_subscribe_many_across_chunks(datastore, bound_parameter_counts):
+    users = [twitter.User(id=user_id, screen_name=f'User{user_id}') for user_id in range(1, 1001)]
+
+    async def test():
+        async with datastore.writer() as conn:
+            await managers.TwitterSubscriptionManager.subscribe_many(conn, users=users)
+            await managers.TwitterSubscriptionManager.unsubscribe(conn, user_ids=[user.id for user in users])
+            # Re-enabling them sets every screen name in a CASE.
+            await managers.TwitterSubscriptionManager.subscribe_many(
+                conn,
+                users=[user._replace(screen_name=f'Renamed{user.id}') for user in users],
+            )
+
+        async with datastore.connection() as conn:
+            return await managers.TwitterSubscriptionManager.list_subscription_records(
+                conn,
+                after_user_id=None,
+                limit=len(users),
+            )
+
+    records = _run(datastore, test)
+
+    assert [(record.user_id, record.screen_name) for record in records] == [
+        (user.id, f'Renamed{user.id}') for user in users
+    ]
+    assert max(bound_parameter_counts) <= managers.MAX_BOUND_PARAMETERS
+
+
+def test_update_screen_names(datastore):
+    users = [twitter.User(id=user_id, screen_name=f'User{user_id}') for user_id in range(1, 4)]
+
+    async def test():
+        async with datastore.writer() as conn:
+            await managers.TwitterSubscriptionManager.subscribe_many(conn, users=users)
+            await managers.TwitterSubscriptionManager.update_screen_names(
+                conn,
+                users=[twitter.User(id=1, screen_name='Renamed'), twitter.User(id=3, screen_name='ALSO_RENAMED')],
+            )
+
+        async with datastore.connection() as conn:
+            screen_names = await managers.TwitterSubscriptionManager.get_screen_names_of_active_subscriptions(conn)
+            new_user_ids = await managers.TwitterSubscriptionManager.list_user_ids_by_screen_names(
+                conn,
+                screen_names=['renamed', 'also_renamed', 'USER2'],
+            )
+            old_user_ids = await managers.TwitterSubscriptionManager.list_user_ids_by_screen_names(
+                conn,
+                screen_names=['User1', 'User3'],
+            )
+        return screen_names, new_user_ids, old_user_ids
+
+    screen_names, new_user_ids, old_user_ids = _run(datastore, test)
+
+    assert screen_names == {1: 'Renamed', 2: 'User2', 3: 'ALSO_RENAMED'}
+    assert sorted(new_user_ids) == [1, 2, 3]
+    assert old_user_ids == []
+
+
+def test_update_account_failures_across_chunks(datastore, bound_parameter_counts):
+    users = [twitter.User(id=user_id, screen_name=f'User{user_id}') for user_id in range(1, 401)]
+    failures = [
+        managers.AccountFailures(
+            user_id=user.id,
+            consecutive_failures=user.id,
+            reason='suspended',
+            quarantined_until=1600000000.0 + user.id,
+            notified=user.id % 2 == 0,
+        )
+        for user in users
+    ]
+
+    async def test():
+        async with datastore.writer() as conn:
+            await managers.TwitterSubscriptionManager.subscribe_many(conn, users=users)
+            await managers.TwitterSubscriptionManager.update_account_failures(conn, failures=failures)
+            # The first user's poll worked again.
+            await managers.TwitterSubscriptionManager.update_account_failures(
+                conn,
+                failures=[failures[0]._replace(consecutive_failures=0, reason=None, quarantined_until=None, notified=False)],
+            )
+
+        async with datastore.connection() as conn:
+            return await managers.TwitterSubscriptionManager.list_account_failures_of_active_subscriptions(conn)
+
+    listed = _run(datastore, test)
+
+    assert sorted(listed) == failures[1:]
+    assert max(bound_parameter_counts) <= managers.MAX_BOUND_PARAMETERS
+
+
+def test_update_latest_tweet_ids_across_chunks(datastore, bound_parameter_counts):
+    users = [twitter.User(id=user_id, screen_name=f'User{user_id}') for user_id in range(1, 401)]
+    cursors = [
+        managers.SubscriptionCursor(user_id=user.id, latest_tweet_id=user.id * 10, tweets_per_day=user.id / 2)
+        for user in users
+    ]
+
+    async def test():
+        async with datastore.writer() as conn:
+            await managers.TwitterSubscriptionManager.subscribe_many(conn, users=users)
+            await managers.TwitterSubscriptionManager.update_latest_tweet_ids(conn, cursors=cursors)
+
+        async with datastore.connection() as conn:
+            return await managers.TwitterSubscriptionManager.get_latest_tweet_ids_for_user_ids(
+                conn,
+                user_ids=[user.id for user in users],
+            )
+
+    assert _run(datastore, test) == {cursor.user_id: cursor.latest_tweet_id for cursor in cursors}
+    assert max(bound_parameter_counts) <= managers.MAX_BOUND_PARAMETERS
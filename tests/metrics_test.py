@@ -0,0 +1,140 @@
+import asyncio
+import socket
+
+import aiohttp
+import pytest
+
+from tothc import metrics
+
+
+def test_counter():
+    counter = metrics.Counter('test_total', 'Things.', ['reason'])
+    counter.inc(reason='a')
+    counter.inc(2, reason='a')
+    counter.inc(reason='say "hi"\n')
+
+    assert counter.render() == [
+        '# HELP test_total Things.',
+        '# TYPE test_total counter',
+        'test_total{reason="a"} 3.0',
+        r'test_total{reason="say \"hi\"\n"} 1.0',
+    ]
+
+
+def test_counter_rejects_bad_calls():
+    counter = metrics.Counter('test_total', 'Things.', ['reason'])
+
+    with pytest.raises(ValueError):
+        counter.inc(-1, reason='a')
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        counter.inc(reason='a', other='b')
+
+
+def test_unlabelled_counter_starts_at_zero():
+    assert metrics.Counter('test_total', 'Things.').render()[-1] == 'test_total 0.0'
+
+
+def test_gauge():
+    gauge = metrics.Gauge('test_depth', 'Depth.')
+    assert gauge.render() == ['# HELP test_depth Depth.', '# TYPE test_depth gauge']
+
+    gauge.set(3)
+    gauge.set(2)
+    assert gauge.render()[-1] == 'test_depth 2.0'
+
+    depths = [5]
+    gauge.set_function(lambda: depths[0])
+    depths[0] = 7
+    assert gauge.render()[-1] == 'test_depth 7.0'
+
+
+def test_labelled_gauge_cannot_be_read_from_a_function():
+    with pytest.raises(ValueError):
+        metrics.Gauge('test_depth', 'Depth.', ['queue']).set_function(lambda: 0)
+
+
+def test_histogram():
+    histogram = metrics.Histogram('test_seconds', 'Latency.', ['method'], buckets=(1, 0.1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value, method='get')
+
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{method="get",le="0.1"} 2',
+        'test_seconds_bucket{method="get",le="1.0"} 3',
+        'test_seconds_bucket{method="get",le="+Inf"} 4',
+        'test_seconds_sum{method="get"} 2.65',
+        'test_seconds_count{method="get"} 4',
+    ]
+
+
+def test_timed_observes_failed_calls():
+    histogram = metrics.Histogram('test_seconds', 'Latency.', ['method'])
+
+    @metrics.timed(histogram, method='fail')
+    async def fail():
+        raise RuntimeError
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(fail())
+
+    assert 'test_seconds_count{method="fail"} 1' in histogram.render()
+
+
+def test_timed_methods():
+    histogram = metrics.Histogram('test_seconds', 'Latency.', ['method'])
+
+    @metrics.timed_methods(histogram)
+    class Manager:
+        @classmethod
+        async def get(cls, value):
+            return value
+
+        @classmethod
+        def not_a_coroutine(cls):
+            return cls
+
+    assert asyncio.run(Manager.get(1)) == 1
+    assert Manager.not_a_coroutine() is Manager
+
+    rendered = histogram.render()
+    assert 'test_seconds_count{method="Manager.get"} 1' in rendered
+    assert not any('not_a_coroutine' in line for line in rendered)
+
+
+def test_registry_rejects_duplicates():
+    registry = metrics.Registry()
+    registry.register(metrics.Counter('test_total', 'Things.'))
+
+    with pytest.raises(ValueError):
+        registry.register(metrics.Counter('test_total', 'Other things.'))
+
+
+def _unused_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_metrics_server():
+    port = _unused_port()
+    registry = metrics.Registry()
+    registry.register(metrics.Counter('test_total', 'Things.'))
+    registry.register(metrics.Gauge('test_depth', 'Depth.'))
+
+    async def scrape():
+        server = metrics.MetricsServer(host='127.0.0.1', port=port, registry=registry)
+        await server.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'http://127.0.0.1:{port}/metrics') as response:
+                    return response.headers['Content-Type'], await response.text()
+        finally:
+            await server.stop()
+
+    content_type, text = asyncio.run(scrape())
+
+    assert content_type == metrics.CONTENT_TYPE
+    assert text == registry.render()
+    assert text.endswith('test_total 0.0\n# HELP test_depth Depth.\n# TYPE test_depth gauge\n')
@@ -0,0 +1,99 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from tothc import datastores
+from tothc import migrations
+from tothc import models
+
+
+async def _migrate_and_describe(datastore):
+    await datastore.connect()
+    try:
+        await datastore.ensure_initialized()
+        async with datastore.connection() as conn:
+            existing_columns = await migrations.list_existing_columns(conn, datastore._dialect)
+            indexes = await conn.fetch_all("SELECT name FROM sqlite_master WHERE type = 'index'")
+            versions = await conn.fetch_all('SELECT version FROM schema_migrations')
+    finally:
+        await datastore.disconnect()
+
+    return existing_columns, {row['name'] for row in indexes}, sorted(row['version'] for row in versions)
+
+
+def test_fresh_db_matches_models(tmp_path):
+    datastore = datastores.Datastore(f'sqlite:///{tmp_path / "tothc.db"}')
+
+    existing_columns, indexes, versions = asyncio.run(_migrate_and_describe(datastore))
+
+    assert existing_columns == {
+        table.name: {column.name for column in table.columns}
+        for table in models.metadata.sorted_tables
+    }
+    for table in models.metadata.sorted_tables:
+        for index in table.indexes:
+            assert index.name in indexes
+    assert versions == [migration.version for migration in migrations.MIGRATIONS]
+
+
+def test_migrations_run_once(tmp_path):
+    url = f'sqlite:///{tmp_path / "tothc.db"}'
+    first = asyncio.run(_migrate_and_describe(datastores.Datastore(url)))
+    second = asyncio.run(_migrate_and_describe(datastores.Datastore(url)))
+
+    assert first == second
+
+
+async def _create_original_schema(datastore):
+    await datastore.connect()
+    try:
+        async with datastore.writer() as conn:
+            await conn.execute(
+                'CREATE TABLE twitter_subscriptions ('
+                'id INTEGER NOT NULL PRIMARY KEY, '
+                'user_id INTEGER NOT NULL UNIQUE, '
+                'screen_name VARCHAR, '
+                'subscribed_at DATETIME NOT NULL, '
+                'unsubscribed_at DATETIME, '
+                'latest_tweet_id INTEGER, '
+                'refreshed_latest_tweet_id_at DATETIME)',
+            )
+            # Startup made these itself before there were migrations.
+            await conn.execute('ALTER TABLE twitter_subscriptions ADD COLUMN tweets_per_day FLOAT')
+            await conn.execute(
+                'CREATE TABLE leases (name VARCHAR NOT NULL PRIMARY KEY, holder VARCHAR, expires_at DATETIME NOT NULL)',
+            )
+            await conn.execute(
+                "INSERT INTO twitter_subscriptions (user_id, screen_name, subscribed_at) VALUES (1, 'Someone', '2020-01-01')",
+            )
+    finally:
+        await datastore.disconnect()
+
+
+def test_db_from_before_migrations(tmp_path):
+    url = f'sqlite:///{tmp_path / "tothc.db"}'
+    asyncio.run(_create_original_schema(datastores.Datastore(url)))
+
+    existing_columns, _, _ = asyncio.run(_migrate_and_describe(datastores.Datastore(url)))
+
+    assert existing_columns['twitter_subscriptions'] == {column.name for column in models.twitter_subscriptions.columns}
+    assert existing_columns['leases'] == {column.name for column in models.leases.columns}
+    assert 'instances' in existing_columns
+
+
+def test_failed_migration_leaves_db_as_it_was(tmp_path, monkeypatch):
+    async def fail(conn, dialect):
+        raise RuntimeError('Failed')
+
+    monkeypatch.setattr(migrations, 'MIGRATIONS', migrations.MIGRATIONS + [migrations.Migration(1000, 'Fail', fail)])
+    url = f'sqlite:///{tmp_path / "tothc.db"}'
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(_migrate_and_describe(datastores.Datastore(url)))
+    with sqlite3.connect(str(tmp_path / 'tothc.db')) as conn:
+        assert conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall() == []
+
+    monkeypatch.undo()
+    _, _, versions = asyncio.run(_migrate_and_describe(datastores.Datastore(url)))
+    assert versions == [migration.version for migration in migrations.MIGRATIONS]
@@ -0,0 +1,98 @@
+import asyncio
+
+from tothc import pipeline
+
+
+def _run(pipe, items):
+    return asyncio.run(pipe.run(items))
+
+
+def test_items_flow_through_stages():
+    outputs = []
+
+    async def double(item):
+        return item * 2
+
+    async def drop_odd(item):
+        return item if item % 4 == 0 else None
+
+    async def collect(item):
+        outputs.append(item)
+
+    report = _run(
+        pipeline.Pipeline([
+            pipeline.Stage('double', double, concurrency=3),
+            pipeline.Stage('drop_odd', drop_odd),
+            pipeline.Stage('collect', collect),
+        ]),
+        range(10),
+    )
+
+    assert sorted(outputs) == [0, 4, 8, 12, 16]
+    assert [(stage.name, stage.processed, stage.dropped) for stage in report.stages] == [
+        ('double', 10, 0),
+        ('drop_odd', 10, 5),
+        ('collect', 5, 0),
+    ]
+
+
+def test_batches():
+    batches = []
+
+    async def collect(batch):
+        batches.append(batch)
+
+    # The pipeline's input is done before a batch would have waited long enough to fill up.
+    report = _run(
+        pipeline.Pipeline([pipeline.Stage('collect', collect, batch_size=4, batch_linger_sec=60)]),
+        range(10),
+    )
+
+    assert sorted(item for batch in batches for item in batch) == list(range(10))
+    assert all(len(batch) <= 4 for batch in batches)
+    assert report.stages[0].processed == 10
+
+
+def test_failures_and_timeouts_are_counted():
+    passed = []
+
+    async def flaky(item):
+        if item == 1:
+            raise RuntimeError('Oops')
+        if item == 2:
+            await asyncio.sleep(10)
+        return item
+
+    async def collect(item):
+        passed.append(item)
+
+    report = _run(
+        pipeline.Pipeline([
+            pipeline.Stage('flaky', flaky, concurrency=2, timeout_sec=0.01),
+            pipeline.Stage('collect', collect),
+        ]),
+        range(4),
+    )
+
+    assert sorted(passed) == [0, 3]
+    flaky_report = report.stages[0]
+    assert (flaky_report.processed, flaky_report.failed, flaky_report.timed_out) == (2, 1, 1)
+
+
+def test_backpressure_bounds_queues():
+    async def slow(item):
+        await asyncio.sleep(0.001)
+
+    report = _run(
+        pipeline.Pipeline(
+            [
+                pipeline.Stage('fast', lambda item: asyncio.sleep(0, result=item), concurrency=4),
+                pipeline.Stage('slow', slow),
+            ],
+            queue_size=3,
+        ),
+        range(50),
+    )
+
+    assert all(stage.max_queue_depth <= 3 for stage in report.stages)
+    assert report.stages[1].processed == 50
@@ -0,0 +1,77 @@
+from tothc import quarantine
+from tothc.managers import AccountFailures
+
+
+def _fail(tracker, user_id, times, now=0):
+    for _ in range(times):
+        failure = tracker.record_failure(user_id, 'suspended', now)
+    return failure
+
+
+def test_quarantine_duration_sec():
+    assert quarantine.quarantine_duration_sec(quarantine.QUARANTINE_AFTER_FAILURES) == quarantine.BASE_QUARANTINE_SEC
+    assert quarantine.quarantine_duration_sec(quarantine.QUARANTINE_AFTER_FAILURES + 2) == 4 * quarantine.BASE_QUARANTINE_SEC
+    assert quarantine.quarantine_duration_sec(1000) == quarantine.MAX_QUARANTINE_SEC
+
+
+def test_quarantines_after_failures_in_a_row():
+    tracker = quarantine.QuarantineTracker()
+
+    failure = _fail(tracker, 1, quarantine.QUARANTINE_AFTER_FAILURES - 1)
+    assert failure.quarantined_until is None
+    assert tracker.quarantined_user_ids(0) == set()
+
+    failure = _fail(tracker, 1, 1, now=10)
+    assert failure.quarantined_until == 10 + quarantine.BASE_QUARANTINE_SEC
+    assert tracker.quarantined_user_ids(10) == {1}
+    assert tracker.quarantined_user_ids(10 + quarantine.BASE_QUARANTINE_SEC) == set()
+
+    # Once the quarantine is over, a failed probe doubles it.
+    failure = _fail(tracker, 1, 1, now=10 + quarantine.BASE_QUARANTINE_SEC)
+    assert failure.quarantined_until == 10 + 3 * quarantine.BASE_QUARANTINE_SEC
+
+
+def test_success_clears_failures():
+    tracker = quarantine.QuarantineTracker()
+    _fail(tracker, 1, quarantine.QUARANTINE_AFTER_FAILURES)
+    tracker.take_changes()
+
+    tracker.record_success(1)
+    tracker.record_success(2)
+
+    assert tracker.quarantined_user_ids(0) == set()
+    assert len(tracker) == 0
+    assert tracker.take_changes() == [
+        AccountFailures(user_id=1, consecutive_failures=0, reason=None, quarantined_until=None, notified=False),
+    ]
+    assert tracker.take_changes() == []
+
+    # Counting starts over.
+    assert _fail(tracker, 1, 1).consecutive_failures == 1
+
+
+def test_notified_sticks_until_cleared():
+    tracker = quarantine.QuarantineTracker()
+    _fail(tracker, 1, quarantine.QUARANTINE_AFTER_FAILURES)
+    tracker.mark_notified([1, 2])
+
+    assert _fail(tracker, 1, 1).notified
+    tracker.record_success(1)
+    assert not _fail(tracker, 1, 1).notified
+
+
+def test_sync_keeps_unwritten_changes():
+    stored = [
+        AccountFailures(user_id=2, consecutive_failures=5, reason='gone', quarantined_until=100.0, notified=True),
+        AccountFailures(user_id=3, consecutive_failures=1, reason='protected', quarantined_until=None, notified=False),
+    ]
+    tracker = quarantine.QuarantineTracker()
+    tracker.sync(stored)
+    _fail(tracker, 1, quarantine.QUARANTINE_AFTER_FAILURES, now=0)
+    tracker.record_success(2)
+
+    # The DB hasn't heard about either change yet.
+    tracker.sync(stored)
+
+    assert tracker.quarantined_user_ids(0) == {1}
+    assert len(tracker) == 2
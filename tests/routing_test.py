@@ -0,0 +1,78 @@
+from tothc import managers
+from tothc import routing
+
+
+def test_add_and_remove():
+    router = routing.ChannelRouter()
+    router.add(1, 'C2')
+    router.add(1, 'C1')
+    router.add(1, 'C1')
+    router.add(2, 'C1')
+
+    assert router.channels_of(1) == ('C1', 'C2')
+    assert len(router) == 2
+
+    router.remove(1, 'C2')
+    router.remove(2, 'C1')
+    router.remove(3, 'C1')
+
+    assert router.channels_of(1) == ('C1',)
+    assert router.channels_of(2) == ()
+    assert len(router) == 1
+
+
+def test_filter_rules():
+    router = routing.ChannelRouter()
+    router.add(1, 'C1')
+    router.add(1, 'C2')
+    router.set_filter_rule(1, 'C1', 'photos')
+    # Only subscribed channels have rules.
+    router.set_filter_rule(1, 'C3', 'videos')
+
+    assert router.filter_rules_of(1) == {'C1': 'photos', 'C2': None}
+
+    # Subscribing again starts over with the default rule.
+    router.remove(1, 'C1')
+    router.add(1, 'C1')
+    assert router.filter_rules_of(1) == {'C1': None, 'C2': None}
+
+
+def test_sync():
+    router = routing.ChannelRouter()
+    router.add(1, 'C1')
+    router.add(2, 'C1')
+
+    changed_count = router.sync(
+        [
+            managers.ChannelSubscription(channel='C1', user_id=1),
+            managers.ChannelSubscription(channel='C2', user_id=1, filter_rule='photos'),
+            managers.ChannelSubscription(channel='C1', user_id=3),
+        ],
+        version=router.version,
+    )
+
+    assert changed_count == 3
+    assert router.channels_of(1) == ('C1', 'C2')
+    assert router.filter_rules_of(1) == {'C1': None, 'C2': 'photos'}
+    assert router.channels_of(2) == ()
+    assert router.channels_of(3) == ('C1',)
+
+
+def test_sync_keeps_changes_it_might_have_missed():
+    router = routing.ChannelRouter()
+    router.add(1, 'C1')
+    version = router.version
+    # Handled after the DB was read.
+    router.add(2, 'C1')
+    router.remove(1, 'C1')
+
+    changed_count = router.sync([managers.ChannelSubscription(channel='C1', user_id=1)], version=version)
+
+    assert changed_count == 0
+    assert router.channels_of(1) == ()
+    assert router.channels_of(2) == ('C1',)
+
+    # The next sync reads them.
+    assert router.sync([managers.ChannelSubscription(channel='C1', user_id=3)], version=router.version) == 2
+    assert router.channels_of(2) == ()
+    assert router.channels_of(3) == ('C1',)
@@ -0,0 +1,132 @@
+import pytest
+
+from tothc import scheduler
+from tothc.clients.twitter import RateLimit
+from tothc.managers import ActiveSubscription
+
+
+@pytest.mark.parametrize(
+    ('tweets_per_day', 'expected'),
+    (
+        (None, scheduler.DEFAULT_POLL_INTERVAL_SEC),
+        (0, scheduler.MAX_POLL_INTERVAL_SEC),
+        (96, 15 * 60),
+        (24 * 60, 60),
+        (1000000, scheduler.MIN_POLL_INTERVAL_SEC),
+    ),
+)
+def test_poll_interval_for_tweet_rate(tweets_per_day, expected):
+    assert scheduler.poll_interval_for_tweet_rate(tweets_per_day) == expected
+
+
+def _scheduler(user_count, now=0.0):
+    poll_scheduler = scheduler.PollScheduler()
+    poll_scheduler.sync(
+        [
+            ActiveSubscription(user_id=user_id, tweets_per_day=None, refreshed_latest_tweet_id_at=None)
+            for user_id in range(1, user_count + 1)
+        ],
+        now=now,
+    )
+    return poll_scheduler
+
+
+def test_pop_due_refills_allowance_over_time():
+    poll_scheduler = _scheduler(10)
+
+    # The allowance starts empty, and refills at a request per second with a fresh window.
+    assert poll_scheduler.pop_due(0) == []
+    assert poll_scheduler.pop_due(3) == [1, 2, 3]
+    assert poll_scheduler.pop_due(3) == []
+    assert poll_scheduler.pop_due(5.5) == [4, 5]
+    assert poll_scheduler.pop_due(6) == [6]
+
+
+def test_pop_due_caps_allowance():
+    poll_scheduler = _scheduler(100)
+    poll_scheduler.pop_due(0)
+
+    # A long wait doesn't save up more than a tick's worth of requests.
+    assert len(poll_scheduler.pop_due(1000)) == scheduler.MAX_TICK_SEC
+
+
+def test_pop_due_spreads_rate_limit_over_window():
+    poll_scheduler = _scheduler(10)
+    poll_scheduler.update_rate_limit(RateLimit(limit=900, remaining=10, reset_at=100))
+    poll_scheduler.pop_due(0)
+
+    # What's left of the window is spread evenly until it resets.
+    assert poll_scheduler.pop_due(5) == []
+    assert poll_scheduler.pop_due(10) == [1]
+    assert poll_scheduler.pop_due(20) == [2]
+    assert poll_scheduler.pop_due(100) == [3, 4, 5, 6, 7, 8, 9, 10]
+
+
+def test_update_rate_limit_keeps_lowest_remaining_in_window():
+    poll_scheduler = _scheduler(10)
+    poll_scheduler.update_rate_limit(RateLimit(limit=900, remaining=10, reset_at=100))
+    # An older response, which arrived late.
+    poll_scheduler.update_rate_limit(RateLimit(limit=900, remaining=50, reset_at=100))
+    poll_scheduler.pop_due(0)
+
+    assert poll_scheduler.pop_due(10) == [1]
+
+
+def test_pop_due_skips_without_spending_allowance():
+    poll_scheduler = _scheduler(4)
+    poll_scheduler.pop_due(0)
+
+    assert poll_scheduler.pop_due(2, skip={1, 2}) == [3, 4]
+    # The skipped users are rescheduled as if they'd been polled.
+    assert poll_scheduler.pop_due(2 + scheduler.DEFAULT_POLL_INTERVAL_SEC) == [1, 2]
+
+
+def test_record_poll_reschedules_by_tweet_rate():
+    poll_scheduler = _scheduler(1)
+    poll_scheduler.pop_due(0)
+    assert poll_scheduler.pop_due(1) == [1]
+
+    # The first poll of a user only sets where the rate is measured from.
+    assert poll_scheduler.record_poll(1, 0, now=1) is None
+    assert poll_scheduler.pop_due(1 + scheduler.DEFAULT_POLL_INTERVAL_SEC) == [1]
+
+    tweets_per_day = poll_scheduler.record_poll(1, 100, now=1 + scheduler.DEFAULT_POLL_INTERVAL_SEC)
+    assert tweets_per_day == 100 * scheduler.SECONDS_PER_DAY / scheduler.DEFAULT_POLL_INTERVAL_SEC
+    next_poll_at = 1 + scheduler.DEFAULT_POLL_INTERVAL_SEC + scheduler.MIN_POLL_INTERVAL_SEC
+    assert poll_scheduler.pop_due(next_poll_at - 1) == []
+    assert poll_scheduler.pop_due(next_poll_at) == [1]
+
+
+def test_sync_forgets_inactive_users():
+    poll_scheduler = _scheduler(3)
+    poll_scheduler.sync(
+        [ActiveSubscription(user_id=2, tweets_per_day=None, refreshed_latest_tweet_id_at=None)],
+        now=0,
+    )
+    poll_scheduler.pop_due(0)
+
+    assert len(poll_scheduler) == 1
+    assert poll_scheduler.pop_due(5) == [2]
+
+
+def test_remove():
+    poll_scheduler = _scheduler(3)
+    poll_scheduler.pop_due(0)
+    poll_scheduler.remove(2)
+    poll_scheduler.remove(4)
+
+    assert len(poll_scheduler) == 2
+    assert poll_scheduler.pop_due(5) == [1, 3]
+
+
+def test_spare_allowance_is_only_taken_when_used():
+    poll_scheduler = _scheduler(1)
+    poll_scheduler.pop_due(0)
+    assert poll_scheduler.pop_due(10) == [1]
+
+    assert poll_scheduler.spare_allowance(cost=3) == 3
+    # Only one of the three fit, so the rest is still there next time.
+    poll_scheduler.take_spare_allowance(1, cost=3)
+    assert poll_scheduler.spare_allowance(cost=3) == 2
+    poll_scheduler.take_spare_allowance(2, cost=3)
+    assert poll_scheduler.spare_allowance(cost=3) == 0
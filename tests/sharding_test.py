@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from tothc import datastores
+from tothc import sharding
+
+
+NOW = 1600000000.0
+
+
+@pytest.fixture
+def datastore(tmp_path):
+    return datastores.Datastore(f'sqlite:///{tmp_path / "tothc.db"}')
+
+
+def _run(datastore, coroutine_function):
+    async def run():
+        await datastore.connect()
+        try:
+            await datastore.ensure_initialized()
+            return await coroutine_function()
+        finally:
+            await datastore.disconnect()
+
+    return asyncio.run(run())
+
+
+def _partitions(shard, now):
+    return {partition for partition in shard._partitions if shard.holds_leases(now)}
+
+
+def test_partition_of():
+    partitions = [sharding.partition_of(user_id, 4) for user_id in range(1000)]
+
+    assert all(0 <= partition < 4 for partition in partitions)
+    assert all(partitions.count(partition) > 200 for partition in range(4))
+    assert sharding.partition_of(12345, 4) == sharding.partition_of(12345, 4)
+
+
+def test_instances_split_partitions(datastore):
+    first = sharding.ShardCoordinator(instance_id='first', partition_count=4)
+    second = sharding.ShardCoordinator(instance_id='second', partition_count=4)
+
+    async def test():
+        async with datastore.writer() as conn:
+            await first.heartbeat(conn, NOW)
+            assert _partitions(first, NOW) == {0, 1, 2, 3}
+            assert first.is_leader(NOW)
+            assert await first.apply_changes(conn)
+
+            # Nothing's free until the first instance makes room.
+            await second.heartbeat(conn, NOW + 1)
+            assert _partitions(second, NOW + 1) == set()
+            assert not second.is_leader(NOW + 1)
+
+            await first.heartbeat(conn, NOW + 2)
+            # Draining partitions aren't polled, but aren't free until they're released.
+            assert len(_partitions(first, NOW + 2)) == 2
+            await second.heartbeat(conn, NOW + 3)
+            assert _partitions(second, NOW + 3) == set()
+
+            assert await first.apply_changes(conn)
+            await second.heartbeat(conn, NOW + 4)
+
+    _run(datastore, test)
+
+    assert _partitions(first, NOW + 4) | _partitions(second, NOW + 4) == {0, 1, 2, 3}
+    assert not _partitions(first, NOW + 4) & _partitions(second, NOW + 4)
+    assert first.is_leader(NOW + 4)
+
+
+def test_leases_are_taken_over_when_they_expire(datastore):
+    first = sharding.ShardCoordinator(instance_id='first', partition_count=4)
+    second = sharding.ShardCoordinator(instance_id='second', partition_count=4)
+
+    async def test():
+        async with datastore.writer() as conn:
+            await first.heartbeat(conn, NOW)
+            await second.heartbeat(conn, NOW + 1)
+
+            # The first instance stops heartbeating, and stops polling before its leases expire.
+            stopped_at = NOW + sharding.LEASE_TTL_SEC - sharding.HEARTBEAT_PERIOD_SEC
+            assert not first.holds_leases(stopped_at)
+            assert not first.owns(1, stopped_at)
+
+            await second.heartbeat(conn, NOW + sharding.LEASE_TTL_SEC - 1)
+            assert _partitions(second, NOW + sharding.LEASE_TTL_SEC - 1) == set()
+
+            # Its leases are up for grabs as soon as they expire, though it's still counted as alive until then.
+            await second.heartbeat(conn, NOW + sharding.LEASE_TTL_SEC)
+            assert len(_partitions(second, NOW + sharding.LEASE_TTL_SEC)) == 2
+
+            takeover_at = NOW + sharding.LEASE_TTL_SEC + 1
+            await second.heartbeat(conn, takeover_at)
+            return takeover_at
+
+    takeover_at = _run(datastore, test)
+
+    assert _partitions(second, takeover_at) == {0, 1, 2, 3}
+    assert second.is_leader(takeover_at)
+    assert second.owns(1, takeover_at)
+
+
+def test_release_all(datastore):
+    first = sharding.ShardCoordinator(instance_id='first', partition_count=4)
+    second = sharding.ShardCoordinator(instance_id='second', partition_count=4)
+
+    async def test():
+        async with datastore.writer() as conn:
+            await first.heartbeat(conn, NOW)
+            await first.release_all(conn)
+            # Released leases are free right away, rather than once they expire.
+            await second.heartbeat(conn, NOW + 1)
+
+    _run(datastore, test)
+
+    assert not first.holds_leases(NOW + 1)
+    # The first instance still counts as alive, so the second only takes its share.
+    assert len(_partitions(second, NOW + 1)) == 2
+    assert second.is_leader(NOW + 1)
@@ -0,0 +1,163 @@
+import asyncio
+import time
+
+import pytest
+
+from tothc import streaming
+from tothc.clients import twitter
+
+
+class FakeStreamClient:
+    """Stands in for the Twitter client, with a stream that yields whatever events the test puts in the queue of
+    its current connection. None ends the connection.
+    """
+    def __init__(self):
+        self.connections = []
+
+    @property
+    def events(self):
+        return self.connections[-1][1]
+
+    async def iter_filtered_stream(self, user_ids):
+        events = asyncio.Queue()
+        self.connections.append((user_ids, events))
+        while True:
+            event = await events.get()
+            if event is None:
+                return
+            yield event
+
+
+def _tweet(id, user_id):
+    return twitter.Tweet.from_data({'id': id, 'full_text': 'Hi', 'user': {'id': user_id, 'screen_name': f'user{user_id}'}})
+
+
+@pytest.fixture(autouse=True)
+def fast_reconnects(monkeypatch):
+    monkeypatch.setattr(streaming, 'RECONNECT_INTERVAL_SEC', 0.01)
+
+
+async def _wait_for(condition, timeout_sec=5.0):
+    deadline = time.monotonic() + timeout_sec
+    while not condition():
+        assert time.monotonic() < deadline, 'Timed out'
+        await asyncio.sleep(0.01)
+
+
+def _run_ingester(test, handler=None):
+    """Runs ``test(ingester, client, batches)`` while the ingester runs, where ``batches`` are the tweets it handled.
+    """
+    async def run():
+        client = FakeStreamClient()
+        batches = []
+
+        async def record(tweets):
+            batches.append([tweet.id for tweet in tweets])
+            if handler is not None:
+                await handler(tweets)
+
+        ingester = streaming.StreamIngester(client, record)
+        task = asyncio.ensure_future(ingester.run())
+        try:
+            return await test(ingester, client, batches)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    return asyncio.run(run())
+
+
+async def _connect(ingester, client, user_ids):
+    ingester.follow(user_ids)
+    await _wait_for(lambda: client.connections and client.connections[-1][0] == frozenset(user_ids))
+    client.events.put_nowait(twitter.StreamEvent(connected=True))
+    await _wait_for(lambda: ingester._connected)
+
+
+def test_hands_followed_users_tweets_to_handler():
+    async def test(ingester, client, batches):
+        await _connect(ingester, client, [1, 2])
+        for tweet in (_tweet(10, 1), _tweet(11, 3), _tweet(12, 2)):
+            client.events.put_nowait(twitter.StreamEvent(tweet=tweet))
+
+        await _wait_for(lambda: sum(len(batch) for batch in batches) == 2)
+        return batches
+
+    # Someone else's retweet of a followed user is left to polling.
+    assert [tweet_id for batch in _run_ingester(test) for tweet_id in batch] == [10, 12]
+
+
+def test_covers_users_polled_while_connected():
+    async def test(ingester, client, batches):
+        generation_before_connecting = ingester.generation
+        await _connect(ingester, client, [1, 2])
+
+        # A poll that started before the stream connected might have missed tweets in between.
+        ingester.mark_polled(1, generation_before_connecting)
+        assert not ingester.covers(1)
+
+        ingester.mark_polled(1, ingester.generation)
+        ingester.mark_polled(3, ingester.generation)
+        assert ingester.covered_user_ids == {1}
+
+        client.events.put_nowait(twitter.StreamEvent(connected=False))
+        await _wait_for(lambda: not ingester._connected)
+        return ingester.covered_user_ids
+
+    assert _run_ingester(test) == set()
+
+
+def test_reconnects_when_follows_change():
+    async def test(ingester, client, batches):
+        await _connect(ingester, client, [1])
+        ingester.mark_polled(1, ingester.generation)
+
+        await _connect(ingester, client, [1, 2])
+        # The new connection starts out covering nobody, since it missed whatever came in while reconnecting.
+        assert ingester.covered_user_ids == set()
+
+        ingester.follow([2, 1])
+        await asyncio.sleep(0.05)
+        return [user_ids for user_ids, _ in client.connections]
+
+    assert _run_ingester(test) == [frozenset([1]), frozenset([1, 2])]
+
+
+def test_reconnects_when_stream_ends():
+    async def test(ingester, client, batches):
+        await _connect(ingester, client, [1])
+        client.events.put_nowait(None)
+
+        await _wait_for(lambda: len(client.connections) == 2)
+        return ingester._connected
+
+    assert not _run_ingester(test)
+
+
+def test_follows_at_most_the_limit(monkeypatch):
+    monkeypatch.setattr(twitter, 'STREAM_FOLLOW_LIMIT', 2)
+
+    async def test(ingester, client, batches):
+        await _connect(ingester, client, [1, 2])
+        ingester.follow([3, 2, 1])
+        await asyncio.sleep(0.05)
+        return len(client.connections)
+
+    # The first users still fit, so there was no need to reconnect.
+    assert _run_ingester(test) == 1
+
+
+def test_failed_handler_uncovers_users():
+    async def fail(tweets):
+        raise RuntimeError('Failed')
+
+    async def test(ingester, client, batches):
+        await _connect(ingester, client, [1, 2])
+        ingester.mark_polled(1, ingester.generation)
+        ingester.mark_polled(2, ingester.generation)
+
+        client.events.put_nowait(twitter.StreamEvent(tweet=_tweet(10, 1)))
+        await _wait_for(lambda: batches)
+        return ingester.covered_user_ids
+
+    assert _run_ingester(test, handler=fail) == {2}
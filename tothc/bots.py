@@ -1,236 +1,1126 @@
 import asyncio
+import collections
+import datetime
 import logging
-import re
 import signal
-from pathlib import Path
+import time
 from typing import Any
+from typing import Counter
 from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Union
 
 import databases
-import sqlalchemy
 
+from tothc import caches
+from tothc import commands
+from tothc import datastores
+from tothc import filters
 from tothc import managers
-from tothc import models
+from tothc import metrics
+from tothc import pipeline
+from tothc import quarantine
+from tothc import routing
+from tothc import scheduler
+from tothc import sharding
+from tothc import streaming
 from tothc.clients import slack
 from tothc.clients import twitter
 
 
 log = logging.getLogger(__name__)
 
-SUBSCRIBE_PATTERNS = [
-    re.compile(r'subscribe (?P<username>[a-zA-Z0-9_]{1,15})\b'),
-    re.compile(r'subscribe .*twitter\.com/(?P<username>[a-zA-Z0-9_]{1,15})\b'),
-]
-UNSUBSCRIBE_PATTERNS = [
-    re.compile(r'unsubscribe (?P<username>[a-zA-Z0-9_]{1,15})\b'),
-    re.compile(r'unsubscribe .*twitter\.com/(?P<username>[a-zA-Z0-9_]{1,15})\b'),
-]
-
-# The timeline endpoint has a rate limit of 900 requests per 15 minute window.
-# This determines how long the bot waits between its batches of polling.
-TWITTER_TIMELINE_POLL_PERIOD_SEC = 100
-
-
-class Datastore:
-    _sqlite_db_path: Path
-    _database_url: str
-    db: databases.Database
-
-    def __init__(
-        self,
-        sqlite_db_path: Path,
-    ) -> None:
-        self._sqlite_db_path = sqlite_db_path
-        self._database_url = f'sqlite:///{sqlite_db_path}'
-        self.db = databases.Database(self._database_url)
-
-    def ensure_initialized(self) -> None:
-        if self._sqlite_db_path.exists():
-            log.info("Assuming that DB doesn't need to be initialized because file exists: %s", self._sqlite_db_path)
-            return
+# How often the poll scheduler re-reads the set of active subscriptions from the DB.
+SUBSCRIPTION_SYNC_PERIOD_SEC = 60
+
+# Fetching is the only stage that waits on the network, so it gets its own knobs.
+DEFAULT_POLL_CONCURRENCY = 20
+DEFAULT_POLL_TIMEOUT_SEC = 30.0
+# The deliver stage commits to the DB, so it works in batches to keep transactions per cycle low.
+DELIVER_BATCH_SIZE = 500
+PIPELINE_STAGE_NAMES = ('fetch', 'parse', 'filter', 'format', 'deliver')
+
+# Catching up on the tweets that polls skipped over only uses the rate limit allowance that polls leave over, a
+# few pages per user at a time, so a big backlog is spread over many cycles.
+CATCH_UP_PAGES_PER_FETCH = 3
+CATCH_UP_MAX_FETCHES_PER_CYCLE = 20
+# While there's catching up to do, the poller checks for spare allowance at least this often.
+CATCH_UP_TICK_SEC = 5
+
+# The outbox is drained in batches. When it's empty, the delivery stage waits for the poller to wake it up,
+# but checks back at least this often.
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_POLL_PERIOD_SEC = 10
+# Each attempt is a full round of DeliveryQueue retries, so a message that fails this many is probably doomed.
+OUTBOX_MAX_ATTEMPTS = 3
+# Sent messages, and the ones that ran out of attempts, are deleted after this long.
+OUTBOX_RETENTION = datetime.timedelta(days=1)
+
+# Content that several subscriptions retweet is only posted once per channel within this window. Recently
+# delivered content is also kept in memory, so that the DB only gets asked about content we haven't seen lately.
+DEDUP_RETENTION = datetime.timedelta(days=7)
+DEDUP_CACHE_SIZE = 10000
+
+# Digest mode holds back each channel's messages about a user, and sends them together. A digest is either one
+# message with all of them, or a thread, with a message saying how many tweets there are and a reply for each.
+# Only the first saves on Slack calls, since a thread costs one more call than sending the tweets on their own.
+DIGEST_THREAD = 'thread'
+DIGEST_MESSAGE = 'message'
+DIGEST_STYLES = (DIGEST_MESSAGE, DIGEST_THREAD)
+DEFAULT_DIGEST_WINDOW_SEC = 5 * 60
+DEFAULT_DIGEST_MAX_TWEETS = 10
+
+
+class FetchedTimeline(NamedTuple):
+    user_id: int
+    since_id: Optional[int]
+    timeline: twitter.Timeline
+    reached_since_id: bool = True
+    # Set when this fetch was catching up on a backfill, rather than polling for new tweets.
+    backfill: Optional[managers.Backfill] = None
+    # Set when the tweets came in through the stream, rather than from polling.
+    streamed: bool = False
+
+
+class UserTweets(NamedTuple):
+    user_id: int
+    # Catching up on a backfill doesn't move the cursor.
+    cursor: Optional[managers.SubscriptionCursor]
+    tweets: List[twitter.Tweet]
+    # What's left of the user's backfill, if this fetch changed it.
+    backfill: Optional[managers.Backfill] = None
+    # Which channels' filter rules kept each tweet, keyed by tweet ID. Until the filter stage, that's unknown.
+    channels_by_tweet_id: Optional[Dict[int, Tuple[str, ...]]] = None
+
+
+class FormattedTweet(NamedTuple):
+    message: slack.OutgoingMessage
+    # The subscribed user whose timeline it came from.
+    user_id: int
+    # The ID of the tweet itself, or of the tweet it's a retweet of.
+    content_tweet_id: int
+    screen_name: str
+    is_retweet: bool
+    url: str
+
+
+class PollResult(NamedTuple):
+    cursor: Optional[managers.SubscriptionCursor]
+    tweets: List[FormattedTweet]
+    backfill: Optional[managers.Backfill] = None
+
+
+class DigestSettings(NamedTuple):
+    # A user's messages go out once the oldest of them has waited this long, or once there are max_tweets of them,
+    # whichever comes first.
+    window_sec: float = DEFAULT_DIGEST_WINDOW_SEC
+    max_tweets: int = DEFAULT_DIGEST_MAX_TWEETS
+    style: str = DIGEST_MESSAGE
+
+
+def _user_link(screen_name: str) -> str:
+    return f'<https://www.twitter.com/{screen_name}|{screen_name}>'
+
+
+def _group_by_channel(keys: List[Tuple[str, int]]) -> Dict[str, List[int]]:
+    content_tweet_ids_by_channel: Dict[str, List[int]] = {}
+    for channel, content_tweet_id in keys:
+        content_tweet_ids_by_channel.setdefault(channel, []).append(content_tweet_id)
+    return content_tweet_ids_by_channel
+
+
+def format_shared_content(tweets: List[FormattedTweet]) -> str:
+    """Folds several subscriptions' tweets of the same content into one message.
+    """
+    url = tweets[0].url
+    retweeters = ', '.join(_user_link(tweet.screen_name) for tweet in tweets if tweet.is_retweet)
+    authors = [tweet.screen_name for tweet in tweets if not tweet.is_retweet]
+    if authors:
+        return f'{_user_link(authors[0])} tweeted <{url}>, retweeted by {retweeters}'
+    return f'<{url}> retweeted by {retweeters}'
+
+
+def format_digest(screen_name: str, texts: List[str], style: str) -> str:
+    """The message that a digest starts with, which for a thread is all there is outside of the replies.
+    """
+    if style == DIGEST_THREAD:
+        return f'{len(texts)} new tweets from {_user_link(screen_name)}'
+    return '\n'.join([f'{len(texts)} new tweets from {_user_link(screen_name)}:', *texts])
+
+
+def _group_digests(pending: List[managers.PendingMessage], max_size: int) -> List[List[managers.PendingMessage]]:
+    """Groups the messages by channel and user, oldest first, in digests of up to ``max_size`` messages.
+    """
+    messages_by_key: Dict[Tuple[str, Optional[int]], List[managers.PendingMessage]] = {}
+    for pending_message in pending:
+        messages_by_key.setdefault((pending_message.message.channel, pending_message.digest_user_id), []).append(
+            pending_message,
+        )
 
-        log.info('Creating fresh DB: %s', self._sqlite_db_path)
-        engine = sqlalchemy.create_engine(self._database_url)
-        models.metadata.create_all(engine)
+    return [
+        messages[start:start + max_size]
+        for messages in messages_by_key.values()
+        for start in range(0, len(messages), max_size)
+    ]
 
 
 class TOTHCBot:
     _twitter_client: twitter.Client
     _slack_client: slack.Client
+    _slack_delivery_queue: slack.DeliveryQueue
+    _command_dispatcher: commands.CommandDispatcher
+    # Subscriptions from before they were made per channel get posted here.
     _slack_channel: str
-    _datastore: Datastore
+    _datastore: datastores.Datastore
+    # Only set when several instances share the DB, each polling a partition of the subscriptions.
+    _shard: Optional[sharding.ShardCoordinator]
+    _scheduler: scheduler.PollScheduler
+    _catch_up_scheduler: scheduler.CatchUpScheduler
+    _router: routing.ChannelRouter
+    _pipeline: pipeline.Pipeline
+    # Only set when streaming. Streamed tweets skip the fetch stage, but go through the same stages after it.
+    _stream: Optional[streaming.StreamIngester]
+    _stream_pipeline: pipeline.Pipeline
+    # The poller's copy of every active subscription's cursor, which saves reading it back before each poll.
+    _latest_tweet_ids: Dict[int, Optional[int]]
+    # The screen names in the DB, and the new screen names that polls found since the last deliver batch, which
+    # get written along with it.
+    _screen_names: Dict[int, Optional[str]]
+    _renamed_users: Dict[int, str]
+    # The users whose poll results made it to the outbox during the current cycle.
+    _polled_user_ids: Set[int]
+    # What the current polling cycle did, for the line that sums it up.
+    _cycle_counts: Counter[str]
+    _quarantine: quarantine.QuarantineTracker
+    # Keys are (channel, content tweet ID).
+    _delivered_content: caches.TTLCache[Tuple[str, int], bool]
+    # Set whenever the poller adds messages to the outbox.
+    _outbox_event: asyncio.Event
+    # Only set in digest mode.
+    _digest: Optional[DigestSettings]
     _loop: asyncio.AbstractEventLoop
     _stopped: bool
 
     def __init__(
         self,
-        twitter_tokens: twitter.OAuth10aTokens,
+        # Each set of tokens brings its own rate limit, so more of them means users can be polled more often.
+        twitter_tokens: List[twitter.OAuth10aTokens],
         slack_token: str,
         slack_channel: str,
-        sqlite_db_path: Path,
+        database_url: str,
         loop: asyncio.AbstractEventLoop,
+        database_pool_size: int = datastores.DEFAULT_POOL_SIZE,
+        poll_concurrency: int = DEFAULT_POLL_CONCURRENCY,
+        poll_timeout_sec: float = DEFAULT_POLL_TIMEOUT_SEC,
+        stage_concurrency: Optional[Dict[str, int]] = None,
+        pipeline_queue_size: int = pipeline.DEFAULT_QUEUE_SIZE,
+        twitter_base_url: Optional[str] = None,
+        slack_base_url: Optional[str] = None,
+        shard: Optional[sharding.ShardCoordinator] = None,
+        command_workers: int = commands.DEFAULT_WORKER_COUNT,
+        streaming_enabled: bool = False,
+        digest: Optional[DigestSettings] = None,
     ) -> None:
-        self._twitter_client = twitter.Client(auth=twitter_tokens)
-        self._slack_client = slack.Client(token=slack_token)
+        self._twitter_client = twitter.Client(auths=twitter_tokens, base_url=twitter_base_url)
+        self._slack_client = slack.Client(token=slack_token, base_url=slack_base_url)
+        self._slack_delivery_queue = slack.DeliveryQueue(self._slack_client)
+        self._command_dispatcher = commands.CommandDispatcher(self._handle_command, worker_count=command_workers)
         self._slack_channel = slack_channel
 
-        self._datastore = Datastore(sqlite_db_path)
+        self._datastore = datastores.Datastore(database_url, pool_size=database_pool_size)
+        self._shard = shard
+        self._scheduler = scheduler.PollScheduler(credential_count=len(twitter_tokens))
+        self._catch_up_scheduler = scheduler.CatchUpScheduler()
+        self._router = routing.ChannelRouter()
+        stage_concurrency = {'fetch': poll_concurrency, **(stage_concurrency or {})}
+        handling_stages = [
+            pipeline.Stage('parse', self._parse_timeline, concurrency=stage_concurrency.get('parse', 1)),
+            pipeline.Stage('filter', self._filter_tweets, concurrency=stage_concurrency.get('filter', 1)),
+            pipeline.Stage('format', self._format_tweets, concurrency=stage_concurrency.get('format', 1)),
+        ]
+        self._pipeline = pipeline.Pipeline(
+            [
+                pipeline.Stage(
+                    'fetch',
+                    self._fetch_timeline,
+                    concurrency=stage_concurrency['fetch'],
+                    timeout_sec=poll_timeout_sec,
+                ),
+                *handling_stages,
+                pipeline.Stage(
+                    'deliver',
+                    self._deliver_poll_results,
+                    concurrency=stage_concurrency.get('deliver', 1),
+                    batch_size=DELIVER_BATCH_SIZE,
+                ),
+            ],
+            queue_size=pipeline_queue_size,
+        )
+        self._stream = None
+        if streaming_enabled:
+            self._stream = streaming.StreamIngester(self._twitter_client, self._handle_streamed_tweets)
+        self._stream_pipeline = pipeline.Pipeline(
+            [
+                *handling_stages,
+                pipeline.Stage(
+                    'deliver',
+                    self._deliver_streamed_results,
+                    concurrency=stage_concurrency.get('deliver', 1),
+                    batch_size=DELIVER_BATCH_SIZE,
+                ),
+            ],
+            queue_size=pipeline_queue_size,
+        )
+        self._latest_tweet_ids = {}
+        self._screen_names = {}
+        self._renamed_users = {}
+        self._polled_user_ids = set()
+        self._cycle_counts = collections.Counter()
+        self._quarantine = quarantine.QuarantineTracker()
+        self._delivered_content = caches.TTLCache(
+            maxsize=DEDUP_CACHE_SIZE,
+            ttl_sec=DEDUP_RETENTION.total_seconds(),
+        )
+        self._outbox_event = asyncio.Event()
+        self._digest = digest
         self._loop = loop
         self._stopped = False
 
-    def initialize(self) -> None:
-        self._datastore.ensure_initialized()
+    async def initialize(self) -> None:
+        await self._datastore.connect()
+        await self._datastore.ensure_initialized()
+        async with self._datastore.writer() as conn:
+            await managers.ChannelSubscriptionManager.assign_unrouted_subscriptions(conn, channel=self._slack_channel)
+
+    async def subscribe_to_twitter_users(self, screen_names: List[str], channel: str) -> List[twitter.User]:
+        """Subscribes the channel to whichever of the screen names belong to a Twitter user, and returns those users.
+        """
+        users = await self._twitter_client.get_users_by_screen_names(screen_names)
+        if not users:
+            return []
+
+        user_ids = [user.id for user in users]
+        async with self._datastore.writer() as conn:
+            async with conn.transaction():
+                await managers.TwitterSubscriptionManager.subscribe_many(
+                    conn,
+                    users=users,
+                )
+                await managers.ChannelSubscriptionManager.subscribe(
+                    conn,
+                    channel=channel,
+                    user_ids=user_ids,
+                )
+                # Re-enabled subscriptions start over from scratch.
+                latest_tweet_ids = await managers.TwitterSubscriptionManager.get_latest_tweet_ids_for_user_ids(
+                    conn,
+                    user_ids=user_ids,
+                )
+
+        self._latest_tweet_ids.update(latest_tweet_ids)
+        self._screen_names.update((user.id, user.screen_name) for user in users)
+
+        now = time.time()
+        for user_id in user_ids:
+            self._router.add(user_id, channel)
+            # Otherwise, whichever instance owns the user picks up the subscription the next time it syncs.
+            if self._owns(user_id, now):
+                self._scheduler.add(user_id, now)
+        metrics.ACTIVE_SUBSCRIPTIONS.set(len(self._scheduler))
+        if self._stream is not None:
+            self._stream.follow(self._scheduler.user_ids)
+
+        return users
+
+    async def unsubscribe_from_twitter_users(self, screen_names: List[str], channel: str) -> None:
+        async with self._datastore.writer() as conn:
+            async with conn.transaction():
+                user_ids = await managers.TwitterSubscriptionManager.list_user_ids_by_screen_names(
+                    conn,
+                    screen_names=screen_names,
+                )
+                await managers.ChannelSubscriptionManager.unsubscribe(
+                    conn,
+                    channel=channel,
+                    user_ids=user_ids,
+                )
+                # Users stay subscribed for as long as any channel wants their tweets.
+                still_subscribed_user_ids = await managers.ChannelSubscriptionManager.filter_subscribed(
+                    conn,
+                    user_ids=user_ids,
+                )
+                unsubscribed_user_ids = [user_id for user_id in user_ids if user_id not in still_subscribed_user_ids]
+                await managers.TwitterSubscriptionManager.unsubscribe(
+                    conn,
+                    user_ids=unsubscribed_user_ids,
+                )
+
+        for user_id in user_ids:
+            self._router.remove(user_id, channel)
+
+        # Rather than keep polling and streaming them until the next sync.
+        for user_id in unsubscribed_user_ids:
+            self._scheduler.remove(user_id)
+            self._catch_up_scheduler.remove(user_id)
+        metrics.ACTIVE_SUBSCRIPTIONS.set(len(self._scheduler))
+        if self._stream is not None:
+            self._stream.uncover(unsubscribed_user_ids)
+            self._stream.follow(self._scheduler.user_ids)
+
+    async def set_filter_rule(self, screen_names: List[str], channel: str, filter_rule: Optional[str]) -> List[int]:
+        """Sets the channel's filter rule for whichever of the users it's subscribed to, and returns their IDs.
+        """
+        async with self._datastore.writer() as conn:
+            async with conn.transaction():
+                user_ids = await managers.TwitterSubscriptionManager.list_user_ids_by_screen_names(
+                    conn,
+                    screen_names=screen_names,
+                )
+                subscribed_user_ids = await managers.ChannelSubscriptionManager.set_filter_rule(
+                    conn,
+                    channel=channel,
+                    user_ids=user_ids,
+                    filter_rule=filter_rule,
+                )
+
+        for user_id in subscribed_user_ids:
+            self._router.set_filter_rule(user_id, channel, filter_rule)
+        return sorted(subscribed_user_ids)
+
+    async def _fetch_timeline(self, task: Union[int, managers.Backfill]) -> Optional[FetchedTimeline]:
+        """Polls a user for new tweets, or catches up on a backfill. Failures that we expect, like the account being
+        suspended or every credential being rate limited, drop the poll without a traceback.
+        """
+        if isinstance(task, managers.Backfill):
+            return await self._fetch_backfill(task)
+
+        user_id = task
+        since_id = self._latest_tweet_ids.get(user_id)
+        stream_generation = self._stream.generation if self._stream is not None else 0
 
-    async def subscribe_to_twitter_user(self, screen_name: str) -> int:
         try:
-            twitter_user = await self._twitter_client.get_user_by_screen_name(screen_name)
-        except twitter.UserNotFound:
-            log.exception('Could not find user with screen name %s', screen_name)
-            raise
+            pages = [page async for page in self._twitter_client.iter_user_timeline(user_id, since_id=since_id)]
+        except (twitter.AccountUnavailable, twitter.RateLimited) as e:
+            self._record_fetch_failure(user_id, e)
+            return None
+        finally:
+            self._record_rate_limits()
+        self._quarantine.record_success(user_id)
+        # There's more than one page when the first one had to be checked for a deleted cursor tweet.
+        timeline = pages[0].timeline._replace(tweets=[tweet for page in pages for tweet in page.timeline.tweets])
+        log.debug('Fetched %s tweets in timeline of user %s since ID %s', len(timeline.tweets), user_id, since_id)
+        self._cycle_counts['fetched_tweets'] += len(timeline.tweets)
+        if self._stream is not None:
+            self._stream.mark_polled(user_id, stream_generation)
+
+        return FetchedTimeline(
+            user_id=user_id,
+            since_id=since_id,
+            timeline=timeline,
+            reached_since_id=pages[-1].reached_since_id,
+        )
 
-        user_id = twitter_user['id']
-        screen_name = twitter_user['screen_name']
+    async def _fetch_backfill(self, backfill: managers.Backfill) -> Optional[FetchedTimeline]:
+        tweets: List[twitter.Tweet] = []
+        reached_since_id = False
+        try:
+            async for page in self._twitter_client.iter_user_timeline(
+                backfill.user_id,
+                since_id=backfill.since_id,
+                max_id=backfill.max_id,
+                max_pages=CATCH_UP_PAGES_PER_FETCH,
+            ):
+                tweets.extend(page.timeline.tweets)
+                reached_since_id = page.reached_since_id
+        except (twitter.AccountUnavailable, twitter.RateLimited) as e:
+            self._record_fetch_failure(backfill.user_id, e)
+            return None
+        finally:
+            self._record_rate_limits()
+        self._quarantine.record_success(backfill.user_id)
+
+        log.debug(
+            'Fetched %s tweets in timeline of user %s between IDs %s and %s',
+            len(tweets),
+            backfill.user_id,
+            backfill.since_id,
+            backfill.max_id,
+        )
+        self._cycle_counts['fetched_tweets'] += len(tweets)
+
+        return FetchedTimeline(
+            user_id=backfill.user_id,
+            since_id=backfill.since_id,
+            timeline=twitter.Timeline(tweets=tweets),
+            reached_since_id=reached_since_id,
+            backfill=backfill,
+        )
 
-        async with self._connection() as conn:
-            await managers.TwitterSubscriptionManager.subscribe(
-                conn,
-                user_id=user_id,
-                screen_name=screen_name,
-            )
+    def _record_fetch_failure(self, user_id: int, exception: Exception) -> None:
+        self._cycle_counts['failed_fetches'] += 1
+        # Only the account's own failures count towards quarantining it. Running out of rate limit fails every
+        # fetch at once, which the cycle's summary counts instead.
+        if isinstance(exception, twitter.AccountUnavailable):
+            log.warning('Failed to fetch the timeline of user %s: %s', user_id, exception)
+            self._quarantine.record_failure(user_id, exception.reason, time.time())
+        else:
+            log.debug('Failed to fetch the timeline of user %s: %s', user_id, exception)
+
+    async def _save_account_failures(self) -> None:
+        """Writes the failures and recoveries since the last call, and lets the channels of newly quarantined users
+        know, once per quarantine.
+        """
+        failures = self._quarantine.take_changes()
+        if not failures:
+            return
 
-        return user_id
+        messages: List[slack.OutgoingMessage] = []
+        notified_user_ids = []
+        for failure in failures:
+            if failure.quarantined_until is None or failure.notified:
+                continue
 
-    async def unsubscribe_from_twitter_user(self, screen_name: str) -> None:
-        async with self._connection() as conn:
-            await managers.TwitterSubscriptionManager.unsubscribe(
-                conn,
-                screen_name=screen_name,
+            screen_name = self._screen_names.get(failure.user_id) or str(failure.user_id)
+            messages.extend(
+                slack.OutgoingMessage(
+                    channel=channel,
+                    text=(
+                        f"Pausing {_user_link(screen_name)}, since Twitter says the account is {failure.reason}. "
+                        "I'll check back every now and then."
+                    ),
+                )
+                for channel in self._router.channels_of(failure.user_id)
             )
+            notified_user_ids.append(failure.user_id)
 
-    async def _handle_polling_twitter_user_id(self, user_id: int) -> None:
-        async with self._connection() as conn:
-            since_id = await managers.TwitterSubscriptionManager.get_latest_tweet_id_for_user_id(
-                conn,
-                user_id=user_id,
-            )
+        notified = set(notified_user_ids)
+        async with self._datastore.writer() as conn:
+            async with conn.transaction():
+                await managers.TwitterSubscriptionManager.update_account_failures(
+                    conn,
+                    failures=[
+                        failure._replace(notified=True) if failure.user_id in notified else failure
+                        for failure in failures
+                    ],
+                )
+                await managers.OutboxManager.add_messages(
+                    conn,
+                    messages=messages,
+                )
 
-        timeline = await self._twitter_client.get_user_timeline_by_user_id(user_id, since_id=since_id)
-        log.info('Fetched %s tweets in timeline of user %s since ID %s', len(timeline.tweets), user_id, since_id)
+        self._quarantine.mark_notified(notified_user_ids)
+        if messages:
+            self._outbox_event.set()
+
+    def _record_rate_limits(self) -> None:
+        # Including those of credentials that were parked along the way, which don't show up in any timeline.
+        for rate_limit in self._twitter_client.rate_limits:
+            self._scheduler.update_rate_limit(rate_limit)
+            metrics.TWITTER_RATE_LIMIT_REMAINING.set(rate_limit.remaining, credential=str(rate_limit.credential))
+
+    async def _parse_timeline(self, fetched: FetchedTimeline) -> UserTweets:
+        tweets = fetched.timeline.tweets
+
+        if fetched.streamed:
+            metrics.TWEETS_STREAMED.inc(len(tweets))
+            self._notice_screen_name(fetched.user_id, tweets[0].screen_name)
+
+            # Until a poll has covered the time before the stream connected, moving the cursor past whatever the
+            # stream missed would lose it for good.
+            cursor = None
+            if self._stream is not None and self._stream.covers(fetched.user_id):
+                cursor = managers.SubscriptionCursor(
+                    user_id=fetched.user_id,
+                    latest_tweet_id=max(tweets[0].id, fetched.since_id or 0),
+                    tweets_per_day=self._scheduler.tweets_per_day(fetched.user_id),
+                )
+
+            return UserTweets(user_id=fetched.user_id, cursor=cursor, tweets=tweets)
 
-        if since_id:
-            new_tweets = timeline.tweets
+        if fetched.backfill is not None:
+            metrics.TWEETS_FETCHED.inc(len(tweets))
+            self._cycle_counts['new_tweets'] += len(tweets)
+
+            # Pages go backwards, so whatever's left is older than what we got.
+            max_id = fetched.backfill.since_id if fetched.reached_since_id else tweets[-1].id - 1
+            return UserTweets(
+                user_id=fetched.user_id,
+                cursor=None,
+                tweets=tweets,
+                backfill=fetched.backfill._replace(max_id=max_id),
+            )
+
+        if fetched.since_id:
+            new_tweets = tweets
+            tweets_per_day = self._scheduler.record_poll(fetched.user_id, len(new_tweets), time.time())
         else:
             # This is our first fetch for the user, so don't consider anything new
             new_tweets = []
+            tweets_per_day = self._scheduler.record_poll(fetched.user_id, 0, time.time())
+
+        metrics.TWEETS_FETCHED.inc(len(new_tweets))
+        self._cycle_counts['new_tweets'] += len(new_tweets)
+
+        backfill = None
+        if new_tweets and fetched.since_id and not fetched.reached_since_id:
+            log.debug('User %s has more new tweets than fit on a page, catching up on the rest later', fetched.user_id)
+            backfill = managers.Backfill(user_id=fetched.user_id, since_id=fetched.since_id, max_id=tweets[-1].id - 1)
+
+            # Catching up on a range again is harmless, since content that's already been delivered gets dropped.
+            previous_backfill = self._catch_up_scheduler.get(fetched.user_id)
+            if previous_backfill is not None:
+                backfill = backfill._replace(
+                    since_id=min(backfill.since_id, previous_backfill.since_id),
+                    max_id=max(backfill.max_id, previous_backfill.max_id),
+                )
 
-        latest_tweet_id = since_id
-        if timeline.tweets:
-            latest_tweet_id = timeline.tweets[0].data['id']
+        latest_tweet_id = fetched.since_id
+        if tweets:
+            latest_tweet_id = tweets[0].id
+            self._notice_screen_name(fetched.user_id, tweets[0].screen_name)
 
-        # Now we must update our subscription information
-        async with self._connection() as conn:
-            await managers.TwitterSubscriptionManager.update_latest_tweet_id(
-                conn,
-                user_id=user_id,
+        return UserTweets(
+            user_id=fetched.user_id,
+            cursor=managers.SubscriptionCursor(
+                user_id=fetched.user_id,
                 latest_tweet_id=latest_tweet_id,
-            )
-
-        # Now we deal with the new tweets
-        for tweet in new_tweets:
-            screen_name = tweet.data['user']['screen_name']
-            log.info('New tweet from user %s (has_media=%s): %s', screen_name, tweet.has_media(), tweet.url_of_content())
+                tweets_per_day=tweets_per_day,
+            ),
+            tweets=new_tweets,
+            backfill=backfill,
+        )
 
-            if not tweet.has_media():
-                continue
+    def _notice_screen_name(self, user_id: int, screen_name: str) -> None:
+        # Tweets tell us about renames for free, which keeps unsubscribing by screen name working.
+        if self._screen_names.get(user_id) != screen_name:
+            log.info('User %s is now called %s', user_id, screen_name)
+            self._renamed_users[user_id] = screen_name
+
+    async def _filter_tweets(self, user_tweets: UserTweets) -> UserTweets:
+        """Runs the filter rules of the channels subscribed to the user over all of the user's new tweets in one go,
+        and keeps the tweets that at least one channel wants.
+        """
+        routed = filters.route_tweets(user_tweets.tweets, self._router.filter_rules_of(user_tweets.user_id))
+        kept = [tweet for tweet, _ in routed]
+        log.debug('Kept %s of %s new tweets from user %s', len(kept), len(user_tweets.tweets), user_tweets.user_id)
+
+        metrics.TWEETS_FILTERED.inc(len(user_tweets.tweets) - len(kept))
+
+        # Users whose tweets all got filtered out still need their cursor to make it to the deliver stage.
+        return user_tweets._replace(
+            tweets=kept,
+            channels_by_tweet_id={tweet.id: channels for tweet, channels in routed},
+        )
 
-            if tweet.is_retweet() and tweet.data['retweeted_status']['user']['id'] == tweet.data['user']['id']:
-                log.info('Ignoring tweet %s because it was a self-retweet', tweet.data['id'])
-                continue
+    async def _format_tweets(self, user_tweets: UserTweets) -> PollResult:
+        """Fans each tweet out to every channel whose filter rule kept it.
+        """
+        channels_by_tweet_id = user_tweets.channels_by_tweet_id or {}
 
+        formatted: List[FormattedTweet] = []
+        for tweet in user_tweets.tweets:
+            channels = channels_by_tweet_id.get(tweet.id, ())
             url = tweet.url_of_content()
-            if tweet.is_retweet():
-                text = f'<https://www.twitter.com/{screen_name}|{screen_name}> retweeted <{url}>'
+            if tweet.retweeted_status_id is not None:
+                text = f'{_user_link(tweet.screen_name)} retweeted <{url}>'
+                content_tweet_id = tweet.retweeted_status_id
             else:
-                text = f'<https://www.twitter.com/{screen_name}|{screen_name}> tweeted <{url}>'
+                text = f'{_user_link(tweet.screen_name)} tweeted <{url}>'
+                content_tweet_id = tweet.id
+
+            formatted.extend(
+                FormattedTweet(
+                    message=slack.OutgoingMessage(
+                        channel=channel,
+                        text=text,
+                    ),
+                    user_id=user_tweets.user_id,
+                    content_tweet_id=content_tweet_id,
+                    screen_name=tweet.screen_name,
+                    is_retweet=tweet.is_retweet(),
+                    url=url,
+                )
+                for channel in channels
+            )
 
-            await self._slack_client.post_message(
-                channel=self._slack_channel,
-                text=text,
+        return PollResult(cursor=user_tweets.cursor, tweets=formatted, backfill=user_tweets.backfill)
+
+    async def _deliver_streamed_results(self, results: List[PollResult]) -> None:
+        await self._deliver_poll_results(results, polled=False)
+
+    async def _deliver_poll_results(self, results: List[PollResult], polled: bool = True) -> None:
+        """Hands a batch of poll results off to the outbox, which the delivery loop sends to Slack.
+        """
+        cursors = [result.cursor for result in results if result.cursor is not None]
+        backfills = [result.backfill for result in results if result.backfill is not None]
+        renamed_users, self._renamed_users = self._renamed_users, {}
+
+        # Group the batch's tweets by what they link to, keeping the order in which each piece of content first showed up.
+        tweets_by_content: Dict[Tuple[str, int], List[FormattedTweet]] = {}
+        for result in results:
+            for tweet in result.tweets:
+                key = (tweet.message.channel, tweet.content_tweet_id)
+                tweets_by_content.setdefault(key, []).append(tweet)
+
+        # Advancing the cursors and queueing up their tweets happen atomically, so a crash can't lose tweets.
+        async with self._datastore.writer() as conn:
+            async with conn.transaction():
+                delivered_keys = await self._find_delivered_content(conn, list(tweets_by_content))
+                new_keys = [key for key in tweets_by_content if key not in delivered_keys]
+
+                messages = []
+                # Content that several users shared is posted on its own, even in digest mode.
+                digest_user_ids: List[Optional[int]] = []
+                for key in new_keys:
+                    tweets = tweets_by_content[key]
+                    if len(tweets) == 1:
+                        messages.append(tweets[0].message)
+                        digest_user_ids.append(tweets[0].user_id if self._digest is not None else None)
+                    else:
+                        messages.append(tweets[0].message._replace(text=format_shared_content(tweets)))
+                        digest_user_ids.append(None)
+
+                await managers.TwitterSubscriptionManager.update_latest_tweet_ids(
+                    conn,
+                    cursors=cursors,
+                )
+                await managers.TwitterSubscriptionManager.update_backfills(
+                    conn,
+                    backfills=backfills,
+                )
+                await managers.TwitterSubscriptionManager.update_screen_names(
+                    conn,
+                    users=[twitter.User(id=user_id, screen_name=screen_name) for user_id, screen_name in renamed_users.items()],
+                )
+                await managers.OutboxManager.add_messages(
+                    conn,
+                    messages=messages,
+                    digest_user_ids=digest_user_ids,
+                )
+                for channel, content_tweet_ids in _group_by_channel(new_keys).items():
+                    await managers.DeliveredContentManager.record_delivered(
+                        conn,
+                        channel=channel,
+                        content_tweet_ids=content_tweet_ids,
+                    )
+
+        duplicate_count = sum(len(tweets) for tweets in tweets_by_content.values()) - len(messages)
+        if duplicate_count:
+            log.debug('Dropped or folded %s tweets of content that was already being delivered', duplicate_count)
+        if polled:
+            self._cycle_counts['queued_messages'] += len(messages)
+            self._cycle_counts['duplicate_tweets'] += duplicate_count
+
+        for key in new_keys:
+            self._delivered_content.set(key, True)
+
+        self._screen_names.update(renamed_users)
+        for backfill in backfills:
+            self._catch_up_scheduler.update(backfill)
+        for cursor in cursors:
+            self._latest_tweet_ids[cursor.user_id] = cursor.latest_tweet_id
+            if polled:
+                self._polled_user_ids.add(cursor.user_id)
+
+        if messages:
+            self._outbox_event.set()
+
+    async def _handle_streamed_tweets(self, tweets: List[twitter.Tweet]) -> None:
+        # Each user's tweets go through the pipeline newest first, the way timelines come.
+        tweets_by_user_id: Dict[int, List[twitter.Tweet]] = {}
+        for tweet in sorted(tweets, key=lambda tweet: tweet.id, reverse=True):
+            tweets_by_user_id.setdefault(tweet.user_id, []).append(tweet)
+
+        report = await self._stream_pipeline.run(
+            FetchedTimeline(
+                user_id=user_id,
+                since_id=self._latest_tweet_ids.get(user_id),
+                timeline=twitter.Timeline(tweets=user_tweets),
+                streamed=True,
+            )
+            for user_id, user_tweets in tweets_by_user_id.items()
+        )
+
+        if self._stream is not None and any(stage.failed or stage.timed_out for stage in report.stages):
+            # There's no telling whose tweets didn't make it, so polls have to make sure nobody's were lost.
+            self._stream.uncover(tweets_by_user_id)
+
+    async def _find_delivered_content(
+        self,
+        conn: databases.core.Connection,
+        keys: List[Tuple[str, int]],
+    ) -> Set[Tuple[str, int]]:
+        delivered = {key for key in keys if key in self._delivered_content}
+
+        unknown_keys = [key for key in keys if key not in delivered]
+        for channel, content_tweet_ids in _group_by_channel(unknown_keys).items():
+            delivered_content_tweet_ids = await managers.DeliveredContentManager.filter_delivered(
+                conn,
+                channel=channel,
+                content_tweet_ids=content_tweet_ids,
             )
+            for content_tweet_id in delivered_content_tweet_ids:
+                self._delivered_content.set((channel, content_tweet_id), True)
+                delivered.add((channel, content_tweet_id))
+
+        return delivered
 
     async def _twitter_loop(self) -> None:
+        synced_at = None
         while not self._stopped:
+            if self._shard is not None:
+                # This is the only place where we're sure not to be polling anyone, so it's safe to hand off partitions.
+                async with self._datastore.writer() as conn:
+                    if await self._shard.apply_changes(conn):
+                        synced_at = None
+
+            now = time.time()
+            if synced_at is None or now - synced_at >= SUBSCRIPTION_SYNC_PERIOD_SEC:
+                router_version = self._router.version
+                async with self._connection() as conn:
+                    subscriptions = await managers.TwitterSubscriptionManager.list_active_subscriptions(
+                        conn,
+                    )
+                    latest_tweet_ids = await managers.TwitterSubscriptionManager.get_latest_tweet_ids_of_active_subscriptions(
+                        conn,
+                    )
+                    screen_names = await managers.TwitterSubscriptionManager.get_screen_names_of_active_subscriptions(
+                        conn,
+                    )
+                    backfills = await managers.TwitterSubscriptionManager.list_backfills_of_active_subscriptions(
+                        conn,
+                    )
+                    channel_subscriptions = await managers.ChannelSubscriptionManager.list_channel_subscriptions(
+                        conn,
+                    )
+                    account_failures = await managers.TwitterSubscriptionManager.list_account_failures_of_active_subscriptions(
+                        conn,
+                    )
+
+                self._latest_tweet_ids = latest_tweet_ids
+                self._screen_names = screen_names
+                self._router.sync(channel_subscriptions, router_version)
+
+                subscriptions = [subscription for subscription in subscriptions if self._owns(subscription.user_id, now)]
+                self._scheduler.sync(subscriptions, now)
+                self._catch_up_scheduler.sync(backfill for backfill in backfills if self._owns(backfill.user_id, now))
+                self._quarantine.sync(failure for failure in account_failures if self._owns(failure.user_id, now))
+                if self._stream is not None:
+                    self._stream.follow(self._scheduler.user_ids)
+                synced_at = now
+                metrics.ACTIVE_SUBSCRIPTIONS.set(len(self._scheduler))
+                log.info('Got %s active twitter subscriptions', len(subscriptions))
+
+            if self._shard is not None and not self._shard.holds_leases(now):
+                log.info('Not polling until we hold our partition leases')
+                await asyncio.sleep(sharding.HEARTBEAT_PERIOD_SEC)
+                continue
+
+            # Users that the stream covers don't need polling, unless it drops. Quarantined users wait until their
+            # quarantine is over, and then their next poll is the probe that tells whether they're back.
+            quarantined_user_ids = self._quarantine.quarantined_user_ids(now)
+            metrics.QUARANTINED_USERS.set(len(quarantined_user_ids))
+            skipped_user_ids = quarantined_user_ids
+            if self._stream is not None:
+                skipped_user_ids = skipped_user_ids | self._stream.covered_user_ids
+            user_ids = self._scheduler.pop_due(now, skip=skipped_user_ids)
+            # Only the backfills that turn out to be due get to spend the allowance, since some might be excluded.
+            due_backfills = self._catch_up_scheduler.pop_due(
+                min(self._scheduler.spare_allowance(cost=CATCH_UP_PAGES_PER_FETCH), CATCH_UP_MAX_FETCHES_PER_CYCLE),
+                exclude={*user_ids, *quarantined_user_ids},
+            )
+            self._scheduler.take_spare_allowance(len(due_backfills), cost=CATCH_UP_PAGES_PER_FETCH)
+            if user_ids or due_backfills:
+                self._polled_user_ids = set()
+                self._cycle_counts = collections.Counter()
+                report = await self._pipeline.run([*user_ids, *due_backfills])
+                metrics.POLL_CYCLE_DURATION.observe(report.duration_sec)
+                log.info(
+                    'Finished polling cycle of %s users and %s catch-ups in %.2fs: fetched %s tweets, %s new, '
+                    'queued %s messages (%s tweets were duplicates), %s fetches failed',
+                    len(user_ids),
+                    len(due_backfills),
+                    report.duration_sec,
+                    self._cycle_counts['fetched_tweets'],
+                    self._cycle_counts['new_tweets'],
+                    self._cycle_counts['queued_messages'],
+                    self._cycle_counts['duplicate_tweets'],
+                    self._cycle_counts['failed_fetches'],
+                )
+                for stage in report.stages:
+                    # Stages that did everything they were given only matter when looking closely.
+                    log.log(
+                        logging.INFO if stage.dropped or stage.failed or stage.timed_out else logging.DEBUG,
+                        'Stage %s: %s processed (%.1f/s), %s dropped, %s failed, %s timed out, max queue depth %s',
+                        stage.name,
+                        stage.processed,
+                        stage.throughput_per_sec,
+                        stage.dropped,
+                        stage.failed,
+                        stage.timed_out,
+                        stage.max_queue_depth,
+                    )
+
+                # Polls that didn't make it all the way through don't tell us anything new about the users, but
+                # they still need to be rescheduled.
+                finished_at = time.time()
+                for user_id in set(user_ids) - self._polled_user_ids:
+                    self._scheduler.record_poll(user_id, None, finished_at)
+
+                await self._save_account_failures()
+
+            sleep_sec = self._scheduler.seconds_until_next(time.time())
+            if len(self._catch_up_scheduler):
+                sleep_sec = min(sleep_sec, CATCH_UP_TICK_SEC)
+            await asyncio.sleep(sleep_sec)
+        return
+
+    async def _outbox_loop(self) -> None:
+        pruned_at = None
+        while not self._stopped:
+            if not self._is_leader(time.time()):
+                # Slack's rate limits are per channel, so there's nothing to gain from several instances delivering.
+                await asyncio.sleep(sharding.HEARTBEAT_PERIOD_SEC)
+                continue
+
+            self._outbox_event.clear()
+            poll_period_sec: float = OUTBOX_POLL_PERIOD_SEC
             async with self._connection() as conn:
-                user_ids = await managers.TwitterSubscriptionManager.list_user_ids_of_active_subscriptions(
+                pending = await managers.OutboxManager.list_pending(
                     conn,
+                    limit=OUTBOX_BATCH_SIZE,
+                    max_attempts=OUTBOX_MAX_ATTEMPTS,
+                    include_digests=self._digest is None,
                 )
+                pending_digests = []
+                if self._digest is not None:
+                    poll_period_sec = min(poll_period_sec, self._digest.window_sec)
+                    pending_digests = await managers.OutboxManager.list_ready_digests(
+                        conn,
+                        created_before=datetime.datetime.utcnow() - datetime.timedelta(seconds=self._digest.window_sec),
+                        min_size=self._digest.max_tweets,
+                        limit=OUTBOX_BATCH_SIZE,
+                        max_attempts=OUTBOX_MAX_ATTEMPTS,
+                    )
+
+            if not pending and not pending_digests:
+                now = datetime.datetime.utcnow()
+                if pruned_at is None or now - pruned_at >= OUTBOX_RETENTION:
+                    async with self._datastore.writer() as conn:
+                        await managers.OutboxManager.delete_finished_before(
+                            conn,
+                            before=now - OUTBOX_RETENTION,
+                            max_attempts=OUTBOX_MAX_ATTEMPTS,
+                        )
+                        await managers.DeliveredContentManager.delete_delivered_before(conn, before=now - DEDUP_RETENTION)
+                    pruned_at = now
 
-                log.info('Got %s active twitter subscriptions: %s', len(user_ids), user_ids)
+                try:
+                    await asyncio.wait_for(self._outbox_event.wait(), timeout=poll_period_sec)
+                except asyncio.TimeoutError:
+                    pass
+                continue
 
-                tasks = {
-                    asyncio.create_task(self._handle_polling_twitter_user_id(user_id))
-                    for user_id in user_ids
-                }
-                await asyncio.wait(tasks)
-                log.info('Finished polling tasks for %s user ids', len(user_ids))
+            delivered: Dict[int, bool] = {}
+            for delivered_batch in await asyncio.gather(
+                self._send_messages(pending),
+                self._send_digests(pending_digests),
+            ):
+                delivered.update(delivered_batch)
+
+            sent_ids = [message_id for message_id, ok in delivered.items() if ok]
+            failed_ids = [message_id for message_id, ok in delivered.items() if not ok]
+            async with self._datastore.writer() as conn:
+                async with conn.transaction():
+                    await managers.OutboxManager.mark_sent(conn, ids=sent_ids)
+                    given_up = await managers.OutboxManager.record_failed_attempts(
+                        conn,
+                        ids=failed_ids,
+                        max_attempts=OUTBOX_MAX_ATTEMPTS,
+                    )
+
+            for message in given_up:
+                log.error(
+                    'Giving up on outbox message %s to %s after %s attempts: %s',
+                    message.id,
+                    message.message.channel,
+                    OUTBOX_MAX_ATTEMPTS,
+                    message.message.text,
+                )
+            metrics.MESSAGES_DELIVERED.inc(len(sent_ids))
+            metrics.MESSAGES_GIVEN_UP.inc(len(given_up))
+            log.info('Delivered %s outbox messages (%s failed)', len(sent_ids), len(failed_ids))
+
+            if not sent_ids:
+                # Slack is having a bad time, so give it a break.
+                await asyncio.sleep(OUTBOX_POLL_PERIOD_SEC)
 
-            await asyncio.sleep(TWITTER_TIMELINE_POLL_PERIOD_SEC)
         return
 
+    async def _send_messages(self, pending: List[managers.PendingMessage]) -> Dict[int, bool]:
+        """Sends each message on its own, and returns whether each one (by ID) was delivered.
+        """
+        # Enqueue everything before waiting on any of it, so that each channel's messages stay in order.
+        futures = [await self._slack_delivery_queue.put(pending_message.message) for pending_message in pending]
+        timestamps = await asyncio.gather(*futures)
+        return {pending_message.id: ts is not None for pending_message, ts in zip(pending, timestamps)}
+
+    async def _send_digests(self, pending: List[managers.PendingMessage]) -> Dict[int, bool]:
+        """Sends the messages as digests, and returns whether each one (by ID) was delivered.
+        """
+        if not pending:
+            return {}
+
+        assert self._digest is not None
+        digests = _group_digests(pending, self._digest.max_tweets)
+        # A digest of one message is just that message.
+        heads = []
+        for digest in digests:
+            if len(digest) == 1:
+                heads.append(digest[0].message)
+                continue
+
+            user_id = digest[0].digest_user_id
+            assert user_id is not None
+            screen_name = self._screen_names.get(user_id) or str(user_id)
+            texts = [pending_message.message.text for pending_message in digest]
+            heads.append(digest[0].message._replace(text=format_digest(screen_name, texts, self._digest.style)))
+
+        futures = [await self._slack_delivery_queue.put(message) for message in heads]
+        head_timestamps = await asyncio.gather(*futures)
+
+        delivered: Dict[int, bool] = {}
+        replies: List[managers.PendingMessage] = []
+        for digest, ts in zip(digests, head_timestamps):
+            if len(digest) > 1 and ts is not None:
+                metrics.DIGESTS_DELIVERED.inc()
+
+            if len(digest) > 1 and self._digest.style == DIGEST_THREAD and ts is not None:
+                # Whichever replies fail get another go in a later digest.
+                replies.extend(
+                    pending_message._replace(message=pending_message.message._replace(thread_ts=ts))
+                    for pending_message in digest
+                )
+            else:
+                delivered.update((pending_message.id, ts is not None) for pending_message in digest)
+
+        delivered.update(await self._send_messages(replies))
+        return delivered
+
     async def _slack_loop(self):
-        message_queue = self._slack_client.get_message_queue()
+        message_intake = self._slack_client.get_message_intake()
 
         while not self._stopped:
-            message = await message_queue.get()
-            log.info('Popped message from the Slack queue: %s', message)
+            message = await message_intake.get()
+            log.debug('Popped message from the Slack queue: %s', message.data)
 
-            await self._handle_slack_message(message)
+            # Every instance hears every message, but only one should act on it.
+            if not self._is_leader(time.time()):
+                continue
 
-            message_queue.task_done()
+            command = commands.parse_command(message)
+            if command is not None:
+                await self._command_dispatcher.dispatch(command)
 
         return
 
-    async def _handle_slack_message(self, message: Dict[str, Any]) -> None:
-        if not message.get('text'):
-            return
+    async def _handle_command(self, command: commands.Command) -> None:
+        if command.name == 'subscribe':
+            log.info('Subscribing to twitter users %s due to text: %s', command.screen_names, command.text)
+
+            users = await self.subscribe_to_twitter_users(command.screen_names, command.channel)
+            found_screen_names = {user.screen_name.lower() for user in users}
+            missing_screen_names = [
+                screen_name
+                for screen_name in command.screen_names
+                if screen_name.lower() not in found_screen_names
+            ]
+
+            lines = []
+            if users:
+                links = ', '.join(_user_link(user.screen_name) for user in users)
+                lines.append(f'Subscribed to {links}' if len(users) == 1 else f'Subscribed to {len(users)} users: {links}')
+            if missing_screen_names:
+                log.warning('Could not find users with screen names %s', missing_screen_names)
+                lines.append(f'No twitter user name {", ".join(missing_screen_names)} found')
 
-        text = message['text']
-        channel_id = message['channel']
+            await self._slack_client.post_message(
+                channel=command.channel,
+                text='\n'.join(lines),
+            )
 
-        for pattern in SUBSCRIBE_PATTERNS:
-            match = pattern.match(text)
-            if match:
-                twitter_username = match.groupdict()['username']
-                log.info('Subscribing to twitter user %s due to text: %s', twitter_username, text)
+        elif command.name == 'unsubscribe':
+            log.info('Unubscribing from twitter users %s due to text: %s', command.screen_names, command.text)
 
-                text = f'Subscribed to <https://www.twitter.com/{twitter_username}|{twitter_username}>'
+            await self.unsubscribe_from_twitter_users(command.screen_names, command.channel)
 
-                try:
-                    await self.subscribe_to_twitter_user(twitter_username)
-                except twitter.UserNotFound:
-                    text = f'No twitter user name {twitter_username} found'
+            links = ', '.join(f'https://www.twitter.com/{screen_name}' for screen_name in command.screen_names)
+            await self._slack_client.post_message(
+                channel=command.channel,
+                text=f'Unsubscribed from {links}',
+            )
 
-                await self._slack_client.post_message(
-                    channel=channel_id,
-                    text=text,
-                )
+        elif command.name == 'filter':
+            links = ', '.join(_user_link(screen_name) for screen_name in command.screen_names)
+            if command.filter_rule is None:
+                async with self._connection() as conn:
+                    user_ids = await managers.TwitterSubscriptionManager.list_user_ids_by_screen_names(
+                        conn,
+                        screen_names=command.screen_names,
+                    )
+                filter_rules = {
+                    self._router.filter_rules_of(user_id)[command.channel] or filters.DEFAULT_RULE
+                    for user_id in user_ids
+                    if command.channel in self._router.channels_of(user_id)
+                }
+                if filter_rules:
+                    text = f'Tweets from {links} are filtered with: {", ".join(sorted(filter_rules))}'
+                else:
+                    text = f'Not subscribed to {links}'
+                await self._slack_client.post_message(channel=command.channel, text=text)
                 return
 
-        for pattern in UNSUBSCRIBE_PATTERNS:
-            match = pattern.match(text)
-            if match:
-                twitter_username = match.groupdict()['username']
-                log.info('Unubscribing from twitter user %s due to text: %s', twitter_username, text)
-
-                await self.unsubscribe_from_twitter_user(twitter_username)
-                await self._slack_client.post_message(
-                    channel=channel_id,
-                    text=f'Unsubscribed from https://www.twitter.com/{twitter_username}',
-                )
+            try:
+                filter_rule = filters.normalize_rule(command.filter_rule)
+            except filters.FilterRuleError as e:
+                await self._slack_client.post_message(channel=command.channel, text=f"Couldn't set that filter: {e}")
                 return
 
+            log.info('Filtering tweets from %s with %r due to text: %s', command.screen_names, filter_rule, command.text)
+            user_ids = await self.set_filter_rule(command.screen_names, command.channel, filter_rule)
+            if not user_ids:
+                text = f'Not subscribed to {links}'
+            elif filter_rule is None:
+                text = f'Tweets from {links} are back to the default filter: {filters.DEFAULT_RULE}'
+            else:
+                text = f'Tweets from {links} are now filtered with: {filter_rule}'
+            await self._slack_client.post_message(channel=command.channel, text=text)
+
+    async def _shard_loop(self, shard: sharding.ShardCoordinator) -> None:
+        while not self._stopped:
+            try:
+                async with self._datastore.writer() as conn:
+                    await shard.heartbeat(conn, time.time())
+            except Exception:
+                # If this keeps failing, our leases lapse and we stop polling until it works again.
+                log.exception('Failed to heartbeat')
+
+            await asyncio.sleep(sharding.HEARTBEAT_PERIOD_SEC)
+
+        return
+
+    def _owns(self, user_id: int, now: float) -> bool:
+        return self._shard is None or self._shard.owns(user_id, now)
+
+    def _is_leader(self, now: float) -> bool:
+        return self._shard is None or self._shard.is_leader(now)
+
     def _connection(self) -> databases.core.Connection:
-        return self._datastore.db.connection()
+        return self._datastore.connection()
 
     def _loop_exception_handler(self, loop: asyncio.AbstractEventLoop, context: Dict[str, Any]) -> None:
         log.info('Loop handled an exception, but might not actually be an issue: %s', context)
@@ -240,8 +1130,6 @@ class TOTHCBot:
     async def run(self) -> int:
         self._loop.set_exception_handler(self._loop_exception_handler)
 
-        await self._datastore.db.connect()
-
         log.info('Starting the RTM client')
         self._slack_client.start_rtm_client()
 
@@ -253,11 +1141,23 @@ class TOTHCBot:
         log.info('Starting the loops')
         await asyncio.gather(
             self._slack_loop(),
-            self._twitter_loop(),
+            self._command_dispatcher.run(),
+            self.run_polling(),
         )
 
         return 0
 
+    async def run_polling(self) -> None:
+        """Runs the Twitter-to-Slack side of the bot on its own, without listening for Slack commands.
+        """
+        loops = [self._twitter_loop(), self._outbox_loop()]
+        if self._shard is not None:
+            loops.insert(0, self._shard_loop(self._shard))
+        if self._stream is not None:
+            loops.append(self._stream.run())
+
+        await asyncio.gather(*loops)
+
     def _create_signal_handler(self, s: signal.Signals):
         def signal_handler():
             async def handle_signal():
@@ -283,5 +1183,14 @@ class TOTHCBot:
         log.info('Waiting for tasks to finish')
         await asyncio.gather(*tasks, return_exceptions=True)
 
+        if self._shard is not None:
+            log.info('Releasing our leases')
+            async with self._datastore.writer() as conn:
+                await self._shard.release_all(conn)
+
+        # Pooled SQLite connections each have a thread, which would keep the process alive.
+        log.info('Closing DB connections')
+        await self._datastore.disconnect()
+
         log.info('Stopping the loop')
         self._loop.stop()
@@ -0,0 +1,67 @@
+import time
+from collections import OrderedDict
+from typing import Callable
+from typing import Generic
+from typing import Hashable
+from typing import Optional
+from typing import Tuple
+from typing import TypeVar
+
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class TTLCache(Generic[K, V]):
+    """An LRU cache whose entries also expire ``ttl_sec`` after they were set.
+
+    Expired entries are evicted lazily, when they're looked up or pushed out by newer ones.
+    """
+    _maxsize: int
+    _ttl_sec: float
+    _entries: 'OrderedDict[K, Tuple[float, V]]'
+
+    def __init__(
+        self,
+        *,
+        maxsize: int,
+        ttl_sec: float,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._maxsize = maxsize
+        self._ttl_sec = ttl_sec
+        self._clock: Callable[[], float] = clock
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return self._get_entry(key) is not None
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self._get_entry(key)
+        return entry[1] if entry is not None else None
+
+    def set(self, key: K, value: V) -> None:
+        self._entries[key] = (self._clock() + self._ttl_sec, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def _get_entry(self, key: K) -> Optional[Tuple[float, V]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        if entry[0] <= self._clock():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return entry
+
+    def pop(self, key: K) -> Optional[V]:
+        entry = self._entries.pop(key, None)
+        return entry[1] if entry is not None else None
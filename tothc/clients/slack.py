@@ -1,14 +1,113 @@
 import asyncio
 import logging
+import time
 from typing import Any
 from typing import Dict
+from typing import Hashable
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
 
+import aiohttp
 from slack import RTMClient
 from slack import WebClient
+from slack.errors import SlackApiError
+
+from tothc import caches
+from tothc import metrics
+
 
 log = logging.getLogger(__name__)
 
-_message_queue: asyncio.Queue = asyncio.Queue()
+# Slack allows posting about one message per second to a channel, with short bursts tolerated.
+CHANNEL_MESSAGES_PER_SEC = 1.0
+CHANNEL_BURST_SIZE = 3
+
+# How many messages can wait to be delivered to a single channel before whoever's enqueueing has to wait.
+DELIVERY_QUEUE_SIZE = 1000
+
+MAX_DELIVERY_ATTEMPTS = 5
+DELIVERY_BACKOFF_BASE_SEC = 1.0
+DELIVERY_BACKOFF_MAX_SEC = 60.0
+
+# How many incoming messages can wait to be handled. Past that, new messages are dropped rather than blocking
+# the RTM client, which would stop it from answering Slack's pings.
+MESSAGE_QUEUE_SIZE = 1000
+
+# Messages get redelivered when the RTM client reconnects, so we remember which ones we've seen for a while.
+SEEN_MESSAGE_CACHE_SIZE = 10000
+SEEN_MESSAGE_TTL_SEC = 60 * 60
+
+
+class IncomingMessage(NamedTuple):
+    data: Dict[str, Any]
+    # From time.monotonic(), so that handlers can tell how long the message waited.
+    received_at: float
+
+
+def _message_key(message_data: Dict[str, Any]) -> Optional[Hashable]:
+    """Messages that people type have a client_msg_id. Otherwise, a message's timestamp is unique within its channel.
+    """
+    if message_data.get('client_msg_id'):
+        return message_data['client_msg_id']
+    if message_data.get('ts'):
+        return (message_data.get('channel'), message_data['ts'])
+    return None
+
+
+class MessageIntake:
+    """A bounded queue of incoming messages that drops the ones it has already seen.
+    """
+    _maxsize: int
+    # Made on first use rather than in __init__, since before Python 3.10, a queue belongs to whichever event loop
+    # was current when it was made, and the intake is made when this module is imported.
+    _queue: 'Optional[asyncio.Queue[IncomingMessage]]'
+    _seen: caches.TTLCache[Hashable, bool]
+
+    def __init__(
+        self,
+        *,
+        maxsize: int = MESSAGE_QUEUE_SIZE,
+    ) -> None:
+        self._maxsize = maxsize
+        self._queue = None
+        self._seen = caches.TTLCache(maxsize=SEEN_MESSAGE_CACHE_SIZE, ttl_sec=SEEN_MESSAGE_TTL_SEC)
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def offer(self, message_data: Dict[str, Any]) -> bool:
+        """Enqueues the message without waiting, and returns whether it was enqueued.
+        """
+        key = _message_key(message_data)
+        if key is not None and key in self._seen:
+            log.debug('Ignoring message we have already seen: %s', message_data)
+            metrics.SLACK_MESSAGES_DROPPED.inc(reason='duplicate')
+            return False
+
+        try:
+            self._get_queue().put_nowait(IncomingMessage(data=message_data, received_at=time.monotonic()))
+        except asyncio.QueueFull:
+            log.warning('Too many Slack messages waiting to be handled, dropping message: %s', message_data)
+            metrics.SLACK_MESSAGES_DROPPED.inc(reason='overflow')
+            return False
+
+        # Only once it's enqueued, so that a redelivery of a dropped message gets another chance.
+        if key is not None:
+            self._seen.set(key, True)
+        return True
+
+    async def get(self) -> IncomingMessage:
+        return await self._get_queue().get()
+
+    def _get_queue(self) -> 'asyncio.Queue[IncomingMessage]':
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self._maxsize)
+        return self._queue
+
+
+_message_intake = MessageIntake()
+metrics.SLACK_MESSAGE_QUEUE_DEPTH.set_function(_message_intake.qsize)
 
 
 @RTMClient.run_on(event='message')
@@ -23,7 +122,7 @@ async def _enqueue_message(**payload) -> None:
         log.debug('Ignoring hidden message: %s', message_data)
         return
 
-    await _message_queue.put(payload['data'])
+    _message_intake.offer(message_data)
 
 
 class Client:
@@ -34,26 +133,31 @@ class Client:
         self,
         *,
         token: str,
+        base_url: Optional[str] = None,
     ) -> None:
         self._webclient = WebClient(
             token=token,
             run_async=True,
+            **({'base_url': base_url} if base_url else {}),
         )
         self._rtm_client = RTMClient(
             token=token,
             run_async=True,
         )
 
+    @metrics.timed(metrics.SLACK_REQUEST_LATENCY, method='chat.postMessage')
     async def post_message(
         self,
         channel: str,
         text: str,
+        thread_ts: Optional[str] = None,
     ) -> Dict[str, Any]:
-        log.info('Sending slack message to channel %s: %s', channel, text)
+        log.debug('Sending slack message to channel %s: %s', channel, text)
         return await self._webclient.chat_postMessage(
             channel=channel,
             text=text,
             icon_emoji='robot_face',
+            **({'thread_ts': thread_ts} if thread_ts else {}),
         )
 
     def start_rtm_client(self) -> asyncio.Future:
@@ -62,5 +166,170 @@ class Client:
     def stop_rtm_client(self) -> None:
         return self._rtm_client.stop()
 
-    def get_message_queue(self) -> asyncio.Queue:
-        return _message_queue
+    def get_message_intake(self) -> MessageIntake:
+        return _message_intake
+
+
+class OutgoingMessage(NamedTuple):
+    channel: str
+    text: str
+    # Set to the timestamp of another message in the channel, to reply in its thread.
+    thread_ts: Optional[str] = None
+
+
+class TokenBucket:
+    _rate: float
+    _capacity: float
+    _tokens: float
+    _updated_at: float
+
+    def __init__(
+        self,
+        *,
+        rate: float,
+        capacity: float,
+    ) -> None:
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    def pause(self, seconds: float) -> None:
+        """Makes the bucket hold back tokens for at least ``seconds``, for when Slack tells us to slow down.
+        """
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self._rate
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._updated_at) * self._rate, self._capacity)
+        self._updated_at = now
+
+
+class _ChannelSender:
+    """Only made by ``DeliveryQueue.put``, so that its queue belongs to the event loop that's running.
+    """
+    channel: str
+    queue: asyncio.Queue
+    bucket: TokenBucket
+    task: Optional[asyncio.Task]
+
+    def __init__(self, channel: str, maxsize: int) -> None:
+        self.channel = channel
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.bucket = TokenBucket(rate=CHANNEL_MESSAGES_PER_SEC, capacity=CHANNEL_BURST_SIZE)
+        self.task = None
+
+
+class DeliveryQueue:
+    """Delivers messages to Slack in the background, so that producers only wait when a channel's queue is full.
+    Each enqueued message comes with a future that resolves to the timestamp Slack gave it, or None if it wasn't
+    delivered.
+
+    Every channel has its own bounded queue, token bucket, and sender task, so messages to a channel go out in
+    order and a slow or rate-limited channel doesn't hold up the others. Failed posts are retried with
+    exponential backoff, or after however long Slack's ``Retry-After`` header says.
+    """
+    _client: Client
+    _maxsize: int
+    _senders: Dict[str, _ChannelSender]
+
+    def __init__(
+        self,
+        client: Client,
+        *,
+        maxsize: int = DELIVERY_QUEUE_SIZE,
+    ) -> None:
+        self._client = client
+        self._maxsize = maxsize
+        self._senders = {}
+
+    def qsize(self) -> int:
+        return sum(sender.queue.qsize() for sender in self._senders.values())
+
+    async def put(self, message: OutgoingMessage) -> asyncio.Future:
+        sender = self._senders.get(message.channel)
+        if sender is None:
+            sender = self._senders[message.channel] = _ChannelSender(message.channel, self._maxsize)
+            sender.task = asyncio.create_task(self._run_sender(sender))
+
+        delivered = asyncio.get_event_loop().create_future()
+        await sender.queue.put((message, delivered))
+        assert sender.task is not None
+        if sender.task.done() and not delivered.done():
+            # The sender was cancelled while we waited for room in its queue.
+            delivered.set_result(None)
+        return delivered
+
+    async def _run_sender(self, sender: _ChannelSender) -> None:
+        try:
+            while True:
+                item: Tuple[OutgoingMessage, asyncio.Future] = await sender.queue.get()
+                message, delivered = item
+                ts = None
+                try:
+                    ts = await self._deliver(sender.bucket, message)
+                except Exception:
+                    log.exception('Unexpected error while delivering message to channel %s', message.channel)
+                finally:
+                    sender.queue.task_done()
+                    # Whoever enqueued the message might have stopped waiting for it. If the sender was
+                    # cancelled, the message counts as undelivered.
+                    if not delivered.done():
+                        delivered.set_result(ts)
+        finally:
+            # Otherwise, whoever's waiting on the messages still in the queue would wait forever, and so would
+            # anyone enqueueing to the channel later.
+            if self._senders.get(sender.channel) is sender:
+                del self._senders[sender.channel]
+            while not sender.queue.empty():
+                _, delivered = sender.queue.get_nowait()
+                sender.queue.task_done()
+                if not delivered.done():
+                    delivered.set_result(None)
+
+    async def _deliver(self, bucket: TokenBucket, message: OutgoingMessage) -> Optional[str]:
+        for attempt in range(1, MAX_DELIVERY_ATTEMPTS + 1):
+            await bucket.acquire()
+            try:
+                response = await self._client.post_message(
+                    channel=message.channel,
+                    text=message.text,
+                    thread_ts=message.thread_ts,
+                )
+                return response['ts']
+            except SlackApiError as e:
+                if e.response.status_code != 429:
+                    log.exception('Slack rejected message to channel %s, dropping it: %s', message.channel, message.text)
+                    return None
+
+                retry_after = float(e.response.headers.get('Retry-After', DELIVERY_BACKOFF_BASE_SEC))
+                log.warning('Rate limited by Slack in channel %s, retrying in %ss', message.channel, retry_after)
+                bucket.pause(retry_after)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                backoff = min(DELIVERY_BACKOFF_BASE_SEC * 2 ** (attempt - 1), DELIVERY_BACKOFF_MAX_SEC)
+                log.warning(
+                    'Attempt %s of posting to channel %s failed, retrying in %ss',
+                    attempt,
+                    message.channel,
+                    backoff,
+                    exc_info=True,
+                )
+                bucket.pause(backoff)
+
+        log.error(
+            'Giving up on message to channel %s after %s attempts: %s',
+            message.channel,
+            MAX_DELIVERY_ATTEMPTS,
+            message.text,
+        )
+        return None
@@ -1,14 +1,77 @@
 from __future__ import annotations
 
+import asyncio
+import itertools
+import json
+import logging
+import re
+import time
 from typing import Any
+from typing import AsyncIterator
+from typing import Collection
 from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Mapping
 from typing import NamedTuple
 from typing import Optional
+from typing import Sequence
+from typing import Union
 
+import peony.data_processing
 import peony.exceptions
+import peony.utils
 from peony import PeonyClient
 
+from tothc import caches
+from tothc import metrics
+
+
+log = logging.getLogger(__name__)
+
+_JSON_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r'\s*')
+
+# The most tweets statuses/user_timeline returns per request.
+TIMELINE_PAGE_SIZE = 200
+
+# What each credential gets from statuses/user_timeline, until Twitter tells us otherwise through response headers.
+TIMELINE_WINDOW_REQUESTS = 900
+# A credential that hits its rate limit is parked until its window resets, or for this long if Twitter doesn't
+# say when that is.
+DEFAULT_PARK_SEC = 15 * 60
+
+# Twitter error codes that are about the account we asked about, rather than about Twitter or us, and what
+# they say about it.
+ACCOUNT_ERROR_REASONS = {
+    # Sorry, that page does not exist.
+    34: 'gone',
+    # User not found.
+    50: 'gone',
+    # User has been suspended.
+    63: 'suspended',
+    # Sorry, you are not authorized to see this status.
+    179: 'protected',
+}
+# Protected timelines come back as a 401 without an error code.
+ACCOUNT_ERROR_REASONS_BY_STATUS = {
+    401: 'protected',
+    404: 'gone',
+}
+
+# statuses/filter follows at most this many users per connection.
+STREAM_FOLLOW_LIMIT = 5000
+
+# users/lookup takes at most this many screen names per request.
+USERS_LOOKUP_BATCH_SIZE = 100
+
+# Users we've seen lately, in lookups or in timelines, are remembered so that looking them up again costs no
+# request. Screen names rarely change, and renames show up in timelines anyway.
+USER_CACHE_SIZE = 100000
+USER_CACHE_TTL_SEC = 24 * 60 * 60
+
 
 class ClientException(Exception):
     pass
@@ -20,6 +83,21 @@ class UserNotFound(ClientException):
         self.message = f'User not found: {screen_name}'
 
 
+class AccountUnavailable(ClientException):
+    """Twitter won't show us a user's timeline, because of something about their account.
+    """
+    def __init__(self, user_id: int, reason: str) -> None:
+        super().__init__(f'The timeline of user {user_id} is unavailable, since the account is {reason}')
+        self.user_id = user_id
+        self.reason = reason
+
+
+class RateLimited(ClientException):
+    def __init__(self, retry_at: float) -> None:
+        super().__init__(f'Every credential is rate limited until {retry_at:.0f}')
+        self.retry_at = retry_at
+
+
 class OAuth10aTokens(NamedTuple):
     consumer_key: str
     consumer_secret: str
@@ -27,81 +105,572 @@ class OAuth10aTokens(NamedTuple):
     access_token_secret: str
 
 
-class Tweet(NamedTuple):
-    data: Dict[str, Any]
+class User(NamedTuple):
+    id: int
+    screen_name: str
 
     @classmethod
-    def from_data(cls, data: Dict[str, Any]) -> Tweet:
-        return cls(data=data)
+    def from_data(cls, data: Mapping[str, Any]) -> User:
+        return cls(id=data['id'], screen_name=data['screen_name'])
+
+
+class UserCache:
+    """Users by ID and by (case insensitive) screen name. A user who's renamed stops being found by their old
+    screen name as soon as we see the new one.
+    """
+    _by_id: caches.TTLCache[int, User]
+    _by_screen_name: caches.TTLCache[str, User]
+
+    def __init__(
+        self,
+        *,
+        maxsize: int = USER_CACHE_SIZE,
+        ttl_sec: float = USER_CACHE_TTL_SEC,
+    ) -> None:
+        self._by_id = caches.TTLCache(maxsize=maxsize, ttl_sec=ttl_sec)
+        self._by_screen_name = caches.TTLCache(maxsize=maxsize, ttl_sec=ttl_sec)
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def get(self, user_id: int) -> Optional[User]:
+        return self._by_id.get(user_id)
+
+    def get_by_screen_name(self, screen_name: str) -> Optional[User]:
+        return self._by_screen_name.get(screen_name.lower())
+
+    def add(self, user: User) -> None:
+        previous = self._by_id.get(user.id)
+        if previous is not None and previous.screen_name.lower() != user.screen_name.lower():
+            self._by_screen_name.pop(previous.screen_name.lower())
+
+        self._by_id.set(user.id, user)
+        self._by_screen_name.set(user.screen_name.lower(), user)
+
+
+class RateLimit(NamedTuple):
+    limit: int
+    remaining: int
+    # When the current window resets, in seconds since the epoch.
+    reset_at: float
+    # Which of the client's credentials it's the rate limit of.
+    credential: int = 0
+
+    @classmethod
+    def from_headers(cls, headers: Mapping[str, str], credential: int = 0) -> Optional[RateLimit]:
+        try:
+            return cls(
+                limit=int(headers['x-rate-limit-limit']),
+                remaining=int(headers['x-rate-limit-remaining']),
+                reset_at=float(headers['x-rate-limit-reset']),
+                credential=credential,
+            )
+        except (KeyError, ValueError):
+            return None
+
+
+def classify_account_error(exception: peony.exceptions.PeonyException) -> Optional[str]:
+    """Says what's wrong with the account, if the error is about the account at all.
+    """
+    data = exception.data
+    # Peony only pulls out the error codes that it knows about, which doesn't include all of ours.
+    if isinstance(data, dict) and data.get('errors'):
+        return ACCOUNT_ERROR_REASONS.get(data['errors'][0].get('code'))
+
+    if exception.response is not None:
+        return ACCOUNT_ERROR_REASONS_BY_STATUS.get(exception.response.status)
+    return None
+
+
+class ErrorHandler(peony.utils.DefaultErrorHandler):
+    """Peony's usual error handling, except that hitting a rate limit raises right away, instead of sleeping until
+    the window resets, since another credential might have budget to spare.
+    """
+    @peony.utils.ErrorHandler.handle(peony.exceptions.RateLimitExceeded)
+    def handle_rate_limits(self) -> bool:
+        return peony.utils.ErrorHandler.RAISE
+
+    async def __call__(self, future: Optional[asyncio.Future] = None, **kwargs: Any) -> Any:
+        try:
+            return await super().__call__(future=future, **kwargs)
+        except Exception:
+            if future is None:
+                raise
+            # Peony runs requests in tasks that nobody awaits, and has already handed the exception to whoever is
+            # waiting on the future, so raising it again only gets it logged as never retrieved.
+            return None
+
+
+class Credential:
+    """One set of tokens, with its own peony client and its own timeline rate limit.
+    """
+    index: int
+    peony_client: PeonyClient
+    rate_limit: Optional[RateLimit]
+    # Timeline requests that were sent, but whose rate limit headers haven't come back yet.
+    in_flight: int
+    parked_until: float
+
+    def __init__(self, index: int, auth: OAuth10aTokens, base_url: Optional[str]) -> None:
+        self.index = index
+        self.peony_client = PeonyClient(
+            consumer_key=auth.consumer_key,
+            consumer_secret=auth.consumer_secret,
+            access_token=auth.access_token,
+            access_token_secret=auth.access_token_secret,
+            base_url=base_url,
+            loads=loads,
+            error_handler=ErrorHandler,
+        )
+        self.rate_limit = None
+        self.in_flight = 0
+        self.parked_until = 0.0
+
+    def is_parked(self, now: float) -> bool:
+        return now < self.parked_until
+
+    def budget(self, now: float) -> int:
+        """How many more timeline requests we expect this credential to be allowed in its current window.
+        """
+        if self.rate_limit is None:
+            remaining = TIMELINE_WINDOW_REQUESTS
+        elif now >= self.rate_limit.reset_at:
+            remaining = self.rate_limit.limit
+        else:
+            remaining = self.rate_limit.remaining
+        return remaining - self.in_flight
+
+    def update_rate_limit(self, rate_limit: RateLimit) -> None:
+        current = self.rate_limit
+        if current is not None and current.reset_at == rate_limit.reset_at:
+            # Responses can arrive out of order, so within a window the lowest remaining count is the freshest.
+            rate_limit = rate_limit._replace(remaining=min(current.remaining, rate_limit.remaining))
+
+        if current is None or rate_limit.reset_at >= current.reset_at:
+            self.rate_limit = rate_limit
+
+    def park(self, rate_limit: Optional[RateLimit], now: float) -> None:
+        if rate_limit is None:
+            limit = self.rate_limit.limit if self.rate_limit is not None else TIMELINE_WINDOW_REQUESTS
+            rate_limit = RateLimit(limit=limit, remaining=0, reset_at=now + DEFAULT_PARK_SEC, credential=self.index)
+
+        self.parked_until = max(rate_limit.reset_at, now)
+        self.rate_limit = rate_limit._replace(remaining=0)
+
+
+class Tweet:
+    """The handful of fields we actually use from a tweet, pulled out once so that the rest of the (large)
+    extended-mode payload can be garbage collected right away. Pass ``keep_raw`` to hold on to the payload.
+    """
+    __slots__ = (
+        'id',
+        'user_id',
+        'screen_name',
+        'media_count',
+        'media_types',
+        'retweeted_status_id',
+        'retweeted_user_id',
+        'retweeted_screen_name',
+        'in_reply_to_user_id',
+        'is_quote',
+        'like_count',
+        'retweet_count',
+        'raw',
+    )
+
+    id: int
+    user_id: int
+    screen_name: str
+    media_count: int
+    # Like 'photo', 'video' or 'animated_gif', once per kind of media the tweet has.
+    media_types: FrozenSet[str]
+    retweeted_status_id: Optional[int]
+    retweeted_user_id: Optional[int]
+    retweeted_screen_name: Optional[str]
+    in_reply_to_user_id: Optional[int]
+    is_quote: bool
+    # For retweets, these are the counts of the retweeted tweet, which is what a retweet shows.
+    like_count: int
+    retweet_count: int
+    raw: Optional[Dict[str, Any]]
+
+    def __init__(
+        self,
+        *,
+        id: int,
+        user_id: int,
+        screen_name: str,
+        media_count: int = 0,
+        media_types: FrozenSet[str] = frozenset(),
+        retweeted_status_id: Optional[int] = None,
+        retweeted_user_id: Optional[int] = None,
+        retweeted_screen_name: Optional[str] = None,
+        in_reply_to_user_id: Optional[int] = None,
+        is_quote: bool = False,
+        like_count: int = 0,
+        retweet_count: int = 0,
+        raw: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.id = id
+        self.user_id = user_id
+        self.screen_name = screen_name
+        self.media_count = media_count
+        self.media_types = media_types
+        self.retweeted_status_id = retweeted_status_id
+        self.retweeted_user_id = retweeted_user_id
+        self.retweeted_screen_name = retweeted_screen_name
+        self.in_reply_to_user_id = in_reply_to_user_id
+        self.is_quote = is_quote
+        self.like_count = like_count
+        self.retweet_count = retweet_count
+        self.raw = raw
+
+    def __repr__(self) -> str:
+        return f'Tweet(id={self.id}, screen_name={self.screen_name!r})'
+
+    @classmethod
+    def from_data(cls, data: Dict[str, Any], keep_raw: bool = False) -> Tweet:
+        user = data['user']
+        retweeted_status = data.get('retweeted_status')
+
+        retweeted_status_id = None
+        retweeted_user_id = None
+        retweeted_screen_name = None
+        if retweeted_status:
+            retweeted_status_id = retweeted_status['id']
+            retweeted_user_id = retweeted_status['user']['id']
+            retweeted_screen_name = retweeted_status['user']['screen_name']
+
+        media = data.get('entities', {}).get('media') or ()
+        # Only extended entities tell photos from videos and GIFs.
+        typed_media = data.get('extended_entities', {}).get('media') or media
+        content = retweeted_status or data
+
+        return cls(
+            id=data['id'],
+            user_id=user['id'],
+            screen_name=user['screen_name'],
+            media_count=len(media),
+            media_types=frozenset(item.get('type') for item in typed_media),
+            retweeted_status_id=retweeted_status_id,
+            retweeted_user_id=retweeted_user_id,
+            retweeted_screen_name=retweeted_screen_name,
+            in_reply_to_user_id=data.get('in_reply_to_user_id'),
+            is_quote=bool(data.get('is_quote_status')),
+            like_count=content.get('favorite_count') or 0,
+            retweet_count=content.get('retweet_count') or 0,
+            raw=data if keep_raw else None,
+        )
 
     def has_media(self) -> bool:
-        return bool(self.data.get('entities', {}).get('media'))
+        return self.media_count > 0
 
     def is_retweet(self) -> bool:
-        return bool(self.data.get('retweeted_status'))
+        return self.retweeted_status_id is not None
+
+    def is_self_retweet(self) -> bool:
+        return self.is_retweet() and self.retweeted_user_id == self.user_id
 
     def url_of_content(self) -> str:
         """Either the URL of the tweet itself, or the URL of the tweet it's a retweet of.
         """
         if self.is_retweet():
-            screen_name = self.data['retweeted_status']['user']['screen_name']
-            tweet_id = self.data['retweeted_status']['id']
+            screen_name = self.retweeted_screen_name
+            tweet_id = self.retweeted_status_id
         else:
-            screen_name = self.data['user']['screen_name']
-            tweet_id = self.data['id']
+            screen_name = self.screen_name
+            tweet_id = self.id
         return f'https://www.twitter.com/{screen_name}/status/{tweet_id}'
 
 
+def iter_json_array(text: str) -> Iterator[Any]:
+    """Decodes the elements of a top-level JSON array one at a time, so callers can compact each one before
+    the next is decoded, instead of materializing the whole tree at once.
+    """
+    index = _skip_whitespace(text, 0)
+    if text[index:index + 1] != '[':
+        raise ValueError('Expected a JSON array')
+
+    index = _skip_whitespace(text, index + 1)
+    if text[index:index + 1] == ']':
+        return
+
+    while True:
+        element, index = _JSON_DECODER.raw_decode(text, index)
+        yield element
+
+        index = _skip_whitespace(text, index)
+        delimiter = text[index:index + 1]
+        if delimiter == ']':
+            return
+        if delimiter != ',':
+            raise ValueError(f'Expected , or ] at position {index}')
+        index = _skip_whitespace(text, index + 1)
+
+
+def _skip_whitespace(text: str, index: int) -> int:
+    match = _WHITESPACE.match(text, index)
+    return match.end() if match else index
+
+
+def _is_tweet(data: Any) -> bool:
+    return isinstance(data, dict) and 'user' in data and ('full_text' in data or 'text' in data)
+
+
+def loads(json_data: Union[str, bytes], encoding: str = 'utf-8', **kwargs: Any) -> Any:
+    """A ``loads`` for peony that turns arrays of tweets (for example, timelines) into compact Tweets as they're
+    decoded. Everything else is decoded the way peony usually does it.
+    """
+    if isinstance(json_data, bytes):
+        json_data = json_data.decode(encoding)
+
+    if not json_data.lstrip().startswith('['):
+        return peony.data_processing.loads(json_data, **kwargs)
+
+    return [
+        Tweet.from_data(element) if _is_tweet(element) else element
+        for element in iter_json_array(json_data)
+    ]
+
+
 class Timeline(NamedTuple):
     tweets: List[Tweet]
+    rate_limit: Optional[RateLimit] = None
 
     @classmethod
-    def from_data(cls, data: List[Dict[str, Any]]) -> Timeline:
+    def from_data(
+        cls,
+        data: Iterable[Union[Tweet, Dict[str, Any]]],
+        rate_limit: Optional[RateLimit] = None,
+    ) -> Timeline:
+        """Accepts tweets that were already compacted by our ``loads``, as well as raw tweet dicts.
+        """
         return cls(
             tweets=[
-                Tweet.from_data(tweet)
+                tweet if isinstance(tweet, Tweet) else Tweet.from_data(tweet)
                 for tweet in data
             ],
+            rate_limit=rate_limit,
         )
 
 
+class TimelinePage(NamedTuple):
+    # Only the tweets newer than the since_id that was asked for.
+    timeline: Timeline
+    # Whether the page reached back to the since_id, so that there's nothing left to fetch in between.
+    reached_since_id: bool
+
+
+class StreamEvent(NamedTuple):
+    # Set for each tweet the stream delivers.
+    tweet: Optional[Tweet] = None
+    # Otherwise, whether the stream is now connected, or has dropped and is waiting to reconnect.
+    connected: bool = False
+
+
 class Client:
-    _peony_client: PeonyClient
+    """Talks to Twitter with one or more credentials, each with a rate limit of its own.
+
+    Timeline requests go to whichever credential has the most budget left, and each user sticks to the credential
+    they were first fetched with, so their timeline is always seen the same way. A credential that hits its rate
+    limit is parked until its window resets, and its users move to another one.
+    """
+    _credentials: List[Credential]
+    _credentials_by_user_id: Dict[int, Credential]
+    user_cache: UserCache
 
     def __init__(
         self,
         *,
-        auth: OAuth10aTokens,
+        auths: Sequence[OAuth10aTokens],
+        base_url: Optional[str] = None,
     ) -> None:
-        self._peony_client = PeonyClient(
-            consumer_key=auth.consumer_key,
-            consumer_secret=auth.consumer_secret,
-            access_token=auth.access_token,
-            access_token_secret=auth.access_token_secret,
-        )
+        """``base_url`` is a peony URL format, like ``https://{api}.twitter.com/{version}``.
+        """
+        if not auths:
+            raise ValueError('At least one set of Twitter credentials is needed')
+
+        self._credentials = [Credential(index, auth, base_url) for index, auth in enumerate(auths)]
+        self._credentials_by_user_id = {}
+        self.user_cache = UserCache()
+
+    @property
+    def rate_limits(self) -> List[RateLimit]:
+        """The timeline rate limits of the credentials that we've heard from.
+        """
+        return [credential.rate_limit for credential in self._credentials if credential.rate_limit is not None]
 
+    def _pick_credential(self, now: float, user_id: Optional[int] = None) -> Credential:
+        credential = self._credentials_by_user_id.get(user_id) if user_id is not None else None
+        if credential is not None and not credential.is_parked(now):
+            return credential
+
+        available = [credential for credential in self._credentials if not credential.is_parked(now)]
+        if not available:
+            raise RateLimited(min(credential.parked_until for credential in self._credentials))
+
+        credential = max(available, key=lambda credential: credential.budget(now))
+        if user_id is not None:
+            self._credentials_by_user_id[user_id] = credential
+        return credential
+
+    @metrics.timed(metrics.TWITTER_REQUEST_LATENCY, method='users/show')
     async def get_user_by_screen_name(self, screen_name: str) -> Dict[str, Any]:
         try:
-            response = await self._peony_client.api.users.show.get(screen_name=screen_name)
+            response = await self._pick_credential(time.time()).peony_client.api.users.show.get(screen_name=screen_name)
         except peony.exceptions.NotFound as e:
             raise UserNotFound(screen_name) from e
 
         return response
 
+    async def get_users_by_screen_names(self, screen_names: List[str]) -> List[User]:
+        """Looks up many users at once, only asking Twitter about the ones that aren't cached. Screen names that
+        don't belong to any user are left out of the result. Raises RateLimited if users/lookup is.
+        """
+        users_by_screen_name = {}
+        uncached_screen_names = []
+        for screen_name in screen_names:
+            cached_user = self.user_cache.get_by_screen_name(screen_name)
+            if cached_user is not None:
+                users_by_screen_name[screen_name.lower()] = cached_user
+            else:
+                uncached_screen_names.append(screen_name)
+
+        metrics.TWITTER_USER_CACHE_LOOKUPS.inc(len(users_by_screen_name), result='hit')
+        metrics.TWITTER_USER_CACHE_LOOKUPS.inc(len(uncached_screen_names), result='miss')
+
+        for start in range(0, len(uncached_screen_names), USERS_LOOKUP_BATCH_SIZE):
+            for user in await self._lookup_users(uncached_screen_names[start:start + USERS_LOOKUP_BATCH_SIZE]):
+                self.user_cache.add(user)
+                users_by_screen_name[user.screen_name.lower()] = user
+
+        return [
+            users_by_screen_name[screen_name.lower()]
+            for screen_name in screen_names
+            if screen_name.lower() in users_by_screen_name
+        ]
+
+    @metrics.timed(metrics.TWITTER_REQUEST_LATENCY, method='users/lookup')
+    async def _lookup_users(self, screen_names: List[str]) -> List[User]:
+        try:
+            # POST, so that a full batch of names can't make the URL too long.
+            credential = self._pick_credential(time.time())
+            response = await credential.peony_client.api.users.lookup.post(screen_name=','.join(screen_names))
+        except peony.exceptions.NotFound:
+            # That's what happens when none of the screen names belong to a user.
+            return []
+        except (peony.exceptions.RateLimitExceeded, peony.exceptions.TooManyRequests) as e:
+            # users/lookup has a rate limit of its own, so running out of it doesn't park the credential for timelines.
+            rate_limit = RateLimit.from_headers(e.response.headers)
+            raise RateLimited(rate_limit.reset_at if rate_limit is not None else time.time() + DEFAULT_PARK_SEC) from e
+
+        return [User.from_data(user) for user in response.data]
+
+    @metrics.timed(metrics.TWITTER_REQUEST_LATENCY, method='statuses/user_timeline')
     async def get_user_timeline_by_user_id(
         self,
         user_id: int,
         since_id: Optional[int] = None,
+        max_id: Optional[int] = None,
     ) -> Timeline:
-        try:
-            response = await self._peony_client.api.statuses.user_timeline.get(
-                user_id=user_id,
-                since_id=since_id,
-                count=200,
-                include_retweets=True,
-                tweet_mode='extended',
+        # Each attempt either succeeds, or parks a credential and tries the next best one.
+        for _ in range(len(self._credentials)):
+            credential = self._pick_credential(time.time(), user_id)
+            credential.in_flight += 1
+            try:
+                response = await credential.peony_client.api.statuses.user_timeline.get(
+                    user_id=user_id,
+                    since_id=since_id,
+                    max_id=max_id,
+                    count=TIMELINE_PAGE_SIZE,
+                    include_retweets=True,
+                    tweet_mode='extended',
+                )
+            except (peony.exceptions.RateLimitExceeded, peony.exceptions.TooManyRequests) as e:
+                rate_limit = RateLimit.from_headers(e.response.headers, credential=credential.index)
+                credential.park(rate_limit, time.time())
+                log.warning('Credential %s is rate limited, parking it until %.0f', credential.index, credential.parked_until)
+                metrics.TWITTER_CREDENTIALS_PARKED.inc(credential=str(credential.index))
+                continue
+            except peony.exceptions.PeonyException as e:
+                reason = classify_account_error(e)
+                if reason is None:
+                    raise
+                metrics.TWITTER_ACCOUNT_ERRORS.inc(reason=reason)
+                raise AccountUnavailable(user_id, reason) from e
+            finally:
+                credential.in_flight -= 1
+
+            break
+        else:
+            raise RateLimited(min(credential.parked_until for credential in self._credentials))
+
+        rate_limit = RateLimit.from_headers(response.headers, credential=credential.index)
+        if rate_limit is not None:
+            credential.update_rate_limit(rate_limit)
+        timeline = Timeline.from_data(response.data, rate_limit=rate_limit)
+
+        # Every tweet comes with its author's current profile, which is as good as a lookup.
+        if timeline.tweets:
+            self.user_cache.add(User(id=timeline.tweets[0].user_id, screen_name=timeline.tweets[0].screen_name))
+        for tweet in timeline.tweets:
+            if tweet.retweeted_user_id is not None and tweet.retweeted_screen_name is not None:
+                self.user_cache.add(User(id=tweet.retweeted_user_id, screen_name=tweet.retweeted_screen_name))
+
+        return timeline
+
+    async def iter_user_timeline(
+        self,
+        user_id: int,
+        *,
+        since_id: Optional[int] = None,
+        max_id: Optional[int] = None,
+        max_pages: int = 1,
+    ) -> AsyncIterator[TimelinePage]:
+        """Pages backwards through a user's timeline, from ``max_id`` (or their latest tweet) towards ``since_id``,
+        yielding each page as it arrives. Stops once it reaches ``since_id``, or after ``max_pages`` requests.
+
+        The one exception is a last page that came back short without reaching ``since_id``. Twitter drops deleted
+        tweets from pages after counting them, so that either means the ``since_id`` tweet itself was deleted, or
+        that deleted tweets were in the way. One more request tells which, so that a deleted cursor tweet doesn't
+        look like a timeline with tweets left to catch up on.
+        """
+        for page_number in itertools.count(1):
+            # Asking for one tweet more than since_id tells us when we've reached it, without a request for a page
+            # that would come back empty.
+            timeline = await self.get_user_timeline_by_user_id(
+                user_id,
+                since_id=since_id - 1 if since_id else None,
+                max_id=max_id,
             )
-        except peony.exceptions.DoesNotExist:
-            raise
+            tweets = [tweet for tweet in timeline.tweets if since_id is None or tweet.id > since_id]
+            reached_since_id = not timeline.tweets or len(tweets) < len(timeline.tweets)
 
-        return Timeline.from_data(response.data)
+            yield TimelinePage(timeline=timeline._replace(tweets=tweets), reached_since_id=reached_since_id)
+
+            if reached_since_id or page_number > max_pages:
+                return
+            if page_number == max_pages and (since_id is None or len(timeline.tweets) >= TIMELINE_PAGE_SIZE):
+                return
+            max_id = timeline.tweets[-1].id - 1
+
+    async def iter_filtered_stream(self, user_ids: Collection[int]) -> AsyncIterator[StreamEvent]:
+        """Follows the users through statuses/filter, which delivers tweets as they happen. That includes other
+        people's retweets of and replies to the users, not just the users' own tweets.
+
+        When the stream drops, peony reconnects it by itself (backing off the way Twitter asks), and says so
+        through events with ``connected`` set accordingly.
+        """
+        # Twitter only allows one stream per account, so it's always the first credential's.
+        follow = ','.join(str(user_id) for user_id in user_ids)
+        async with self._credentials[0].peony_client.stream.statuses.filter.post(follow=follow) as stream:
+            async for data in stream:
+                if 'connected' in data or 'stream_restart' in data:
+                    # Those come after every connection attempt, whether or not it worked.
+                    yield StreamEvent(connected=200 <= stream.response.status < 300)
+                elif 'reconnecting_in' in data:
+                    yield StreamEvent(connected=False)
+                elif _is_tweet(data):
+                    tweet = Tweet.from_data(data)
+                    self.user_cache.add(User(id=tweet.user_id, screen_name=tweet.screen_name))
+                    yield StreamEvent(tweet=tweet)
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import re
+import time
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+from tothc import metrics
+from tothc.clients import slack
+
+
+log = logging.getLogger(__name__)
+
+# Commands take any number of usernames or Twitter URLs, separated by whitespace or commas, so that a pasted
+# list of accounts can be subscribed to in one go. The filter command takes one, followed by the rule. Only
+# messages that start with the command (or with a mention, followed by the command) are commands, so that chat
+# that happens to use one of the words isn't taken for one.
+COMMAND_PATTERN = re.compile(
+    r'\A\s*(?:<@\w+>:?\s*)?(?P<name>subscribe|unsubscribe|filter)\s+(?P<arguments>.+)',
+    re.DOTALL,
+)
+ARGUMENT_SEPARATOR_PATTERN = re.compile(r'[\s,]+')
+TWITTER_URL_PATTERN = re.compile(r'twitter\.com/(?P<username>[a-zA-Z0-9_]{1,15})\b')
+USERNAME_PATTERN = re.compile(r'@?(?P<username>[a-zA-Z0-9_]{1,15})\b')
+
+# Handling a command mostly means waiting on Twitter and the DB, so a few of them can be handled at once.
+DEFAULT_WORKER_COUNT = 4
+# How many commands can wait for a worker before the dispatcher has to wait.
+QUEUE_SIZE = 100
+
+
+class Command(NamedTuple):
+    # Either 'subscribe', 'unsubscribe' or 'filter'.
+    name: str
+    # Without duplicates, in the order they were given.
+    screen_names: List[str]
+    # Where the command came from, and where the reply goes.
+    channel: str
+    text: str
+    # From time.monotonic().
+    received_at: float
+    # The rule that a filter command sets, as typed. Without one, the command shows the current rule.
+    filter_rule: Optional[str] = None
+
+
+def parse_screen_names(arguments: str) -> List[str]:
+    screen_names: Dict[str, str] = {}
+    for argument in ARGUMENT_SEPARATOR_PATTERN.split(arguments):
+        # Slack turns URLs into links like <https://twitter.com/foo|twitter.com/foo>.
+        match = TWITTER_URL_PATTERN.search(argument) or USERNAME_PATTERN.match(argument)
+        if match:
+            screen_name = match.group('username')
+            screen_names.setdefault(screen_name.lower(), screen_name)
+
+    return list(screen_names.values())
+
+
+def parse_command(message: slack.IncomingMessage) -> Optional[Command]:
+    text = message.data.get('text')
+    if not text:
+        return None
+
+    match = COMMAND_PATTERN.match(text)
+    if not match:
+        return None
+
+    name = match.group('name')
+    arguments = match.group('arguments')
+    filter_rule = None
+    if name == 'filter':
+        arguments, *rest = ARGUMENT_SEPARATOR_PATTERN.split(arguments.strip(), maxsplit=1)
+        filter_rule = rest[0] if rest else None
+
+    screen_names = parse_screen_names(arguments)
+    if not screen_names:
+        return None
+
+    return Command(
+        name=name,
+        screen_names=screen_names,
+        channel=message.data['channel'],
+        text=text,
+        received_at=message.received_at,
+        filter_rule=filter_rule,
+    )
+
+
+class _QueuedCommand(NamedTuple):
+    command: Command
+    # The commands about the same screen names that came in before this one, and have to be handled first.
+    previous: List[asyncio.Future]
+    handled: asyncio.Future
+
+
+class CommandDispatcher:
+    """Hands commands out to a fixed set of workers.
+
+    Commands about the same Twitter user are handled in the order they came in, while commands about different
+    users don't wait on each other. Each command waits for the previous command about any of its screen names
+    to be handled before it starts.
+    """
+    _worker_count: int
+    _queue: 'asyncio.Queue[_QueuedCommand]'
+    # Keys are lower-case screen names, and values are whether the latest command about them has been handled.
+    _latest: Dict[str, asyncio.Future]
+
+    def __init__(
+        self,
+        handler: Callable[[Command], Awaitable[None]],
+        *,
+        worker_count: int = DEFAULT_WORKER_COUNT,
+        queue_size: int = QUEUE_SIZE,
+    ) -> None:
+        self._handler: Callable[[Command], Awaitable[None]] = handler
+        self._worker_count = worker_count
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._latest = {}
+
+    async def dispatch(self, command: Command) -> None:
+        handled = asyncio.get_event_loop().create_future()
+        previous = []
+        for screen_name in command.screen_names:
+            # Screen names are case insensitive.
+            key = screen_name.lower()
+            if key in self._latest:
+                previous.append(self._latest[key])
+            self._latest[key] = handled
+
+        await self._queue.put(_QueuedCommand(command=command, previous=previous, handled=handled))
+
+    async def run(self) -> None:
+        await asyncio.gather(*(self._run_worker() for _ in range(self._worker_count)))
+
+    async def _run_worker(self) -> None:
+        while True:
+            queued = await self._queue.get()
+            try:
+                # Those commands were queued earlier, so they've already been picked up by other workers.
+                await asyncio.gather(*queued.previous)
+                await self._handler(queued.command)
+            except Exception:
+                log.exception('Failed to handle command: %s', queued.command.text)
+            finally:
+                queued.handled.set_result(None)
+                for screen_name in queued.command.screen_names:
+                    if self._latest.get(screen_name.lower()) is queued.handled:
+                        del self._latest[screen_name.lower()]
+                self._queue.task_done()
+
+            metrics.SLACK_COMMAND_LATENCY.observe(time.monotonic() - queued.command.received_at, command=queued.command.name)
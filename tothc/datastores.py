@@ -0,0 +1,184 @@
+import asyncio
+import contextlib
+import logging
+from typing import Any
+from typing import AsyncContextManager
+from typing import AsyncIterator
+from typing import List
+from typing import Optional
+from typing import Union
+from typing import cast
+
+import aiosqlite
+import sqlalchemy
+from databases.backends.sqlite import SQLiteBackend
+from databases.backends.sqlite import SQLitePool
+from databases.core import Connection
+from databases.core import DatabaseURL
+from databases.interfaces import DatabaseBackend
+from sqlalchemy.engine.interfaces import Dialect
+
+from tothc import migrations
+
+
+log = logging.getLogger(__name__)
+
+# How many connections a datastore keeps around. For Postgres, that's the size of the connection pool. For SQLite,
+# it's how many idle connections are kept open instead of being closed after each use.
+DEFAULT_POOL_SIZE = 10
+
+# WAL lets readers carry on while something's writing, and with WAL, synchronous=NORMAL is still safe from
+# corruption (a power loss can only roll back the last few commits).
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',
+    # When another process is writing, wait for it instead of failing right away.
+    'PRAGMA busy_timeout = 30000',
+)
+
+
+class TunedSQLitePool(SQLitePool):
+    """Keeps connections open between uses, with our PRAGMAs applied, instead of opening a new one (and a new
+    thread, since that's how aiosqlite works) every time. With ``query_only``, the connections refuse to write.
+    """
+    _max_size: int
+    _query_only: bool
+    _idle_connections: List[aiosqlite.Connection]
+
+    def __init__(self, url: DatabaseURL, *, max_size: int, query_only: bool, **options: Any) -> None:
+        super().__init__(url, **options)
+        self._max_size = max_size
+        self._query_only = query_only
+        self._idle_connections = []
+
+    async def acquire(self) -> aiosqlite.Connection:
+        if self._idle_connections:
+            return self._idle_connections.pop()
+
+        connection = await super().acquire()
+        pragmas = list(SQLITE_CONNECTION_PRAGMAS)
+        if self._query_only:
+            pragmas.append('PRAGMA query_only = ON')
+        for pragma in pragmas:
+            cursor = await connection.execute(pragma)
+            await cursor.close()
+        return connection
+
+    async def release(self, connection: aiosqlite.Connection) -> None:
+        # A connection that was abandoned in the middle of a transaction can't be trusted with the next one.
+        if len(self._idle_connections) < self._max_size and not connection.in_transaction:
+            self._idle_connections.append(connection)
+        else:
+            await super().release(connection)
+
+    async def close(self) -> None:
+        while self._idle_connections:
+            await super().release(self._idle_connections.pop())
+
+
+class TunedSQLiteBackend(SQLiteBackend):
+    _pool: TunedSQLitePool
+
+    def __init__(
+        self,
+        database_url: Union[DatabaseURL, str],
+        *,
+        max_size: int = DEFAULT_POOL_SIZE,
+        query_only: bool = False,
+        **options: Any
+    ) -> None:
+        super().__init__(database_url, **options)
+        self._pool = TunedSQLitePool(self._database_url, max_size=max_size, query_only=query_only, **options)
+
+    async def disconnect(self) -> None:
+        await self._pool.close()
+
+
+class Datastore:
+    """The DB, which can be SQLite (``sqlite:///path/to/file.db``) or Postgres (``postgresql://...``, which needs
+    asyncpg to be installed).
+
+    This uses the backends and connections of ``databases`` directly instead of going through
+    ``databases.Database``, which would hand out one connection per task. Child tasks inherit that connection, so
+    concurrent pipeline workers would end up interleaving their transactions on it.
+    """
+    _database_url: DatabaseURL
+    _dialect: Dialect
+    _backend: DatabaseBackend
+    # SQLite only lets one connection write at a time, so everything that writes takes turns on a single
+    # connection of its own, instead of fighting over the file lock. The pooled connections are read-only, so
+    # writing through one of them fails right away. Postgres copes with concurrent writers by itself, so it
+    # doesn't have any of these.
+    _writer_backend: Optional[TunedSQLiteBackend]
+    _writer_connection: Optional[Connection]
+    _write_lock: Optional[asyncio.Lock]
+    _exit_stack: contextlib.AsyncExitStack
+
+    def __init__(
+        self,
+        database_url: str,
+        *,
+        pool_size: int = DEFAULT_POOL_SIZE,
+    ) -> None:
+        self._database_url = DatabaseURL(database_url)
+        self._dialect = sqlalchemy.engine.url.make_url(database_url).get_dialect()()
+        self._writer_connection = None
+        self._exit_stack = contextlib.AsyncExitStack()
+
+        if self.is_sqlite:
+            self._backend = TunedSQLiteBackend(self._database_url, max_size=pool_size, query_only=True)
+            self._writer_backend = TunedSQLiteBackend(self._database_url, max_size=1)
+        else:
+            from databases.backends.postgres import PostgresBackend
+            self._backend = PostgresBackend(self._database_url, min_size=1, max_size=pool_size)
+            self._writer_backend = None
+        self._write_lock = None
+
+    @property
+    def is_sqlite(self) -> bool:
+        return self._database_url.dialect == 'sqlite'
+
+    async def connect(self) -> None:
+        await self._backend.connect()
+        self._exit_stack.push_async_callback(self._backend.disconnect)
+
+        if self._writer_backend is not None:
+            await self._writer_backend.connect()
+            self._exit_stack.push_async_callback(self._writer_backend.disconnect)
+            self._writer_connection = await self._exit_stack.enter_async_context(
+                cast(AsyncContextManager[Connection], Connection(self._writer_backend)),
+            )
+            # Made here rather than in __init__, since before Python 3.10, a lock belongs to whichever event loop
+            # was current when it was made, and the datastore might have been made outside of the one it runs in.
+            self._write_lock = asyncio.Lock()
+
+    async def disconnect(self) -> None:
+        self._writer_connection = None
+        await self._exit_stack.aclose()
+
+    def connection(self) -> Connection:
+        """A connection for reading from the DB. On SQLite, it can't write.
+        """
+        return Connection(self._backend)
+
+    @contextlib.asynccontextmanager
+    async def writer(self) -> AsyncIterator[Connection]:
+        """A connection for anything that writes to the DB.
+        """
+        if self._writer_connection is None:
+            async with self.connection() as conn:
+                yield conn
+            return
+
+        assert self._write_lock is not None
+        async with self._write_lock:
+            yield self._writer_connection
+
+    async def ensure_initialized(self) -> None:
+        log.info('Bringing DB up to date: %s', self._database_url.obscure_password)
+        async with self.writer() as conn:
+            if self.is_sqlite:
+                # Unlike the other PRAGMAs, this one sticks to the DB file.
+                await conn.execute(f'PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}')
+
+            await migrations.run_migrations(conn, self._dialect)
@@ -0,0 +1,218 @@
+"""Filter rules, which say which of a subscribed user's tweets a channel gets.
+
+A rule is a list of terms, all of which a tweet has to match. A term is a kind of tweet, like ``photos`` or
+``replies``, or a count compared to a number, like ``likes>1k``. Terms can be negated with a leading ``-``, and
+alternatives are separated by commas, so ``photos,videos -replies likes>=500`` keeps photos and videos with at
+least 500 likes, unless they're replies.
+
+Each rule is parsed into terms, which are compiled once into a function that takes a whole batch of tweets and says
+which of them it keeps. Compiled rules are put together out of the predicates in KINDS and COUNTS, so nothing from
+the rule's text gets run. They're cached by their text, so changing a rule compiles the new one, and everyone with
+the same rule shares it.
+"""
+import functools
+import operator
+import re
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+from tothc.clients import twitter
+
+
+TweetPredicate = Callable[[twitter.Tweet], bool]
+# Takes a batch of tweets, and returns whether the rule keeps each one.
+CompiledRule = Callable[[Sequence[twitter.Tweet]], List[bool]]
+
+# What channels get from users that they haven't set a rule for.
+DEFAULT_RULE = 'media -self-retweets'
+# Setting a user's rule to this goes back to the default.
+DEFAULT_KEYWORD = 'default'
+
+# Distinct rules are few, since most subscriptions use the default.
+COMPILED_RULE_CACHE_SIZE = 1024
+
+KINDS: Dict[str, TweetPredicate] = {
+    'all': lambda tweet: True,
+    'media': lambda tweet: tweet.media_count > 0,
+    'photos': lambda tweet: 'photo' in tweet.media_types,
+    'videos': lambda tweet: 'video' in tweet.media_types,
+    'gifs': lambda tweet: 'animated_gif' in tweet.media_types,
+    'retweets': lambda tweet: tweet.retweeted_status_id is not None,
+    'self-retweets': lambda tweet: tweet.retweeted_status_id is not None and tweet.retweeted_user_id == tweet.user_id,
+    'replies': lambda tweet: tweet.in_reply_to_user_id is not None,
+    'quotes': lambda tweet: tweet.is_quote,
+}
+# For retweets, these are the counts of the retweeted tweet.
+COUNTS: Dict[str, Callable[[twitter.Tweet], int]] = {
+    'likes': operator.attrgetter('like_count'),
+    'retweets': operator.attrgetter('retweet_count'),
+}
+COMPARISONS: Dict[str, Callable[[int, int], bool]] = {
+    '>=': operator.ge,
+    '<=': operator.le,
+    '>': operator.gt,
+    '<': operator.lt,
+    '=': operator.eq,
+}
+COUNT_SUFFIXES = {'': 1, 'k': 1000, 'm': 1000000}
+
+TERM_SEPARATOR_PATTERN = re.compile(r'\s+')
+# Alternatives can have spaces around their commas, like ``photos, videos``, which are dropped before the rule is
+# split into terms.
+ALTERNATIVE_SEPARATOR_PATTERN = re.compile(r'\s*,\s*')
+ALTERNATIVE_PATTERN = re.compile(
+    r'(?P<name>[a-z-]+)(?:(?P<comparison>>=|<=|>|<|=)(?P<number>\d+(?:\.\d+)?)(?P<suffix>[km]?))?',
+)
+
+
+class FilterRuleError(ValueError):
+    pass
+
+
+class Kind(NamedTuple):
+    """Like ``photos``, which is one of KINDS.
+    """
+    name: str
+
+
+class Count(NamedTuple):
+    """Like ``likes>1k``, which compares one of COUNTS to a number.
+    """
+    name: str
+    comparison: str
+    threshold: int
+
+
+Alternative = Union[Kind, Count]
+
+
+class Term(NamedTuple):
+    """Matches the tweets that match any of its alternatives, or if it's negated, none of them.
+    """
+    negated: bool
+    alternatives: Tuple[Alternative, ...]
+
+
+def normalize_rule(rule: str) -> Optional[str]:
+    """Checks the rule, and returns it the way it's stored, which is None for the default rule.
+    """
+    rule = ALTERNATIVE_SEPARATOR_PATTERN.sub(',', rule.strip().lower())
+    rule = ' '.join(TERM_SEPARATOR_PATTERN.split(rule))
+    if not rule or rule == DEFAULT_KEYWORD:
+        return None
+
+    parse_rule(rule)
+    return rule
+
+
+def parse_rule(rule: Optional[str]) -> Tuple[Term, ...]:
+    """Raises FilterRuleError if the rule doesn't make sense.
+    """
+    return tuple(_parse_term(term) for term in (rule or DEFAULT_RULE).split())
+
+
+def _parse_term(term: str) -> Term:
+    negated = term.startswith('-')
+    alternatives: List[Alternative] = []
+    for alternative in (term[1:] if negated else term).split(','):
+        if not alternative:
+            raise FilterRuleError(f'Term {term!r} has an empty alternative')
+        alternatives.append(_parse_alternative(alternative))
+
+    return Term(negated=negated, alternatives=tuple(alternatives))
+
+
+def _parse_alternative(alternative: str) -> Alternative:
+    match = ALTERNATIVE_PATTERN.fullmatch(alternative)
+    if not match:
+        raise FilterRuleError(f"Can't make sense of {alternative!r}")
+
+    name = match.group('name')
+    if match.group('comparison') is None:
+        if name not in KINDS:
+            raise FilterRuleError(f'No kind of tweet called {name!r}. Kinds: {", ".join(KINDS)}')
+        return Kind(name=name)
+
+    if name not in COUNTS:
+        raise FilterRuleError(f'No count called {name!r}. Counts: {", ".join(COUNTS)}')
+
+    return Count(
+        name=name,
+        comparison=match.group('comparison'),
+        threshold=int(float(match.group('number')) * COUNT_SUFFIXES[match.group('suffix')]),
+    )
+
+
+@functools.lru_cache(maxsize=COMPILED_RULE_CACHE_SIZE)
+def compile_rule(rule: Optional[str]) -> CompiledRule:
+    """Raises FilterRuleError if the rule doesn't make sense.
+    """
+    predicate = _all_of([_compile_term(term) for term in parse_rule(rule)])
+
+    def compiled_rule(tweets: Sequence[twitter.Tweet]) -> List[bool]:
+        return [predicate(tweet) for tweet in tweets]
+
+    return compiled_rule
+
+
+def _compile_term(term: Term) -> TweetPredicate:
+    predicate = _any_of([_compile_alternative(alternative) for alternative in term.alternatives])
+    if term.negated:
+        return lambda tweet: not predicate(tweet)
+    return predicate
+
+
+def _compile_alternative(alternative: Alternative) -> TweetPredicate:
+    if isinstance(alternative, Kind):
+        return KINDS[alternative.name]
+
+    count = COUNTS[alternative.name]
+    compare = COMPARISONS[alternative.comparison]
+    threshold = alternative.threshold
+    return lambda tweet: compare(count(tweet), threshold)
+
+
+def _all_of(predicates: List[TweetPredicate]) -> TweetPredicate:
+    # Most rules are a single term, which doesn't need wrapping.
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda tweet: all(predicate(tweet) for predicate in predicates)
+
+
+def _any_of(predicates: List[TweetPredicate]) -> TweetPredicate:
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda tweet: any(predicate(tweet) for predicate in predicates)
+
+
+def route_tweets(
+    tweets: Sequence[twitter.Tweet],
+    rules_by_channel: Mapping[str, Optional[str]],
+) -> List[Tuple[twitter.Tweet, Tuple[str, ...]]]:
+    """Returns each tweet that at least one channel's rule keeps, along with the channels that keep it.
+
+    Channels with the same rule share it, so each distinct rule runs once over the batch.
+    """
+    channels_by_rule: Dict[Optional[str], List[str]] = {}
+    for channel, rule in rules_by_channel.items():
+        channels_by_rule.setdefault(rule, []).append(channel)
+
+    if len(channels_by_rule) == 1:
+        [(rule, channels)] = channels_by_rule.items()
+        kept = compile_rule(rule)(tweets)
+        return [(tweet, tuple(channels)) for tweet, keep in zip(tweets, kept) if keep]
+
+    channels_of_tweets: List[Tuple[str, ...]] = [()] * len(tweets)
+    for rule, channels in channels_by_rule.items():
+        for index, keep in enumerate(compile_rule(rule)(tweets)):
+            if keep:
+                channels_of_tweets[index] += tuple(channels)
+
+    return [(tweet, channels) for tweet, channels in zip(tweets, channels_of_tweets) if channels]
@@ -1,26 +1,175 @@
+"""Logging goes through a queue to a thread that does the writing, so that the event loop never waits on stderr.
+
+Records below WARNING are also rate limited by message, since a message that's logged for every user or tweet
+would otherwise drown out everything else at tens of thousands of subscriptions. What gets dropped is counted, and
+the next record of that message that makes it through says how many.
+"""
+import atexit
+import json
 import logging.config
+import logging.handlers
+import queue
+import threading
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+
+TEXT_FORMAT = '%(levelname)s %(asctime)s %(module)s [%(process)d] %(message)s'
+LOG_FORMATS = ('text', 'json')
+
+# Each message (that is, each format string of each logger) gets this many records per period, and the rest of
+# the period's records of it are dropped. That's enough for a line per polling cycle.
+RATE_LIMIT_RECORDS_PER_PERIOD = 60
+RATE_LIMIT_PERIOD_SEC = 60.0
+
+# What a LogRecord has no matter what was logged, so that everything else came from ``extra``.
+_STANDARD_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats each record as a JSON object on a line of its own, with whatever was passed as ``extra`` as fields
+    next to the message.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        data.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in _STANDARD_RECORD_ATTRIBUTES
+        )
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+
+        return json.dumps(data, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most ``records_per_period`` records of each message per period. WARNING and above always
+    get through.
+    """
+    _records_per_period: int
+    _period_sec: float
+    # By logger name and format string: when the current period started, how many records it let through, and how
+    # many it dropped.
+    _periods: Dict[Tuple[str, str], Tuple[float, int, int]]
+    _pruned_at: float
+    _lock: threading.Lock
+
+    def __init__(
+        self,
+        *,
+        records_per_period: int = RATE_LIMIT_RECORDS_PER_PERIOD,
+        period_sec: float = RATE_LIMIT_PERIOD_SEC,
+    ) -> None:
+        super().__init__()
+        self._records_per_period = records_per_period
+        self._period_sec = period_sec
+        self._periods = {}
+        self._pruned_at = 0.0
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        key = (record.name, str(record.msg))
+        with self._lock:
+            if record.created - self._pruned_at >= self._period_sec:
+                self._prune(record.created)
+
+            started_at, passed, dropped = self._periods.get(key, (0.0, 0, 0))
+            if record.created - started_at >= self._period_sec:
+                started_at, passed = record.created, 0
+
+            if passed >= self._records_per_period:
+                self._periods[key] = (started_at, passed, dropped + 1)
+                return False
+            self._periods[key] = (started_at, passed + 1, 0)
+
+        if dropped:
+            record.msg = f'{record.getMessage()} ({dropped} more like this were dropped)'
+            record.args = ()
+        return True
 
+    def _prune(self, now: float) -> None:
+        """Forgets the messages whose periods are over and that didn't drop anything, which is most of them when
+        messages are formatted before they're logged. Those that did drop records are kept, so that their next
+        record can say how many.
+        """
+        self._periods = {
+            key: (started_at, passed, dropped)
+            for key, (started_at, passed, dropped) in self._periods.items()
+            if dropped or now - started_at < self._period_sec
+        }
+        self._pruned_at = now
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Unlike the default, this keeps the traceback apart from the message, so that the writer's formatter still
+        gets to format it, and leaves ``extra`` alone for the JSON formatter.
+        """
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = ()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(*, log_format: str = 'text', level: str = 'INFO') -> None:
+    """Sets up tothc's loggers, and starts the thread that writes their records, which is stopped (after writing
+    whatever's left) when the process exits.
+    """
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
 
-def configure_logging() -> None:
     logging.config.dictConfig({
         'version': 1,
         'disable_existing_loggers': True,
-        'formatters': {
-            'verbose': {
-                'format': '%(levelname)s %(asctime)s %(module)s [%(process)d] %(message)s',
-            },
-        },
-        'handlers': {
-            'console': {
-                'level': 'INFO',
-                'class': 'logging.StreamHandler',
-                'formatter': 'verbose',
-            },
-        },
         'loggers': {
             'tothc': {
-                'handlers': ['console'],
-                'level': 'INFO',
+                'level': level,
             },
         },
     })
+
+    formatter = JSONFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter())
+    logging.getLogger('tothc').addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(records, stream_handler)
+    _listener.start()
+
+
+def _stop_listener() -> None:
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# Registered once, rather than by each call of configure_logging, and does nothing if logging was never configured.
+atexit.register(_stop_listener)
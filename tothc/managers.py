@@ -1,143 +1,1408 @@
 import datetime
 import logging
+from typing import Any
+from typing import Dict
 from typing import List
+from typing import Mapping
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from typing import Tuple
 
+import sqlalchemy as sa
 from databases.core import Connection
 
+from tothc import metrics
 from tothc import models
+from tothc.clients import slack
+from tothc.clients import twitter
 
 
 log = logging.getLogger(__name__)
 
+# SQLite allows at most 999 bound parameters per statement. Bulk UPDATEs work out their chunk sizes from how many
+# of them each row takes up, with _case_update_chunk_size.
+MAX_BOUND_PARAMETERS = 999
+# Each outbox row takes up 3.
+BULK_INSERT_CHUNK_SIZE = 300
+# And each ID in an IN clause takes up 1.
+BULK_SELECT_CHUNK_SIZE = 900
 
+
+class ActiveSubscription(NamedTuple):
+    user_id: int
+    tweets_per_day: Optional[float]
+    # In seconds since the epoch, or None if we've never polled the user.
+    refreshed_latest_tweet_id_at: Optional[float]
+
+
+class SubscriptionCursor(NamedTuple):
+    """The polling state that moves every time we poll a user.
+    """
+    user_id: int
+    latest_tweet_id: Optional[int]
+    tweets_per_day: Optional[float]
+
+
+class ChannelSubscription(NamedTuple):
+    channel: str
+    user_id: int
+    # None for the default rule.
+    filter_rule: Optional[str] = None
+
+
+class SubscriptionRecord(NamedTuple):
+    """An active subscription the way it's exported and imported, with one record for each channel that's
+    subscribed to the user.
+    """
+    user_id: int
+    screen_name: str
+    latest_tweet_id: Optional[int]
+    tweets_per_day: Optional[float]
+    # None if no channel is subscribed to the user.
+    channel: Optional[str]
+    filter_rule: Optional[str]
+
+
+class Backfill(NamedTuple):
+    """The tweets in (since_id, max_id] of a user's timeline, which a poll skipped over. Once there's nothing
+    left to catch up on, since_id and max_id meet.
+    """
+    user_id: int
+    since_id: int
+    max_id: int
+
+    def is_done(self) -> bool:
+        return self.since_id >= self.max_id
+
+
+class AccountFailures(NamedTuple):
+    """How a user's account has been failing lately. Only failures that are about the account (it's suspended,
+    protected or gone) count, not those that are about Twitter or us.
+    """
+    user_id: int
+    # Zero once a poll works again, which clears everything else too.
+    consecutive_failures: int
+    reason: Optional[str]
+    # In seconds since the epoch, or None if the user isn't quarantined.
+    quarantined_until: Optional[float]
+    # Whether the user's channels were told about the quarantine.
+    notified: bool
+
+    def is_cleared(self) -> bool:
+        return self.consecutive_failures == 0
+
+
+class Lease(NamedTuple):
+    name: str
+    holder: Optional[str]
+    expires_at: datetime.datetime
+
+
+class PendingMessage(NamedTuple):
+    id: int
+    message: slack.OutgoingMessage
+    attempts: int
+    # In seconds since the epoch.
+    created_at: float
+    digest_user_id: Optional[int] = None
+
+
+@metrics.timed_methods(metrics.DB_CALL_LATENCY)
 class TwitterSubscriptionManager:
     @classmethod
-    async def subscribe(
+    async def subscribe_many(
         cls,
         connection: Connection,
         *,
-        user_id: int,
-        screen_name: str,
+        users: List[twitter.User],
     ) -> None:
+        """Like ``subscribe``, but for many users in one transaction, with a few statements per chunk of users.
+        """
+        if not users:
+            return
+
+        user_id_column = models.twitter_subscriptions.c.user_id
+        subscribed_at = datetime.datetime.utcnow()
+
         async with connection.transaction():
-            # This subscription might be inactive.
-            existing_subscription = await connection.fetch_one(
-                models.twitter_subscriptions
-                .select()
-                .where(models.twitter_subscriptions.c.user_id == user_id),
-            )
+            # Re-enabling subscriptions takes up the most parameters per user, with 8 more to reset their state.
+            chunk_size = _case_update_chunk_size(2, fixed_params=8)
+            for start in range(0, len(users), chunk_size):
+                chunk = users[start:start + chunk_size]
+                result = await connection.fetch_all(
+                    sa.select([
+                        user_id_column,
+                        models.twitter_subscriptions.c.unsubscribed_at,
+                    ])
+                    .where(user_id_column.in_([user.id for user in chunk])),
+                )
+                existing = {
+                    row[user_id_column]: row[models.twitter_subscriptions.c.unsubscribed_at] is None
+                    for row in result
+                }
 
-            if existing_subscription:
-                if existing_subscription[models.twitter_subscriptions.c.unsubscribed_at]:
-                    log.info('Re-enabling existing subscription for user ID %s (%s)', user_id, screen_name)
+                new_users = [user for user in chunk if user.id not in existing]
+                inactive_users = [user for user in chunk if existing.get(user.id) is False]
+                log.info(
+                    'Adding %s new subscriptions, re-enabling %s, and leaving %s as they are',
+                    len(new_users),
+                    len(inactive_users),
+                    len(chunk) - len(new_users) - len(inactive_users),
+                )
+
+                if new_users:
+                    await connection.execute(
+                        models.twitter_subscriptions
+                        .insert()
+                        .values([
+                            {
+                                'user_id': user.id,
+                                'screen_name': user.screen_name,
+                                'screen_name_lower': user.screen_name.lower(),
+                                'subscribed_at': subscribed_at,
+                            }
+                            for user in new_users
+                        ]),
+                    )
+
+                if inactive_users:
                     await connection.execute(
                         models.twitter_subscriptions
                         .update()
-                        .where(models.twitter_subscriptions.c.user_id == user_id)
+                        .where(user_id_column.in_([user.id for user in inactive_users]))
                         .values(
-                            screen_name=screen_name,
-                            subscribed_at=datetime.datetime.utcnow(),
+                            screen_name=sa.case(
+                                {user.id: user.screen_name for user in inactive_users},
+                                value=user_id_column,
+                            ),
+                            screen_name_lower=sa.case(
+                                {user.id: user.screen_name.lower() for user in inactive_users},
+                                value=user_id_column,
+                            ),
+                            subscribed_at=subscribed_at,
                             unsubscribed_at=None,
+                            backfill_since_id=None,
+                            backfill_max_id=None,
+                            consecutive_failures=None,
+                            failure_reason=None,
+                            quarantined_until=None,
+                            quarantine_notified=None,
                         ),
                     )
-                else:
-                    log.info('User ID %s (%s) already has an active subscription', user_id, screen_name)
-            else:
-                log.info('Adding new subscription for user ID %s (%s)', user_id, screen_name)
+
+    @classmethod
+    async def list_user_ids_by_screen_names(
+        cls,
+        connection: Connection,
+        *,
+        screen_names: List[str],
+    ) -> List[int]:
+        """Returns the IDs of the subscribed and unsubscribed users whose screen names in our DB match any of these,
+        ignoring case. Screen names the DB has never seen are left out.
+        """
+        screen_names_lower = sorted({screen_name.lower() for screen_name in screen_names})
+        user_ids: List[int] = []
+        for start in range(0, len(screen_names_lower), BULK_SELECT_CHUNK_SIZE):
+            result = await connection.fetch_all(
+                sa.select([models.twitter_subscriptions.c.user_id])
+                .where(
+                    models.twitter_subscriptions.c.screen_name_lower.in_(
+                        screen_names_lower[start:start + BULK_SELECT_CHUNK_SIZE],
+                    ),
+                ),
+            )
+            user_ids.extend(row[models.twitter_subscriptions.c.user_id] for row in result)
+
+        return user_ids
+
+    @classmethod
+    async def unsubscribe(
+        cls,
+        connection: Connection,
+        *,
+        user_ids: List[int],
+    ) -> None:
+        if not user_ids:
+            return
+
+        log.info('Unsubscribing from %s users', len(user_ids))
+        log.debug('Unsubscribing from user IDs %s', user_ids)
+        unsubscribed_at = datetime.datetime.utcnow()
+        async with connection.transaction():
+            for start in range(0, len(user_ids), BULK_SELECT_CHUNK_SIZE):
                 await connection.execute(
                     models.twitter_subscriptions
-                    .insert()
+                    .update()
+                    .where(models.twitter_subscriptions.c.user_id.in_(user_ids[start:start + BULK_SELECT_CHUNK_SIZE]))
+                    .values(
+                        unsubscribed_at=unsubscribed_at,
+                        latest_tweet_id=None,
+                        refreshed_latest_tweet_id_at=None,
+                        tweets_per_day=None,
+                        backfill_since_id=None,
+                        backfill_max_id=None,
+                        consecutive_failures=None,
+                        failure_reason=None,
+                        quarantined_until=None,
+                        quarantine_notified=None,
+                    ),
+                )
+
+    @classmethod
+    async def update_screen_names(
+        cls,
+        connection: Connection,
+        *,
+        users: List[twitter.User],
+    ) -> None:
+        if not users:
+            return
+
+        log.info('Updating screen names of %s users', len(users))
+        user_id_column = models.twitter_subscriptions.c.user_id
+
+        async with connection.transaction():
+            chunk_size = _case_update_chunk_size(2)
+            for start in range(0, len(users), chunk_size):
+                chunk = users[start:start + chunk_size]
+                await connection.execute(
+                    models.twitter_subscriptions
+                    .update()
+                    .where(user_id_column.in_([user.id for user in chunk]))
+                    .values(
+                        screen_name=sa.case(
+                            {user.id: user.screen_name for user in chunk},
+                            value=user_id_column,
+                        ),
+                        screen_name_lower=sa.case(
+                            {user.id: user.screen_name.lower() for user in chunk},
+                            value=user_id_column,
+                        ),
+                    ),
+                )
+
+    @classmethod
+    async def get_screen_names_of_active_subscriptions(
+        cls,
+        connection: Connection,
+    ) -> Dict[int, Optional[str]]:
+        result = await connection.fetch_all(
+            sa.select([
+                models.twitter_subscriptions.c.user_id,
+                models.twitter_subscriptions.c.screen_name,
+            ])
+            .where(
+                models.twitter_subscriptions.c.unsubscribed_at.is_(None),
+            ),
+        )
+        return {
+            row[models.twitter_subscriptions.c.user_id]: row[models.twitter_subscriptions.c.screen_name]
+            for row in result
+        }
+
+    @classmethod
+    async def get_latest_tweet_ids_for_user_ids(
+        cls,
+        connection: Connection,
+        *,
+        user_ids: List[int],
+    ) -> Dict[int, Optional[int]]:
+        latest_tweet_ids: Dict[int, Optional[int]] = {}
+        for start in range(0, len(user_ids), BULK_SELECT_CHUNK_SIZE):
+            result = await connection.fetch_all(
+                sa.select([
+                    models.twitter_subscriptions.c.user_id,
+                    models.twitter_subscriptions.c.latest_tweet_id,
+                ])
+                .where(models.twitter_subscriptions.c.user_id.in_(user_ids[start:start + BULK_SELECT_CHUNK_SIZE])),
+            )
+            latest_tweet_ids.update(
+                (row[models.twitter_subscriptions.c.user_id], row[models.twitter_subscriptions.c.latest_tweet_id])
+                for row in result
+            )
+
+        return latest_tweet_ids
+
+    @classmethod
+    async def get_latest_tweet_ids_of_active_subscriptions(
+        cls,
+        connection: Connection,
+    ) -> Dict[int, Optional[int]]:
+        result = await connection.fetch_all(
+            sa.select([
+                models.twitter_subscriptions.c.user_id,
+                models.twitter_subscriptions.c.latest_tweet_id,
+            ])
+            .where(
+                models.twitter_subscriptions.c.unsubscribed_at.is_(None),
+            ),
+        )
+        return {
+            row[models.twitter_subscriptions.c.user_id]: row[models.twitter_subscriptions.c.latest_tweet_id]
+            for row in result
+        }
+
+    @classmethod
+    async def update_latest_tweet_ids(
+        cls,
+        connection: Connection,
+        *,
+        cursors: List[SubscriptionCursor],
+    ) -> None:
+        """Writes back a whole polling cycle's worth of cursors in one transaction, using a CASE expression
+        so that each chunk of users costs a single statement.
+        """
+        if not cursors:
+            return
+
+        log.info('Updating latest tweet IDs of %s users', len(cursors))
+        refreshed_at = datetime.datetime.utcnow()
+        user_id_column = models.twitter_subscriptions.c.user_id
+
+        async with connection.transaction():
+            chunk_size = _case_update_chunk_size(2, fixed_params=1)
+            for start in range(0, len(cursors), chunk_size):
+                chunk = cursors[start:start + chunk_size]
+                await connection.execute(
+                    models.twitter_subscriptions
+                    .update()
+                    .where(user_id_column.in_([cursor.user_id for cursor in chunk]))
+                    .values(
+                        refreshed_latest_tweet_id_at=refreshed_at,
+                        latest_tweet_id=sa.case(
+                            {cursor.user_id: cursor.latest_tweet_id for cursor in chunk},
+                            value=user_id_column,
+                        ),
+                        tweets_per_day=sa.case(
+                            {cursor.user_id: cursor.tweets_per_day for cursor in chunk},
+                            value=user_id_column,
+                        ),
+                    ),
+                )
+
+    @classmethod
+    async def update_backfills(
+        cls,
+        connection: Connection,
+        *,
+        backfills: List[Backfill],
+    ) -> None:
+        if not backfills:
+            return
+
+        user_id_column = models.twitter_subscriptions.c.user_id
+
+        async with connection.transaction():
+            chunk_size = _case_update_chunk_size(2)
+            for start in range(0, len(backfills), chunk_size):
+                chunk = backfills[start:start + chunk_size]
+                await connection.execute(
+                    models.twitter_subscriptions
+                    .update()
+                    .where(user_id_column.in_([backfill.user_id for backfill in chunk]))
                     .values(
-                        user_id=user_id,
-                        screen_name=screen_name,
-                        subscribed_at=datetime.datetime.utcnow(),
+                        backfill_since_id=sa.case(
+                            {backfill.user_id: None if backfill.is_done() else backfill.since_id for backfill in chunk},
+                            value=user_id_column,
+                        ),
+                        backfill_max_id=sa.case(
+                            {backfill.user_id: None if backfill.is_done() else backfill.max_id for backfill in chunk},
+                            value=user_id_column,
+                        ),
                     ),
                 )
 
+    @classmethod
+    async def list_backfills_of_active_subscriptions(
+        cls,
+        connection: Connection,
+    ) -> List[Backfill]:
+        result = await connection.fetch_all(
+            sa.select([
+                models.twitter_subscriptions.c.user_id,
+                models.twitter_subscriptions.c.backfill_since_id,
+                models.twitter_subscriptions.c.backfill_max_id,
+            ])
+            .where(models.twitter_subscriptions.c.unsubscribed_at.is_(None))
+            .where(models.twitter_subscriptions.c.backfill_max_id.isnot(None)),
+        )
+        return [
+            Backfill(
+                user_id=row[models.twitter_subscriptions.c.user_id],
+                since_id=row[models.twitter_subscriptions.c.backfill_since_id],
+                max_id=row[models.twitter_subscriptions.c.backfill_max_id],
+            )
+            for row in result
+        ]
+
+    @classmethod
+    async def update_account_failures(
+        cls,
+        connection: Connection,
+        *,
+        failures: List[AccountFailures],
+    ) -> None:
+        if not failures:
+            return
+
+        user_id_column = models.twitter_subscriptions.c.user_id
+
+        async with connection.transaction():
+            chunk_size = _case_update_chunk_size(4)
+            for start in range(0, len(failures), chunk_size):
+                chunk = failures[start:start + chunk_size]
+                await connection.execute(
+                    models.twitter_subscriptions
+                    .update()
+                    .where(user_id_column.in_([failure.user_id for failure in chunk]))
+                    .values(
+                        consecutive_failures=sa.case(
+                            {
+                                failure.user_id: None if failure.is_cleared() else failure.consecutive_failures
+                                for failure in chunk
+                            },
+                            value=user_id_column,
+                        ),
+                        failure_reason=sa.case(
+                            {failure.user_id: failure.reason for failure in chunk},
+                            value=user_id_column,
+                        ),
+                        quarantined_until=sa.case(
+                            {failure.user_id: _from_timestamp(failure.quarantined_until) for failure in chunk},
+                            value=user_id_column,
+                        ),
+                        quarantine_notified=sa.case(
+                            {failure.user_id: None if failure.is_cleared() else failure.notified for failure in chunk},
+                            value=user_id_column,
+                        ),
+                    ),
+                )
+
+    @classmethod
+    async def list_account_failures_of_active_subscriptions(
+        cls,
+        connection: Connection,
+    ) -> List[AccountFailures]:
+        result = await connection.fetch_all(
+            sa.select([
+                models.twitter_subscriptions.c.user_id,
+                models.twitter_subscriptions.c.consecutive_failures,
+                models.twitter_subscriptions.c.failure_reason,
+                models.twitter_subscriptions.c.quarantined_until,
+                models.twitter_subscriptions.c.quarantine_notified,
+            ])
+            .where(models.twitter_subscriptions.c.unsubscribed_at.is_(None))
+            .where(models.twitter_subscriptions.c.consecutive_failures > 0),
+        )
+        return [
+            AccountFailures(
+                user_id=row[models.twitter_subscriptions.c.user_id],
+                consecutive_failures=row[models.twitter_subscriptions.c.consecutive_failures],
+                reason=row[models.twitter_subscriptions.c.failure_reason],
+                quarantined_until=_to_timestamp(row[models.twitter_subscriptions.c.quarantined_until]),
+                notified=bool(row[models.twitter_subscriptions.c.quarantine_notified]),
+            )
+            for row in result
+        ]
+
+    @classmethod
+    async def list_active_subscriptions(
+        cls,
+        connection: Connection,
+    ) -> List[ActiveSubscription]:
+        result = await connection.fetch_all(
+            sa.select([
+                models.twitter_subscriptions.c.user_id,
+                models.twitter_subscriptions.c.tweets_per_day,
+                models.twitter_subscriptions.c.refreshed_latest_tweet_id_at,
+            ])
+            .where(
+                models.twitter_subscriptions.c.unsubscribed_at.is_(None),
+            ),
+        )
+        return [
+            ActiveSubscription(
+                user_id=row[models.twitter_subscriptions.c.user_id],
+                tweets_per_day=row[models.twitter_subscriptions.c.tweets_per_day],
+                refreshed_latest_tweet_id_at=_to_timestamp(row[models.twitter_subscriptions.c.refreshed_latest_tweet_id_at]),
+            )
+            for row in result
+        ]
+
+    @classmethod
+    async def list_subscription_records(
+        cls,
+        connection: Connection,
+        *,
+        after_user_id: Optional[int],
+        limit: int,
+    ) -> List[SubscriptionRecord]:
+        """Returns the records of up to ``limit`` active subscriptions with user IDs after ``after_user_id``, in order
+        of user ID, so that they can be paged through a page per statement instead of in one long transaction.
+        """
+        subscriptions = models.twitter_subscriptions
+        page = (
+            sa.select([subscriptions.c.user_id])
+            .where(subscriptions.c.unsubscribed_at.is_(None))
+            .order_by(subscriptions.c.user_id)
+            .limit(limit)
+        )
+        if after_user_id is not None:
+            page = page.where(subscriptions.c.user_id > after_user_id)
+
+        result = await connection.fetch_all(
+            sa.select([
+                subscriptions.c.user_id,
+                subscriptions.c.screen_name,
+                subscriptions.c.latest_tweet_id,
+                subscriptions.c.tweets_per_day,
+                models.channel_subscriptions.c.channel,
+                models.channel_subscriptions.c.filter_rule,
+            ])
+            .select_from(
+                subscriptions.outerjoin(
+                    models.channel_subscriptions,
+                    models.channel_subscriptions.c.user_id == subscriptions.c.user_id,
+                ),
+            )
+            .where(subscriptions.c.user_id.in_(page))
+            .order_by(subscriptions.c.user_id, models.channel_subscriptions.c.channel),
+        )
+        return [
+            SubscriptionRecord(
+                user_id=row[subscriptions.c.user_id],
+                screen_name=row[subscriptions.c.screen_name],
+                latest_tweet_id=row[subscriptions.c.latest_tweet_id],
+                tweets_per_day=row[subscriptions.c.tweets_per_day],
+                channel=row[models.channel_subscriptions.c.channel],
+                filter_rule=row[models.channel_subscriptions.c.filter_rule],
+            )
+            for row in result
+        ]
+
+    @classmethod
+    async def import_subscriptions(
+        cls,
+        connection: Connection,
+        *,
+        records: List[SubscriptionRecord],
+    ) -> None:
+        """Like ``subscribe_many``, but the subscriptions come with their cursors. New and inactive subscriptions
+        start from the imported cursors, while active ones only ever move forward to them, so that importing an old
+        export doesn't post the same tweets again.
+        """
+        if not records:
+            return
+
+        # Every channel's record of a user has the same cursor.
+        records = list({record.user_id: record for record in records}.values())
+        user_id_column = models.twitter_subscriptions.c.user_id
+        subscribed_at = datetime.datetime.utcnow()
+
+        async with connection.transaction():
+            new_records = []
+            inactive_records = []
+            behind_records = []
+            for start in range(0, len(records), BULK_SELECT_CHUNK_SIZE):
+                chunk = records[start:start + BULK_SELECT_CHUNK_SIZE]
+                result = await connection.fetch_all(
+                    sa.select([
+                        user_id_column,
+                        models.twitter_subscriptions.c.unsubscribed_at,
+                        models.twitter_subscriptions.c.latest_tweet_id,
+                    ])
+                    .where(user_id_column.in_([record.user_id for record in chunk])),
+                )
+                existing_rows = {row[user_id_column]: row for row in result}
+
+                for record in chunk:
+                    row = existing_rows.get(record.user_id)
+                    if row is None:
+                        new_records.append(record)
+                    elif row[models.twitter_subscriptions.c.unsubscribed_at] is not None:
+                        inactive_records.append(record)
+                    elif record.latest_tweet_id is not None and (
+                        row[models.twitter_subscriptions.c.latest_tweet_id] or 0
+                    ) < record.latest_tweet_id:
+                        behind_records.append(record)
+
+            log.info(
+                'Importing %s new subscriptions, re-enabling %s, moving %s cursors forward, and leaving %s as they are',
+                len(new_records),
+                len(inactive_records),
+                len(behind_records),
+                len(records) - len(new_records) - len(inactive_records) - len(behind_records),
+            )
+
+            await _insert_many(
+                connection,
+                models.twitter_subscriptions,
+                [
+                    {
+                        'user_id': record.user_id,
+                        'screen_name': record.screen_name,
+                        'screen_name_lower': record.screen_name.lower(),
+                        'subscribed_at': subscribed_at,
+                        'latest_tweet_id': record.latest_tweet_id,
+                        'tweets_per_day': record.tweets_per_day,
+                    }
+                    for record in new_records
+                ],
+            )
+
+            chunk_size = _case_update_chunk_size(4, fixed_params=8)
+            for start in range(0, len(inactive_records), chunk_size):
+                chunk = inactive_records[start:start + chunk_size]
+                await connection.execute(
+                    models.twitter_subscriptions
+                    .update()
+                    .where(user_id_column.in_([record.user_id for record in chunk]))
+                    .values(
+                        screen_name=sa.case(
+                            {record.user_id: record.screen_name for record in chunk},
+                            value=user_id_column,
+                        ),
+                        screen_name_lower=sa.case(
+                            {record.user_id: record.screen_name.lower() for record in chunk},
+                            value=user_id_column,
+                        ),
+                        latest_tweet_id=sa.case(
+                            {record.user_id: record.latest_tweet_id for record in chunk},
+                            value=user_id_column,
+                        ),
+                        tweets_per_day=sa.case(
+                            {record.user_id: record.tweets_per_day for record in chunk},
+                            value=user_id_column,
+                        ),
+                        subscribed_at=subscribed_at,
+                        unsubscribed_at=None,
+                        backfill_since_id=None,
+                        backfill_max_id=None,
+                        consecutive_failures=None,
+                        failure_reason=None,
+                        quarantined_until=None,
+                        quarantine_notified=None,
+                    ),
+                )
+
+            chunk_size = _case_update_chunk_size(1)
+            for start in range(0, len(behind_records), chunk_size):
+                chunk = behind_records[start:start + chunk_size]
+                await connection.execute(
+                    models.twitter_subscriptions
+                    .update()
+                    .where(user_id_column.in_([record.user_id for record in chunk]))
+                    .values(
+                        latest_tweet_id=sa.case(
+                            {record.user_id: record.latest_tweet_id for record in chunk},
+                            value=user_id_column,
+                        ),
+                    ),
+                )
+
+
+@metrics.timed_methods(metrics.DB_CALL_LATENCY)
+class ChannelSubscriptionManager:
+    @classmethod
+    async def subscribe(
+        cls,
+        connection: Connection,
+        *,
+        channel: str,
+        user_ids: List[int],
+    ) -> None:
+        if not user_ids:
+            return
+
+        subscribed_at = datetime.datetime.utcnow()
+        async with connection.transaction():
+            for start in range(0, len(user_ids), BULK_INSERT_CHUNK_SIZE):
+                chunk = user_ids[start:start + BULK_INSERT_CHUNK_SIZE]
+                result = await connection.fetch_all(
+                    sa.select([models.channel_subscriptions.c.user_id])
+                    .where(models.channel_subscriptions.c.channel == channel)
+                    .where(models.channel_subscriptions.c.user_id.in_(chunk)),
+                )
+                existing_user_ids = {row[models.channel_subscriptions.c.user_id] for row in result}
+
+                new_user_ids = [user_id for user_id in chunk if user_id not in existing_user_ids]
+                if not new_user_ids:
+                    continue
+
+                log.info('Subscribing channel %s to %s user IDs', channel, len(new_user_ids))
+                await connection.execute(
+                    models.channel_subscriptions
+                    .insert()
+                    .values([
+                        {'channel': channel, 'user_id': user_id, 'subscribed_at': subscribed_at}
+                        for user_id in new_user_ids
+                    ]),
+                )
+
     @classmethod
     async def unsubscribe(
         cls,
         connection: Connection,
         *,
-        screen_name: str,
+        channel: str,
+        user_ids: List[int],
     ) -> None:
-        """We unsubscribe based on the screen name in our DB instead of the user ID because
-        screen names can change, and users can get into bad states (ex: suspended) that prevent
-        us from fetching their ID.
+        if not user_ids:
+            return
+
+        log.info('Unsubscribing channel %s from %s users', channel, len(user_ids))
+        log.debug('Unsubscribing channel %s from user IDs %s', channel, user_ids)
+        async with connection.transaction():
+            for start in range(0, len(user_ids), BULK_SELECT_CHUNK_SIZE):
+                await connection.execute(
+                    models.channel_subscriptions
+                    .delete()
+                    .where(models.channel_subscriptions.c.channel == channel)
+                    .where(models.channel_subscriptions.c.user_id.in_(user_ids[start:start + BULK_SELECT_CHUNK_SIZE])),
+                )
+
+    @classmethod
+    async def filter_subscribed(
+        cls,
+        connection: Connection,
+        *,
+        user_ids: List[int],
+    ) -> Set[int]:
+        """Returns which of the given user IDs at least one channel is subscribed to.
+        """
+        subscribed: Set[int] = set()
+        for start in range(0, len(user_ids), BULK_SELECT_CHUNK_SIZE):
+            result = await connection.fetch_all(
+                sa.select([models.channel_subscriptions.c.user_id])
+                .where(models.channel_subscriptions.c.user_id.in_(user_ids[start:start + BULK_SELECT_CHUNK_SIZE]))
+                .distinct(),
+            )
+            subscribed.update(row[models.channel_subscriptions.c.user_id] for row in result)
+
+        return subscribed
+
+    @classmethod
+    async def list_channel_subscriptions(
+        cls,
+        connection: Connection,
+    ) -> List[ChannelSubscription]:
+        result = await connection.fetch_all(
+            sa.select([
+                models.channel_subscriptions.c.channel,
+                models.channel_subscriptions.c.user_id,
+                models.channel_subscriptions.c.filter_rule,
+            ]),
+        )
+        return [
+            ChannelSubscription(
+                channel=row[models.channel_subscriptions.c.channel],
+                user_id=row[models.channel_subscriptions.c.user_id],
+                filter_rule=row[models.channel_subscriptions.c.filter_rule],
+            )
+            for row in result
+        ]
+
+    @classmethod
+    async def set_filter_rule(
+        cls,
+        connection: Connection,
+        *,
+        channel: str,
+        user_ids: List[int],
+        filter_rule: Optional[str],
+    ) -> Set[int]:
+        """Sets the rule of the channel's subscriptions to the given users, and returns which of the users the
+        channel is subscribed to.
         """
-        log.info('Unsubscribing from screen name %s', screen_name)
+        subscribed: Set[int] = set()
+        async with connection.transaction():
+            for start in range(0, len(user_ids), BULK_SELECT_CHUNK_SIZE):
+                chunk = user_ids[start:start + BULK_SELECT_CHUNK_SIZE]
+                result = await connection.fetch_all(
+                    sa.select([models.channel_subscriptions.c.user_id])
+                    .where(models.channel_subscriptions.c.channel == channel)
+                    .where(models.channel_subscriptions.c.user_id.in_(chunk)),
+                )
+                subscribed.update(row[models.channel_subscriptions.c.user_id] for row in result)
+
+                await connection.execute(
+                    models.channel_subscriptions
+                    .update()
+                    .where(models.channel_subscriptions.c.channel == channel)
+                    .where(models.channel_subscriptions.c.user_id.in_(chunk))
+                    .values(filter_rule=filter_rule),
+                )
+
+        return subscribed
+
+    @classmethod
+    async def import_subscriptions(
+        cls,
+        connection: Connection,
+        *,
+        subscriptions: List[ChannelSubscription],
+    ) -> None:
+        """Like ``subscribe``, but for any number of channels, and the subscriptions come with their filter rules,
+        which replace those of existing subscriptions.
+        """
+        if not subscriptions:
+            return
+
+        subscriptions = list({
+            (subscription.channel, subscription.user_id): subscription
+            for subscription in subscriptions
+        }.values())
+        user_ids = sorted({subscription.user_id for subscription in subscriptions})
+        subscribed_at = datetime.datetime.utcnow()
+
+        async with connection.transaction():
+            existing_filter_rules: Dict[Tuple[str, int], Optional[str]] = {}
+            for start in range(0, len(user_ids), BULK_SELECT_CHUNK_SIZE):
+                result = await connection.fetch_all(
+                    sa.select([
+                        models.channel_subscriptions.c.channel,
+                        models.channel_subscriptions.c.user_id,
+                        models.channel_subscriptions.c.filter_rule,
+                    ])
+                    .where(models.channel_subscriptions.c.user_id.in_(user_ids[start:start + BULK_SELECT_CHUNK_SIZE])),
+                )
+                existing_filter_rules.update(
+                    (
+                        (row[models.channel_subscriptions.c.channel], row[models.channel_subscriptions.c.user_id]),
+                        row[models.channel_subscriptions.c.filter_rule],
+                    )
+                    for row in result
+                )
+
+            new_subscriptions = []
+            # The user IDs whose rule changes, by channel and new rule.
+            changed_user_ids: Dict[Tuple[str, Optional[str]], List[int]] = {}
+            for subscription in subscriptions:
+                key = (subscription.channel, subscription.user_id)
+                if key not in existing_filter_rules:
+                    new_subscriptions.append(subscription)
+                elif existing_filter_rules[key] != subscription.filter_rule:
+                    changed_user_ids.setdefault((subscription.channel, subscription.filter_rule), []).append(
+                        subscription.user_id,
+                    )
+
+            log.info(
+                'Importing %s channel subscriptions, and changing the filter rules of %s',
+                len(new_subscriptions),
+                sum(len(user_ids) for user_ids in changed_user_ids.values()),
+            )
+            await _insert_many(
+                connection,
+                models.channel_subscriptions,
+                [
+                    {
+                        'channel': subscription.channel,
+                        'user_id': subscription.user_id,
+                        'subscribed_at': subscribed_at,
+                        'filter_rule': subscription.filter_rule,
+                    }
+                    for subscription in new_subscriptions
+                ],
+            )
+
+            for (channel, filter_rule), changed in changed_user_ids.items():
+                for start in range(0, len(changed), BULK_SELECT_CHUNK_SIZE):
+                    await connection.execute(
+                        models.channel_subscriptions
+                        .update()
+                        .where(models.channel_subscriptions.c.channel == channel)
+                        .where(models.channel_subscriptions.c.user_id.in_(changed[start:start + BULK_SELECT_CHUNK_SIZE]))
+                        .values(filter_rule=filter_rule),
+                    )
+
+    @classmethod
+    async def assign_unrouted_subscriptions(
+        cls,
+        connection: Connection,
+        *,
+        channel: str,
+    ) -> None:
+        """Subscribes the channel to every active subscription that no channel is subscribed to, which is what
+        subscriptions from before channels were tracked look like.
+        """
+        unrouted = (
+            sa.select([
+                sa.literal(channel),
+                models.twitter_subscriptions.c.user_id,
+                sa.literal(datetime.datetime.utcnow()),
+            ])
+            .where(models.twitter_subscriptions.c.unsubscribed_at.is_(None))
+            .where(
+                ~sa.exists()
+                .where(models.channel_subscriptions.c.user_id == models.twitter_subscriptions.c.user_id),
+            )
+        )
         await connection.execute(
-            models.twitter_subscriptions
+            models.channel_subscriptions
+            .insert()
+            .from_select(['channel', 'user_id', 'subscribed_at'], unrouted),
+        )
+
+
+@metrics.timed_methods(metrics.DB_CALL_LATENCY)
+class OutboxManager:
+    @classmethod
+    async def add_messages(
+        cls,
+        connection: Connection,
+        *,
+        messages: List[slack.OutgoingMessage],
+        digest_user_ids: Optional[List[Optional[int]]] = None,
+    ) -> None:
+        """``digest_user_ids``, if given, has one entry per message, for the user whose tweet it's about.
+        """
+        if not messages:
+            return
+
+        log.info('Adding %s messages to the outbox', len(messages))
+        created_at = datetime.datetime.utcnow()
+        if digest_user_ids is None:
+            digest_user_ids = [None] * len(messages)
+        async with connection.transaction():
+            for start in range(0, len(messages), BULK_INSERT_CHUNK_SIZE):
+                end = start + BULK_INSERT_CHUNK_SIZE
+                await connection.execute(
+                    models.outbox
+                    .insert()
+                    .values([
+                        {
+                            'channel': message.channel,
+                            'text': message.text,
+                            'created_at': created_at,
+                            'attempts': 0,
+                            'digest_user_id': digest_user_id,
+                        }
+                        for message, digest_user_id in zip(messages[start:end], digest_user_ids[start:end])
+                    ]),
+                )
+
+    @classmethod
+    async def list_pending(
+        cls,
+        connection: Connection,
+        *,
+        limit: int,
+        max_attempts: int,
+        include_digests: bool = True,
+    ) -> List[PendingMessage]:
+        """Messages come back oldest first, so that every channel gets its messages in order. Without
+        ``include_digests``, messages that digest mode holds back are left out.
+        """
+        query = (
+            models.outbox
+            .select()
+            .where(models.outbox.c.sent_at.is_(None))
+            .where(models.outbox.c.attempts < max_attempts)
+        )
+        if not include_digests:
+            query = query.where(models.outbox.c.digest_user_id.is_(None))
+
+        result = await connection.fetch_all(query.order_by(models.outbox.c.id).limit(limit))
+        return [_pending_message_from_row(row) for row in result]
+
+    @classmethod
+    async def list_ready_digests(
+        cls,
+        connection: Connection,
+        *,
+        created_before: datetime.datetime,
+        min_size: int,
+        limit: int,
+        max_attempts: int,
+    ) -> List[PendingMessage]:
+        """Returns the pending messages of up to ``limit`` digests, each being up to ``min_size`` of a channel's
+        messages about one user, that are ready to go out: either their oldest message was created before
+        ``created_before``, or there are at least ``min_size`` of them. Messages come back oldest first.
+        """
+        pending = sa.and_(
+            models.outbox.c.sent_at.is_(None),
+            models.outbox.c.attempts < max_attempts,
+            models.outbox.c.digest_user_id.isnot(None),
+        )
+        groups = await connection.fetch_all(
+            sa.select([models.outbox.c.channel, models.outbox.c.digest_user_id])
+            .where(pending)
+            .group_by(models.outbox.c.channel, models.outbox.c.digest_user_id)
+            .having(
+                sa.or_(
+                    sa.func.min(models.outbox.c.created_at) < created_before,
+                    sa.func.count() >= min_size,
+                ),
+            )
+            # The digests that have been waiting longest go first.
+            .order_by(sa.func.min(models.outbox.c.created_at))
+            .limit(limit),
+        )
+        if not groups:
+            return []
+
+        # Each digest holds at most min_size messages, and the rest wait for the next one.
+        ranked = (
+            sa.select([
+                models.outbox.c.id,
+                sa.func.row_number().over(
+                    partition_by=[models.outbox.c.channel, models.outbox.c.digest_user_id],
+                    order_by=models.outbox.c.id,
+                ).label('position'),
+            ])
+            .where(pending)
+            .where(
+                sa.or_(*(
+                    sa.and_(
+                        models.outbox.c.channel == row[models.outbox.c.channel],
+                        models.outbox.c.digest_user_id == row[models.outbox.c.digest_user_id],
+                    )
+                    for row in groups
+                )),
+            )
+            .alias('ranked')
+        )
+        result = await connection.fetch_all(
+            models.outbox
+            .select()
+            .where(models.outbox.c.id.in_(sa.select([ranked.c.id]).where(ranked.c.position <= min_size)))
+            .order_by(models.outbox.c.id),
+        )
+        return [_pending_message_from_row(row) for row in result]
+
+    @classmethod
+    async def mark_sent(
+        cls,
+        connection: Connection,
+        *,
+        ids: List[int],
+    ) -> None:
+        if not ids:
+            return
+
+        await connection.execute(
+            models.outbox
             .update()
-            .where(models.twitter_subscriptions.c.screen_name.ilike(screen_name))
+            .where(models.outbox.c.id.in_(ids))
             .values(
-                unsubscribed_at=datetime.datetime.utcnow(),
-                latest_tweet_id=None,
-                refreshed_latest_tweet_id_at=None,
+                sent_at=datetime.datetime.utcnow(),
+                attempts=models.outbox.c.attempts + 1,
             ),
         )
 
     @classmethod
-    async def update_screen_name(
+    async def record_failed_attempts(
         cls,
         connection: Connection,
         *,
-        user_id: int,
-        screen_name: str,
-    ) -> None:
+        ids: List[int],
+        max_attempts: int,
+    ) -> List[PendingMessage]:
+        """Returns the messages that this was the last of their ``max_attempts``, which won't be tried again.
+        """
+        if not ids:
+            return []
+
+        log.warning('Failed to deliver outbox messages: %s', ids)
         await connection.execute(
-            models.twitter_subscriptions
+            models.outbox
             .update()
-            .where(models.twitter_subscriptions.c.user_id == user_id)
+            .where(models.outbox.c.id.in_(ids))
             .values(
-                screen_name=screen_name,
+                attempts=models.outbox.c.attempts + 1,
             ),
         )
+        result = await connection.fetch_all(
+            models.outbox
+            .select()
+            .where(models.outbox.c.id.in_(ids))
+            .where(models.outbox.c.attempts >= max_attempts),
+        )
+        return [_pending_message_from_row(row) for row in result]
 
     @classmethod
-    async def get_latest_tweet_id_for_user_id(
+    async def delete_finished_before(
         cls,
         connection: Connection,
         *,
-        user_id: int
-    ) -> int:
-        subscription = await connection.fetch_one(
-            models.twitter_subscriptions
-            .select()
-            .where(models.twitter_subscriptions.c.user_id == user_id),
+        before: datetime.datetime,
+        max_attempts: int,
+    ) -> None:
+        """Deletes the messages that were sent before ``before``, and the ones created before it that ran out of
+        attempts without being sent.
+        """
+        await connection.execute(
+            models.outbox
+            .delete()
+            .where(
+                sa.or_(
+                    models.outbox.c.sent_at < before,
+                    sa.and_(
+                        models.outbox.c.sent_at.is_(None),
+                        models.outbox.c.attempts >= max_attempts,
+                        models.outbox.c.created_at < before,
+                    ),
+                ),
+            ),
         )
 
-        return subscription[models.twitter_subscriptions.c.latest_tweet_id]
+
+@metrics.timed_methods(metrics.DB_CALL_LATENCY)
+class DeliveredContentManager:
+    @classmethod
+    async def filter_delivered(
+        cls,
+        connection: Connection,
+        *,
+        channel: str,
+        content_tweet_ids: List[int],
+    ) -> Set[int]:
+        """Returns which of the given content tweet IDs have already been posted to the channel.
+        """
+        delivered: Set[int] = set()
+        for start in range(0, len(content_tweet_ids), BULK_SELECT_CHUNK_SIZE):
+            result = await connection.fetch_all(
+                sa.select([models.delivered_content.c.content_tweet_id])
+                .where(models.delivered_content.c.channel == channel)
+                .where(
+                    models.delivered_content.c.content_tweet_id.in_(
+                        content_tweet_ids[start:start + BULK_SELECT_CHUNK_SIZE],
+                    ),
+                ),
+            )
+            delivered.update(row[models.delivered_content.c.content_tweet_id] for row in result)
+
+        return delivered
+
+    @classmethod
+    async def record_delivered(
+        cls,
+        connection: Connection,
+        *,
+        channel: str,
+        content_tweet_ids: List[int],
+    ) -> None:
+        if not content_tweet_ids:
+            return
+
+        delivered_at = datetime.datetime.utcnow()
+        async with connection.transaction():
+            for start in range(0, len(content_tweet_ids), BULK_INSERT_CHUNK_SIZE):
+                await connection.execute(
+                    models.delivered_content
+                    .insert()
+                    .values([
+                        {
+                            'channel': channel,
+                            'content_tweet_id': content_tweet_id,
+                            'delivered_at': delivered_at,
+                        }
+                        for content_tweet_id in content_tweet_ids[start:start + BULK_INSERT_CHUNK_SIZE]
+                    ]),
+                )
 
     @classmethod
-    async def update_latest_tweet_id(
+    async def delete_delivered_before(
         cls,
         connection: Connection,
         *,
-        user_id: int,
-        latest_tweet_id: int,
+        before: datetime.datetime,
     ) -> None:
-        log.info('Updating latest tweet ID of user %s to %s', user_id, latest_tweet_id)
         await connection.execute(
-            models.twitter_subscriptions
-            .update()
-            .where(models.twitter_subscriptions.c.user_id == user_id)
-            .values(
-                refreshed_latest_tweet_id_at=datetime.datetime.utcnow(),
-                latest_tweet_id=latest_tweet_id,
-            ),
+            models.delivered_content
+            .delete()
+            .where(models.delivered_content.c.delivered_at < before),
         )
 
+
+@metrics.timed_methods(metrics.DB_CALL_LATENCY)
+class LeaseManager:
     @classmethod
-    async def list_user_ids_of_active_subscriptions(
+    async def record_heartbeat(
         cls,
         connection: Connection,
-    ) -> List[int]:
+        *,
+        instance_id: str,
+        now: datetime.datetime,
+    ) -> None:
+        async with connection.transaction():
+            existing_instance = await connection.fetch_one(
+                models.instances
+                .select()
+                .where(models.instances.c.id == instance_id),
+            )
+            if existing_instance:
+                await connection.execute(
+                    models.instances
+                    .update()
+                    .where(models.instances.c.id == instance_id)
+                    .values(heartbeat_at=now),
+                )
+            else:
+                log.info('Registering new instance %s', instance_id)
+                await connection.execute(
+                    models.instances
+                    .insert()
+                    .values(id=instance_id, heartbeat_at=now),
+                )
+
+    @classmethod
+    async def list_live_instance_ids(
+        cls,
+        connection: Connection,
+        *,
+        since: datetime.datetime,
+    ) -> List[str]:
         result = await connection.fetch_all(
-            models.twitter_subscriptions
+            sa.select([models.instances.c.id])
+            .where(models.instances.c.heartbeat_at >= since)
+            .order_by(models.instances.c.id),
+        )
+        return [row[models.instances.c.id] for row in result]
+
+    @classmethod
+    async def delete_instances_before(
+        cls,
+        connection: Connection,
+        *,
+        before: datetime.datetime,
+    ) -> None:
+        await connection.execute(
+            models.instances
+            .delete()
+            .where(models.instances.c.heartbeat_at < before),
+        )
+
+    @classmethod
+    async def list_leases(
+        cls,
+        connection: Connection,
+        *,
+        names: List[str],
+    ) -> Dict[str, Lease]:
+        """Returns the given leases, creating the ones that don't exist yet as released.
+        """
+        result = await connection.fetch_all(
+            models.leases
             .select()
+            .where(models.leases.c.name.in_(names)),
+        )
+        leases = {
+            row[models.leases.c.name]: Lease(
+                name=row[models.leases.c.name],
+                holder=row[models.leases.c.holder],
+                expires_at=row[models.leases.c.expires_at],
+            )
+            for row in result
+        }
+
+        missing_names = [name for name in names if name not in leases]
+        if missing_names:
+            released_at = datetime.datetime.utcfromtimestamp(0)
+            await connection.execute(
+                models.leases
+                .insert()
+                .values([{'name': name, 'holder': None, 'expires_at': released_at} for name in missing_names]),
+            )
+            for name in missing_names:
+                leases[name] = Lease(name=name, holder=None, expires_at=released_at)
+
+        return leases
+
+    @classmethod
+    async def acquire_leases(
+        cls,
+        connection: Connection,
+        *,
+        names: List[str],
+        holder: str,
+        now: datetime.datetime,
+        expires_at: datetime.datetime,
+    ) -> None:
+        """Takes or renews whichever of the given leases are released, expired or already ours.
+
+        Callers should check which ones they got by listing the leases again in the same transaction.
+        """
+        if not names:
+            return
+
+        await connection.execute(
+            models.leases
+            .update()
+            .where(models.leases.c.name.in_(names))
             .where(
-                models.twitter_subscriptions.c.unsubscribed_at.is_(None),
-            ),
+                sa.or_(
+                    models.leases.c.holder == holder,
+                    models.leases.c.holder.is_(None),
+                    models.leases.c.expires_at <= now,
+                ),
+            )
+            .values(holder=holder, expires_at=expires_at),
+        )
+
+    @classmethod
+    async def release_leases(
+        cls,
+        connection: Connection,
+        *,
+        names: List[str],
+        holder: str,
+    ) -> None:
+        if not names:
+            return
+
+        await connection.execute(
+            models.leases
+            .update()
+            .where(models.leases.c.name.in_(names))
+            .where(models.leases.c.holder == holder)
+            .values(holder=None),
         )
-        return [row[models.twitter_subscriptions.c.user_id] for row in result]
+
+
+def _case_update_chunk_size(case_count: int, fixed_params: int = 0) -> int:
+    """How many rows fit in an UPDATE that picks them with an IN, which takes up 1 parameter per row, and sets
+    ``case_count`` columns to a CASE over them, which take up 2 each (for the WHEN and the THEN).
+    """
+    return (MAX_BOUND_PARAMETERS - fixed_params) // (1 + 2 * case_count)
+
+
+async def _insert_many(connection: Connection, table: sa.Table, rows: List[Dict[str, Any]]) -> None:
+    """Inserts rows that all have the same keys, as multi-row INSERTs that each bind as many parameters as SQLite
+    allows.
+    """
+    if not rows:
+        return
+
+    chunk_size = MAX_BOUND_PARAMETERS // len(rows[0])
+    for start in range(0, len(rows), chunk_size):
+        await connection.execute(table.insert().values(rows[start:start + chunk_size]))
+
+
+def _pending_message_from_row(row: Mapping) -> PendingMessage:
+    return PendingMessage(
+        id=row[models.outbox.c.id],
+        message=slack.OutgoingMessage(
+            channel=row[models.outbox.c.channel],
+            text=row[models.outbox.c.text],
+        ),
+        attempts=row[models.outbox.c.attempts],
+        # Unlike the other timestamps, this one is never NULL.
+        created_at=row[models.outbox.c.created_at].replace(tzinfo=datetime.timezone.utc).timestamp(),
+        digest_user_id=row[models.outbox.c.digest_user_id],
+    )
+
+
+def _from_timestamp(timestamp: Optional[float]) -> Optional[datetime.datetime]:
+    if timestamp is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+
+def _to_timestamp(dt: Optional[datetime.datetime]) -> Optional[float]:
+    """Our DateTime columns hold naive UTC datetimes.
+    """
+    if dt is None:
+        return None
+    return dt.replace(tzinfo=datetime.timezone.utc).timestamp()
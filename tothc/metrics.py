@@ -0,0 +1,372 @@
+"""Metrics about the bot's hot paths, served in the Prometheus text format.
+
+Metrics are always collected, since it's just a few additions per call. They're only served when something
+starts a ``MetricsServer``.
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import TypeVar
+
+from aiohttp import web
+
+
+log = logging.getLogger(__name__)
+
+# The same buckets as the official Prometheus clients, which suit request latencies.
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+CYCLE_DURATION_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+T = TypeVar('T', bound=type)
+M = TypeVar('M', bound='_Metric')
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+
+    pairs = ','.join(
+        '{}="{}"'.format(name, value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for name, value in zip(names, values)
+    )
+    return f'{{{pairs}}}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    name: str
+    documentation: str
+    label_names: Tuple[str, ...]
+    type_name: str
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'Metric {self.name} takes labels {self.label_names}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type_name}',
+        ]
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+    _values: Dict[LabelValues, float]
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        # Unlabelled metrics start out at 0, rather than missing until they're first touched.
+        self._values = {} if self.label_names else {(): 0}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        if amount < 0:
+            raise ValueError(f'Counter {self.name} can only go up, not by {amount}')
+
+        key = self._label_values(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_samples(self) -> Iterable[str]:
+        for key, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+
+
+class Gauge(_Metric):
+    """A value that goes up and down. Unlabelled gauges can instead be read from a function when scraped.
+    """
+    type_name = 'gauge'
+    _values: Dict[LabelValues, float]
+    _function: Optional[Callable[[], float]]
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        # Gauges have no sensible starting value, so they're missing until they're first set.
+        self._values = {}
+        self._function = None
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._label_values(labels)] = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        if self.label_names:
+            raise ValueError(f'Gauge {self.name} has labels, so it cannot be read from a function')
+        self._function = function
+
+    def _render_samples(self) -> Iterable[str]:
+        if self._function is not None:
+            yield f'{self.name} {_format_value(self._function())}'
+            return
+
+        for key, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+
+
+class _HistogramValues:
+    __slots__ = ('bucket_counts', 'sum', 'count')
+
+    def __init__(self, bucket_count: int) -> None:
+        self.bucket_counts = [0] * bucket_count
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+    _buckets: Tuple[float, ...]
+    _values: Dict[LabelValues, _HistogramValues]
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        *,
+        buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, label_names)
+        self._buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {} if self.label_names else {(): _HistogramValues(len(self._buckets))}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        values = self._values.get(key)
+        if values is None:
+            values = self._values[key] = _HistogramValues(len(self._buckets))
+
+        # Buckets are stored non-cumulatively, and summed up when rendered.
+        values.bucket_counts[bisect.bisect_left(self._buckets, value)] += 1
+        values.sum += value
+        values.count += 1
+
+    def _render_samples(self) -> Iterable[str]:
+        bucket_label_names = self.label_names + ('le',)
+        for key, values in self._values.items():
+            cumulative_count = 0
+            for upper_bound, count in zip(self._buckets, values.bucket_counts):
+                cumulative_count += count
+                labels = _format_labels(bucket_label_names, key + (_format_value(upper_bound),))
+                yield f'{self.name}_bucket{labels} {cumulative_count}'
+
+            labels = _format_labels(self.label_names, key)
+            yield f'{self.name}_sum{labels} {_format_value(values.sum)}'
+            yield f'{self.name}_count{labels} {values.count}'
+
+
+class Registry:
+    _metrics: Dict[str, _Metric]
+
+    def __init__(self) -> None:
+        self._metrics = {}
+
+    def register(self, metric: _Metric) -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _registered(metric: M) -> M:
+    REGISTRY.register(metric)
+    return metric
+
+
+TWITTER_REQUEST_LATENCY = _registered(Histogram(
+    'tothc_twitter_request_seconds',
+    'How long Twitter API calls take.',
+    ['method'],
+))
+TWITTER_RATE_LIMIT_REMAINING = _registered(Gauge(
+    'tothc_twitter_rate_limit_remaining',
+    "How many timeline requests are left in each Twitter credential's current rate limit window.",
+    ['credential'],
+))
+TWITTER_CREDENTIALS_PARKED = _registered(Counter(
+    'tothc_twitter_credentials_parked_total',
+    'How many times each Twitter credential was parked for hitting its rate limit.',
+    ['credential'],
+))
+TWITTER_ACCOUNT_ERRORS = _registered(Counter(
+    'tothc_twitter_account_errors_total',
+    'Timeline requests that failed because of the account, by whether it was suspended, protected or gone.',
+    ['reason'],
+))
+QUARANTINED_USERS = _registered(Gauge(
+    'tothc_quarantined_users',
+    "How many users aren't being polled for now, because their accounts kept failing.",
+))
+TWITTER_USER_CACHE_LOOKUPS = _registered(Counter(
+    'tothc_twitter_user_cache_lookups_total',
+    'Twitter user lookups by screen name, by whether the user was cached.',
+    ['result'],
+))
+DB_CALL_LATENCY = _registered(Histogram(
+    'tothc_db_call_seconds',
+    'How long each manager call takes, including waiting for the DB.',
+    ['method'],
+))
+SLACK_REQUEST_LATENCY = _registered(Histogram(
+    'tothc_slack_request_seconds',
+    'How long Slack API calls take.',
+    ['method'],
+))
+SLACK_MESSAGE_QUEUE_DEPTH = _registered(Gauge(
+    'tothc_slack_message_queue_depth',
+    'How many incoming Slack messages are waiting to be handled.',
+))
+SLACK_MESSAGES_DROPPED = _registered(Counter(
+    'tothc_slack_messages_dropped_total',
+    'Incoming Slack messages that were dropped, because they were duplicates or there was no room for them.',
+    ['reason'],
+))
+SLACK_COMMAND_LATENCY = _registered(Histogram(
+    'tothc_slack_command_seconds',
+    'How long Slack commands take from being received to being handled.',
+    ['command'],
+))
+POLL_CYCLE_DURATION = _registered(Histogram(
+    'tothc_poll_cycle_seconds',
+    'How long it takes to poll a batch of due users, from fetching their timelines to queueing up their tweets.',
+    buckets=CYCLE_DURATION_BUCKETS,
+))
+ACTIVE_SUBSCRIPTIONS = _registered(Gauge(
+    'tothc_active_subscriptions',
+    'How many Twitter users are being polled.',
+))
+TWEETS_FETCHED = _registered(Counter(
+    'tothc_tweets_fetched_total',
+    'New tweets fetched from timelines.',
+))
+TWEETS_STREAMED = _registered(Counter(
+    'tothc_tweets_streamed_total',
+    "Tweets by subscribed users that came in through Twitter's filtered stream.",
+))
+TWITTER_STREAM_CONNECTED = _registered(Gauge(
+    'tothc_twitter_stream_connected',
+    "Whether Twitter's filtered stream is connected.",
+))
+TWITTER_STREAM_COVERED_USERS = _registered(Gauge(
+    'tothc_twitter_stream_covered_users',
+    "How many users are covered by Twitter's filtered stream, and don't need to be polled.",
+))
+TWEETS_FILTERED = _registered(Counter(
+    'tothc_tweets_filtered_total',
+    'New tweets that were not worth posting to Slack.',
+))
+MESSAGES_DELIVERED = _registered(Counter(
+    'tothc_messages_delivered_total',
+    'Messages successfully posted to Slack.',
+))
+MESSAGES_GIVEN_UP = _registered(Counter(
+    'tothc_messages_given_up_total',
+    'Messages that ran out of attempts without being posted to Slack.',
+))
+DIGESTS_DELIVERED = _registered(Counter(
+    'tothc_digests_delivered_total',
+    "Digests posted to Slack, each one standing in for several of a user's tweets.",
+))
+
+
+def timed(histogram: Histogram, **labels: str) -> Callable:
+    """Decorates a coroutine function so that each call's duration is observed, whether or not it raised.
+    """
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            started_at = time.monotonic()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                histogram.observe(time.monotonic() - started_at, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_methods(histogram: Histogram) -> Callable[[T], T]:
+    """Decorates a class so that all its coroutine classmethods are timed, labelled ``ClassName.method``.
+    """
+    def decorator(cls: T) -> T:
+        for name, attribute in list(vars(cls).items()):
+            if isinstance(attribute, classmethod) and asyncio.iscoroutinefunction(attribute.__func__):
+                method = timed(histogram, method=f'{cls.__name__}.{name}')(attribute.__func__)
+                setattr(cls, name, classmethod(method))
+        return cls
+
+    return decorator
+
+
+class MetricsServer:
+    """Serves the registry's metrics at ``/metrics``.
+    """
+    _host: str
+    _port: int
+    _registry: Registry
+    _runner: Optional[web.AppRunner]
+
+    def __init__(
+        self,
+        *,
+        port: int,
+        host: str = '0.0.0.0',
+        registry: Registry = REGISTRY,
+    ) -> None:
+        self._host = host
+        self._port = port
+        self._registry = registry
+        self._runner = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/metrics', self._metrics)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+        log.info('Serving metrics on %s:%s', self._host, self._port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=self._registry.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
@@ -0,0 +1,285 @@
+"""Versioned changes to the DB schema, applied in order at startup.
+
+Each migration is written against the schema as it was when the migration was added, so it spells out the tables
+and columns it creates rather than reading them from tothc.models, which only describes the latest schema.
+"""
+import datetime
+import logging
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Set
+
+import sqlalchemy as sa
+from databases.core import Connection
+from sqlalchemy.engine.interfaces import Dialect
+
+from tothc import models
+
+
+log = logging.getLogger(__name__)
+
+# Any constant will do, as long as nothing else sharing a Postgres DB takes the same advisory lock.
+MIGRATIONS_LOCK_ID = 0x7074_6863
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[Connection, Dialect], Awaitable[None]]
+
+
+async def list_existing_columns(conn: Connection, dialect: Dialect) -> Dict[str, Set[str]]:
+    existing_columns: Dict[str, Set[str]] = {}
+    if dialect.name == 'sqlite':
+        tables = await conn.fetch_all("SELECT name FROM sqlite_master WHERE type = 'table'")
+        for table in tables:
+            columns = await conn.fetch_all(f'PRAGMA table_info({table["name"]})')
+            existing_columns[table['name']] = {column['name'] for column in columns}
+    else:
+        columns = await conn.fetch_all(
+            'SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = current_schema()',
+        )
+        for column in columns:
+            existing_columns.setdefault(column['table_name'], set()).add(column['column_name'])
+
+    return existing_columns
+
+
+async def create_table(conn: Connection, dialect: Dialect, table: sa.Table) -> None:
+    log.info('Creating table %s', table.name)
+    await conn.execute(str(sa.schema.CreateTable(table).compile(dialect=dialect)))
+    for index in table.indexes:
+        await conn.execute(str(sa.schema.CreateIndex(index).compile(dialect=dialect)))
+
+
+async def add_column(conn: Connection, dialect: Dialect, table_name: str, column: sa.Column) -> None:
+    log.info('Adding column %s.%s', table_name, column.name)
+    column_type = column.type.compile(dialect=dialect)
+    await conn.execute(f'ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}')
+
+
+# The schema as it was before migrations. Nothing should change this, since migration 1 has to keep meaning the
+# same thing.
+_BASELINE_TWITTER_SUBSCRIPTIONS = sa.Table(
+    'twitter_subscriptions',
+    sa.MetaData(),
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('user_id', sa.Integer, nullable=False, unique=True),
+    sa.Column('screen_name', sa.String),
+    sa.Column('subscribed_at', sa.DateTime, nullable=False),
+    sa.Column('unsubscribed_at', sa.DateTime),
+    sa.Column('latest_tweet_id', sa.Integer),
+    sa.Column('refreshed_latest_tweet_id_at', sa.DateTime),
+)
+
+
+async def _create_baseline_schema(conn: Connection, dialect: Dialect) -> None:
+    existing_columns = await list_existing_columns(conn, dialect)
+    if _BASELINE_TWITTER_SUBSCRIPTIONS.name not in existing_columns:
+        await create_table(conn, dialect, _BASELINE_TWITTER_SUBSCRIPTIONS)
+
+
+async def _create_table_if_missing(conn: Connection, dialect: Dialect, table: sa.Table) -> None:
+    """Migrations 2 to 5 make changes that startup used to make itself, by creating missing tables and adding
+    missing columns, before there were migrations. So a DB from back then might already have them.
+    """
+    existing_columns = await list_existing_columns(conn, dialect)
+    if table.name not in existing_columns:
+        await create_table(conn, dialect, table)
+
+
+async def _add_tweet_rates(conn: Connection, dialect: Dialect) -> None:
+    existing_columns = await list_existing_columns(conn, dialect)
+    if 'tweets_per_day' not in existing_columns['twitter_subscriptions']:
+        await add_column(conn, dialect, 'twitter_subscriptions', sa.Column('tweets_per_day', sa.Float))
+
+
+async def _add_outbox(conn: Connection, dialect: Dialect) -> None:
+    await _create_table_if_missing(
+        conn,
+        dialect,
+        sa.Table(
+            'outbox',
+            sa.MetaData(),
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('channel', sa.String, nullable=False),
+            sa.Column('text', sa.String, nullable=False),
+            sa.Column('created_at', sa.DateTime, nullable=False),
+            sa.Column('sent_at', sa.DateTime, index=True),
+            sa.Column('attempts', sa.Integer, nullable=False),
+        ),
+    )
+
+
+async def _add_delivered_content(conn: Connection, dialect: Dialect) -> None:
+    await _create_table_if_missing(
+        conn,
+        dialect,
+        sa.Table(
+            'delivered_content',
+            sa.MetaData(),
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('channel', sa.String, nullable=False),
+            sa.Column('content_tweet_id', sa.BigInteger, nullable=False),
+            sa.Column('delivered_at', sa.DateTime, nullable=False, index=True),
+            sa.UniqueConstraint('channel', 'content_tweet_id'),
+        ),
+    )
+
+
+async def _add_leases(conn: Connection, dialect: Dialect) -> None:
+    metadata = sa.MetaData()
+    await _create_table_if_missing(
+        conn,
+        dialect,
+        sa.Table(
+            'leases',
+            metadata,
+            sa.Column('name', sa.String, primary_key=True),
+            sa.Column('holder', sa.String),
+            sa.Column('expires_at', sa.DateTime, nullable=False),
+        ),
+    )
+    await _create_table_if_missing(
+        conn,
+        dialect,
+        sa.Table(
+            'instances',
+            metadata,
+            sa.Column('id', sa.String, primary_key=True),
+            sa.Column('heartbeat_at', sa.DateTime, nullable=False, index=True),
+        ),
+    )
+
+
+async def _index_active_subscriptions(conn: Connection, dialect: Dialect) -> None:
+    await conn.execute(
+        'CREATE INDEX ix_twitter_subscriptions_active ON twitter_subscriptions (user_id) '
+        'WHERE unsubscribed_at IS NULL',
+    )
+
+
+async def _add_lower_case_screen_names(conn: Connection, dialect: Dialect) -> None:
+    await add_column(conn, dialect, 'twitter_subscriptions', sa.Column('screen_name_lower', sa.String))
+    await conn.execute('UPDATE twitter_subscriptions SET screen_name_lower = lower(screen_name)')
+    await conn.execute(
+        'CREATE INDEX ix_twitter_subscriptions_screen_name_lower ON twitter_subscriptions (screen_name_lower)',
+    )
+
+
+async def _widen_twitter_ids(conn: Connection, dialect: Dialect) -> None:
+    """Twitter IDs are 64-bit. SQLite's integers already are, but Postgres' aren't.
+    """
+    if dialect.name == 'sqlite':
+        return
+
+    await conn.execute(
+        'ALTER TABLE twitter_subscriptions '
+        'ALTER COLUMN user_id TYPE BIGINT, '
+        'ALTER COLUMN latest_tweet_id TYPE BIGINT',
+    )
+
+
+async def _add_channel_subscriptions(conn: Connection, dialect: Dialect) -> None:
+    """Subscriptions made before this don't say which channel they're for. The bot hands them to its default
+    channel at startup, since the DB doesn't know what that is.
+    """
+    await create_table(
+        conn,
+        dialect,
+        sa.Table(
+            'channel_subscriptions',
+            sa.MetaData(),
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('channel', sa.String, nullable=False),
+            sa.Column('user_id', sa.BigInteger, nullable=False, index=True),
+            sa.Column('subscribed_at', sa.DateTime, nullable=False),
+            sa.UniqueConstraint('channel', 'user_id'),
+        ),
+    )
+
+
+async def _add_backfills(conn: Connection, dialect: Dialect) -> None:
+    await add_column(conn, dialect, 'twitter_subscriptions', sa.Column('backfill_since_id', sa.BigInteger))
+    await add_column(conn, dialect, 'twitter_subscriptions', sa.Column('backfill_max_id', sa.BigInteger))
+
+
+async def _add_account_failures(conn: Connection, dialect: Dialect) -> None:
+    columns = (
+        sa.Column('consecutive_failures', sa.Integer),
+        sa.Column('failure_reason', sa.String),
+        sa.Column('quarantined_until', sa.DateTime),
+        sa.Column('quarantine_notified', sa.Boolean),
+    )
+    for column in columns:
+        await add_column(conn, dialect, 'twitter_subscriptions', column)
+
+
+async def _add_outbox_digests(conn: Connection, dialect: Dialect) -> None:
+    await add_column(conn, dialect, 'outbox', sa.Column('digest_user_id', sa.BigInteger))
+
+
+async def _add_filter_rules(conn: Connection, dialect: Dialect) -> None:
+    await add_column(conn, dialect, 'channel_subscriptions', sa.Column('filter_rule', sa.String))
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, 'Create the subscriptions table', _create_baseline_schema),
+    Migration(2, 'Add tweet rates', _add_tweet_rates),
+    Migration(3, 'Add the outbox', _add_outbox),
+    Migration(4, 'Add delivered content', _add_delivered_content),
+    Migration(5, 'Add leases and instances', _add_leases),
+    Migration(6, 'Index active subscriptions', _index_active_subscriptions),
+    Migration(7, 'Add lower-case screen names', _add_lower_case_screen_names),
+    Migration(8, 'Widen Twitter IDs to 64 bits', _widen_twitter_ids),
+    Migration(9, 'Add per-channel subscriptions', _add_channel_subscriptions),
+    Migration(10, 'Add timeline backfills', _add_backfills),
+    Migration(11, 'Add account failures', _add_account_failures),
+    Migration(12, 'Add outbox digests', _add_outbox_digests),
+    Migration(13, 'Add filter rules', _add_filter_rules),
+]
+
+
+async def _list_applied_versions(conn: Connection) -> Set[int]:
+    result = await conn.fetch_all(sa.select([models.schema_migrations.c.version]))
+    return {row[models.schema_migrations.c.version] for row in result}
+
+
+async def _lock_migrations(conn: Connection, dialect: Dialect) -> None:
+    """Makes other instances sharing the DB wait until we're done migrating, rather than apply the same migrations.
+    Postgres lets us hold an advisory lock until the transaction ends. SQLite only has one writer at a time anyway,
+    so a second process that tries to migrate at the same time fails on its first write, rather than migrate twice.
+    """
+    if dialect.name == 'postgresql':
+        await conn.execute(f'SELECT pg_advisory_xact_lock({MIGRATIONS_LOCK_ID})')
+
+
+async def run_migrations(conn: Connection, dialect: Dialect) -> None:
+    """Applies the pending migrations in one transaction, so that the DB is either fully migrated or left as it was.
+    """
+    async with conn.transaction():
+        await _lock_migrations(conn, dialect)
+
+        existing_columns = await list_existing_columns(conn, dialect)
+        if models.schema_migrations.name not in existing_columns:
+            await create_table(conn, dialect, models.schema_migrations)
+
+        applied_versions = await _list_applied_versions(conn)
+        for migration in MIGRATIONS:
+            if migration.version in applied_versions:
+                continue
+
+            log.info('Applying migration %s: %s', migration.version, migration.description)
+            await migration.apply(conn, dialect)
+            await conn.execute(
+                models.schema_migrations
+                .insert()
+                .values(
+                    version=migration.version,
+                    description=migration.description,
+                    applied_at=datetime.datetime.utcnow(),
+                ),
+            )
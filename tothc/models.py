@@ -7,14 +7,110 @@ twitter_subscriptions = sa.Table(
     'twitter_subscriptions',
     metadata,
     sa.Column('id', sa.Integer, primary_key=True),
-    sa.Column('user_id', sa.Integer, nullable=False, unique=True),
+    sa.Column('user_id', sa.BigInteger, nullable=False, unique=True),
     sa.Column('screen_name', sa.String),
+    # Screen names are case insensitive, so this is what we look them up by.
+    sa.Column('screen_name_lower', sa.String, index=True),
 
     # We only care about the latest round of subscribing/unsubscribing.
     sa.Column('subscribed_at', sa.DateTime, nullable=False),
     sa.Column('unsubscribed_at', sa.DateTime),
 
     # This state clears after unsubscribing.
-    sa.Column('latest_tweet_id', sa.Integer),
+    sa.Column('latest_tweet_id', sa.BigInteger),
     sa.Column('refreshed_latest_tweet_id_at', sa.DateTime),
+    # Moving average of how often the user tweets, which determines how often we poll them.
+    sa.Column('tweets_per_day', sa.Float),
+    # When a poll gets more new tweets than fit on a page, the ones it skipped over, (since_id, max_id], are
+    # caught up on later.
+    sa.Column('backfill_since_id', sa.BigInteger),
+    sa.Column('backfill_max_id', sa.BigInteger),
+    # Polls that failed in a row because of something about the account (it's suspended, protected or gone), and
+    # until when the account is quarantined because of that. Everyone gets told once when it's quarantined.
+    sa.Column('consecutive_failures', sa.Integer),
+    sa.Column('failure_reason', sa.String),
+    sa.Column('quarantined_until', sa.DateTime),
+    sa.Column('quarantine_notified', sa.Boolean),
+
+    # Most subscriptions are eventually inactive, and the poller only ever cares about the active ones.
+    sa.Index(
+        'ix_twitter_subscriptions_active',
+        'user_id',
+        sqlite_where=sa.text('unsubscribed_at IS NULL'),
+        postgresql_where=sa.text('unsubscribed_at IS NULL'),
+    ),
+)
+
+# The Slack channels that each Twitter user's tweets get posted to. A user's subscription above stays active for
+# as long as at least one channel is subscribed to them.
+channel_subscriptions = sa.Table(
+    'channel_subscriptions',
+    metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('channel', sa.String, nullable=False),
+    sa.Column('user_id', sa.BigInteger, nullable=False, index=True),
+    sa.Column('subscribed_at', sa.DateTime, nullable=False),
+    # Which of the user's tweets the channel gets, or null for the default rule. See tothc.filters.
+    sa.Column('filter_rule', sa.String),
+
+    sa.UniqueConstraint('channel', 'user_id'),
+)
+
+# Slack messages that the poller has committed to delivering, written in the same transaction as the
+# subscription cursors they came from.
+outbox = sa.Table(
+    'outbox',
+    metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('channel', sa.String, nullable=False),
+    sa.Column('text', sa.String, nullable=False),
+    sa.Column('created_at', sa.DateTime, nullable=False),
+    # Set on messages about a single subscribed user's tweet, which digest mode holds back to send together with
+    # that user's other tweets.
+    sa.Column('digest_user_id', sa.BigInteger),
+
+    # Pending messages haven't been sent yet.
+    sa.Column('sent_at', sa.DateTime, index=True),
+    sa.Column('attempts', sa.Integer, nullable=False, default=0),
+)
+
+# Tweets (or the tweets they're retweets of) that have already been posted to a channel, so that we post each
+# piece of content only once no matter how many subscriptions retweet it.
+delivered_content = sa.Table(
+    'delivered_content',
+    metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('channel', sa.String, nullable=False),
+    sa.Column('content_tweet_id', sa.BigInteger, nullable=False),
+    sa.Column('delivered_at', sa.DateTime, nullable=False, index=True),
+
+    sa.UniqueConstraint('channel', 'content_tweet_id'),
+)
+
+# Named claims that expire unless their holder keeps renewing them. When several bot instances share the DB,
+# they split the subscriptions into partitions, and each partition (and leadership) is a lease.
+leases = sa.Table(
+    'leases',
+    metadata,
+    sa.Column('name', sa.String, primary_key=True),
+    # The instance holding the lease, or NULL if it's been released.
+    sa.Column('holder', sa.String),
+    sa.Column('expires_at', sa.DateTime, nullable=False),
+)
+
+# Bot instances that share the DB, which heartbeat so that each can tell how many of them are alive.
+instances = sa.Table(
+    'instances',
+    metadata,
+    sa.Column('id', sa.String, primary_key=True),
+    sa.Column('heartbeat_at', sa.DateTime, nullable=False, index=True),
+)
+
+# The migrations in tothc.migrations that have been applied to the DB.
+schema_migrations = sa.Table(
+    'schema_migrations',
+    metadata,
+    sa.Column('version', sa.Integer, primary_key=True),
+    sa.Column('description', sa.String, nullable=False),
+    sa.Column('applied_at', sa.DateTime, nullable=False),
 )
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import time
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_BATCH_LINGER_SEC = 0.5
+
+
+class StageReport(NamedTuple):
+    name: str
+    processed: int
+    dropped: int
+    failed: int
+    timed_out: int
+    throughput_per_sec: float
+    # The deepest the stage's input queue got during the run.
+    max_queue_depth: int
+
+
+class PipelineReport(NamedTuple):
+    duration_sec: float
+    stages: List[StageReport]
+
+
+class Stage:
+    """One step of a pipeline.
+
+    The handler gets an item from the previous stage, and returns the item to pass on to the next one, or None
+    to drop it. Stages with a ``batch_size`` greater than 1 get lists of up to that many items instead, and
+    wait up to ``batch_linger_sec`` for a batch to fill up.
+    """
+    name: str
+    concurrency: int
+    timeout_sec: Optional[float]
+    batch_size: int
+    batch_linger_sec: float
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Any], Awaitable[Any]],
+        *,
+        concurrency: int = 1,
+        timeout_sec: Optional[float] = None,
+        batch_size: int = 1,
+        batch_linger_sec: float = DEFAULT_BATCH_LINGER_SEC,
+    ) -> None:
+        if concurrency < 1:
+            raise ValueError(f'Concurrency of stage {name} must be positive: {concurrency}')
+
+        self.name = name
+        # Annotated here rather than on the class, where mypy would take it for a method.
+        self.handler: Callable[[Any], Awaitable[Any]] = handler
+        self.concurrency = concurrency
+        self.timeout_sec = timeout_sec
+        self.batch_size = batch_size
+        self.batch_linger_sec = batch_linger_sec
+
+
+class _StageRun:
+    __slots__ = ('stage', 'queue', 'upstream_done', 'processed', 'dropped', 'failed', 'timed_out', 'max_queue_depth')
+
+    def __init__(self, stage: Stage, queue_size: int) -> None:
+        self.stage = stage
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        # Set once nothing more will be put into the queue, so that batches stop waiting to fill up.
+        self.upstream_done = asyncio.Event()
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.max_queue_depth = 0
+
+    async def put(self, item: Any) -> None:
+        await self.queue.put(item)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def report(self, duration_sec: float) -> StageReport:
+        return StageReport(
+            name=self.stage.name,
+            processed=self.processed,
+            dropped=self.dropped,
+            failed=self.failed,
+            timed_out=self.timed_out,
+            throughput_per_sec=self.processed / duration_sec if duration_sec > 0 else 0.0,
+            max_queue_depth=self.max_queue_depth,
+        )
+
+
+class Pipeline:
+    """Runs items through a sequence of stages connected by bounded queues.
+
+    Each stage has its own pool of workers. When a stage falls behind, its input queue fills up and the
+    workers of the stage before it block, all the way back to whoever's feeding the pipeline, so memory
+    use stays bounded by the queue sizes.
+    """
+    _stages: List[Stage]
+    _queue_size: int
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        *,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+    ) -> None:
+        self._stages = stages
+        self._queue_size = queue_size
+
+    async def run(self, items: Iterable[Any]) -> PipelineReport:
+        started_at = time.monotonic()
+        runs = [_StageRun(stage, self._queue_size) for stage in self._stages]
+
+        workers: List[List[asyncio.Task]] = []
+        for index, run in enumerate(runs):
+            next_run = runs[index + 1] if index + 1 < len(runs) else None
+            workers.append([
+                asyncio.create_task(self._worker(run, next_run))
+                for _ in range(run.stage.concurrency)
+            ])
+
+        try:
+            for item in items:
+                await runs[0].put(item)
+            runs[0].upstream_done.set()
+
+            # Workers only mark an item as done after passing its output on, so once a stage's queue is joined,
+            # everything it produced is already in the next stage's queue.
+            for index, (run, stage_workers) in enumerate(zip(runs, workers)):
+                await run.queue.join()
+                for worker in stage_workers:
+                    worker.cancel()
+                if index + 1 < len(runs):
+                    runs[index + 1].upstream_done.set()
+        finally:
+            for stage_workers in workers:
+                for worker in stage_workers:
+                    worker.cancel()
+            all_workers = [worker for stage_workers in workers for worker in stage_workers]
+            await asyncio.gather(*all_workers, return_exceptions=True)
+
+        duration_sec = time.monotonic() - started_at
+        return PipelineReport(
+            duration_sec=duration_sec,
+            stages=[run.report(duration_sec) for run in runs],
+        )
+
+    async def _worker(self, run: _StageRun, next_run: Optional[_StageRun]) -> None:
+        stage = run.stage
+        while True:
+            batch = await self._get_batch(run)
+            try:
+                handled = batch if stage.batch_size > 1 else batch[0]
+                if stage.timeout_sec is None:
+                    result = await stage.handler(handled)
+                else:
+                    result = await asyncio.wait_for(stage.handler(handled), timeout=stage.timeout_sec)
+            except asyncio.TimeoutError:
+                log.warning('Stage %s timed out after %ss', stage.name, stage.timeout_sec)
+                run.timed_out += len(batch)
+            except Exception:
+                log.exception('Stage %s failed', stage.name)
+                run.failed += len(batch)
+            else:
+                run.processed += len(batch)
+                if next_run is None:
+                    pass
+                elif result is None:
+                    run.dropped += len(batch)
+                else:
+                    await next_run.put(result)
+            finally:
+                for _ in batch:
+                    run.queue.task_done()
+
+    async def _get_batch(self, run: _StageRun) -> List[Any]:
+        batch = [await run.queue.get()]
+        if run.stage.batch_size <= 1:
+            return batch
+
+        deadline = time.monotonic() + run.stage.batch_linger_sec
+        while len(batch) < run.stage.batch_size:
+            if not run.queue.empty():
+                batch.append(run.queue.get_nowait())
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or run.upstream_done.is_set():
+                break
+
+            getter = asyncio.ensure_future(run.queue.get())
+            upstream_done = asyncio.ensure_future(run.upstream_done.wait())
+            try:
+                await asyncio.wait({getter, upstream_done}, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                upstream_done.cancel()
+                if not getter.done():
+                    getter.cancel()
+
+            if getter.done() and not getter.cancelled():
+                batch.append(getter.result())
+
+        return batch
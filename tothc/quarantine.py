@@ -0,0 +1,107 @@
+import logging
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+
+from tothc.managers import AccountFailures
+
+
+log = logging.getLogger(__name__)
+
+# Polls of an account have to fail this many times in a row before it's quarantined, so that one bad response
+# doesn't do it.
+QUARANTINE_AFTER_FAILURES = 3
+# The first quarantine lasts this long, and every failed probe after it doubles that, up to the max.
+BASE_QUARANTINE_SEC = 60 * 60
+MAX_QUARANTINE_SEC = 7 * 24 * 60 * 60
+
+
+def quarantine_duration_sec(consecutive_failures: int) -> float:
+    doublings = max(consecutive_failures - QUARANTINE_AFTER_FAILURES, 0)
+    return min(BASE_QUARANTINE_SEC * 2 ** min(doublings, 32), MAX_QUARANTINE_SEC)
+
+
+class QuarantineTracker:
+    """A circuit breaker per user, for accounts that Twitter says are suspended, protected or gone.
+
+    After QUARANTINE_AFTER_FAILURES failed polls in a row, a user stops being polled for a while. Once that's
+    over, their next poll is a probe: if it fails, they go back into quarantine for twice as long, and if it
+    works, everything is forgotten. Changes pile up until they're taken to be written to the DB.
+    """
+    _failures: Dict[int, AccountFailures]
+    _changes: Dict[int, AccountFailures]
+
+    def __init__(self) -> None:
+        self._failures = {}
+        self._changes = {}
+
+    def __len__(self) -> int:
+        return len(self._failures)
+
+    def sync(self, failures: Iterable[AccountFailures]) -> None:
+        self._failures = {failure.user_id: failure for failure in failures}
+        # Changes that haven't been written yet are newer than what the DB has.
+        for user_id, failure in self._changes.items():
+            if failure.is_cleared():
+                self._failures.pop(user_id, None)
+            else:
+                self._failures[user_id] = failure
+
+    def quarantined_user_ids(self, now: float) -> Set[int]:
+        return {
+            user_id
+            for user_id, failure in self._failures.items()
+            if failure.quarantined_until is not None and failure.quarantined_until > now
+        }
+
+    def record_failure(self, user_id: int, reason: str, now: float) -> AccountFailures:
+        previous = self._failures.get(user_id)
+        consecutive_failures = (previous.consecutive_failures if previous is not None else 0) + 1
+
+        quarantined_until: Optional[float] = None
+        if consecutive_failures >= QUARANTINE_AFTER_FAILURES:
+            quarantined_until = now + quarantine_duration_sec(consecutive_failures)
+            log.warning(
+                'Quarantining user %s for %.0fs after %s failures in a row, since the account is %s',
+                user_id,
+                quarantined_until - now,
+                consecutive_failures,
+                reason,
+            )
+
+        failure = AccountFailures(
+            user_id=user_id,
+            consecutive_failures=consecutive_failures,
+            reason=reason,
+            quarantined_until=quarantined_until,
+            notified=previous.notified if previous is not None else False,
+        )
+        self._failures[user_id] = failure
+        self._changes[user_id] = failure
+        return failure
+
+    def record_success(self, user_id: int) -> None:
+        if user_id not in self._failures:
+            return
+
+        log.info('User %s is back after %s failures', user_id, self._failures[user_id].consecutive_failures)
+        del self._failures[user_id]
+        self._changes[user_id] = AccountFailures(
+            user_id=user_id,
+            consecutive_failures=0,
+            reason=None,
+            quarantined_until=None,
+            notified=False,
+        )
+
+    def mark_notified(self, user_ids: Iterable[int]) -> None:
+        for user_id in user_ids:
+            failure = self._failures.get(user_id)
+            if failure is not None:
+                self._failures[user_id] = failure._replace(notified=True)
+
+    def take_changes(self) -> List[AccountFailures]:
+        changes, self._changes = list(self._changes.values()), {}
+        return changes
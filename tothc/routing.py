@@ -0,0 +1,130 @@
+import logging
+from typing import Dict
+from typing import Iterable
+from typing import Mapping
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from tothc import managers
+
+
+log = logging.getLogger(__name__)
+
+
+class ChannelRouter:
+    """Which Slack channels each Twitter user's tweets get posted to, and with which filter rules, so that a user
+    is fetched once no matter how many channels are subscribed to them.
+
+    Subscription commands update the router as they're handled, and periodic syncs with the DB (which pick up
+    commands handled by other instances) only touch the users whose channels changed.
+    """
+    _channels_by_user_id: Dict[int, Tuple[str, ...]]
+    # Only the channels that don't use the default rule.
+    _filter_rules_by_user_id: Dict[int, Dict[str, str]]
+    # Bumped on every local change, so that a sync can tell which changes it might not have seen.
+    _version: int
+    _changed_at_version: Dict[int, int]
+
+    def __init__(self) -> None:
+        self._channels_by_user_id = {}
+        self._filter_rules_by_user_id = {}
+        self._version = 0
+        self._changed_at_version = {}
+
+    def __len__(self) -> int:
+        return len(self._channels_by_user_id)
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def channels_of(self, user_id: int) -> Tuple[str, ...]:
+        return self._channels_by_user_id.get(user_id, ())
+
+    def filter_rules_of(self, user_id: int) -> Dict[str, Optional[str]]:
+        """Returns the rule of each channel subscribed to the user, which is None for the default rule.
+        """
+        filter_rules = self._filter_rules_by_user_id.get(user_id, {})
+        return {channel: filter_rules.get(channel) for channel in self.channels_of(user_id)}
+
+    def add(self, user_id: int, channel: str) -> None:
+        channels = self.channels_of(user_id)
+        if channel not in channels:
+            self._set_channels(user_id, set(channels) | {channel})
+            # New subscriptions start out with the default rule.
+            self._set_filter_rule(user_id, channel, None)
+        self._mark_changed(user_id)
+
+    def remove(self, user_id: int, channel: str) -> None:
+        channels = self.channels_of(user_id)
+        if channel in channels:
+            self._set_channels(user_id, set(channels) - {channel})
+            self._set_filter_rule(user_id, channel, None)
+        self._mark_changed(user_id)
+
+    def set_filter_rule(self, user_id: int, channel: str, filter_rule: Optional[str]) -> None:
+        if channel in self.channels_of(user_id):
+            self._set_filter_rule(user_id, channel, filter_rule)
+        self._mark_changed(user_id)
+
+    def sync(self, subscriptions: Iterable[managers.ChannelSubscription], version: int) -> int:
+        """Brings the router in line with the channel subscriptions read from the DB, and returns how many users'
+        channels changed.
+
+        ``version`` is what ``version`` was before the subscriptions were read. Users that changed locally since
+        then keep their local channels, since the DB read might have missed those changes.
+        """
+        channels_by_user_id: Dict[int, Set[str]] = {}
+        filter_rules_by_user_id: Dict[int, Dict[str, str]] = {}
+        for subscription in subscriptions:
+            channels_by_user_id.setdefault(subscription.user_id, set()).add(subscription.channel)
+            if subscription.filter_rule is not None:
+                filter_rules_by_user_id.setdefault(subscription.user_id, {})[subscription.channel] = subscription.filter_rule
+
+        changed_count = 0
+        for user_id in set(self._channels_by_user_id) | set(channels_by_user_id):
+            if self._changed_at_version.get(user_id, 0) > version:
+                continue
+
+            channels = tuple(sorted(channels_by_user_id.get(user_id, ())))
+            filter_rules = filter_rules_by_user_id.get(user_id, {})
+            if channels != self.channels_of(user_id) or filter_rules != self._filter_rules_by_user_id.get(user_id, {}):
+                self._set_channels(user_id, channels)
+                self._set_filter_rules(user_id, filter_rules)
+                changed_count += 1
+
+        self._changed_at_version = {
+            user_id: changed_at
+            for user_id, changed_at in self._changed_at_version.items()
+            if changed_at > version
+        }
+
+        if changed_count:
+            log.info('Updated the channels of %s users', changed_count)
+        return changed_count
+
+    def _set_channels(self, user_id: int, channels: Iterable[str]) -> None:
+        channels = tuple(sorted(channels))
+        if channels:
+            self._channels_by_user_id[user_id] = channels
+        else:
+            self._channels_by_user_id.pop(user_id, None)
+
+    def _set_filter_rule(self, user_id: int, channel: str, filter_rule: Optional[str]) -> None:
+        filter_rules = dict(self._filter_rules_by_user_id.get(user_id, {}))
+        if filter_rule is None:
+            filter_rules.pop(channel, None)
+        else:
+            filter_rules[channel] = filter_rule
+        self._set_filter_rules(user_id, filter_rules)
+
+    def _set_filter_rules(self, user_id: int, filter_rules: Mapping[str, str]) -> None:
+        if filter_rules:
+            self._filter_rules_by_user_id[user_id] = dict(filter_rules)
+        else:
+            self._filter_rules_by_user_id.pop(user_id, None)
+
+    def _mark_changed(self, user_id: int) -> None:
+        self._version += 1
+        self._changed_at_version[user_id] = self._version
@@ -0,0 +1,336 @@
+import heapq
+import logging
+from collections import OrderedDict
+from typing import Container
+from typing import Dict
+from typing import Iterable
+from typing import KeysView
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from tothc.clients.twitter import RateLimit
+from tothc.managers import ActiveSubscription
+from tothc.managers import Backfill
+
+
+log = logging.getLogger(__name__)
+
+# The timeline endpoint has a rate limit of 900 requests per 15 minute window, for each credential.
+# Until Twitter tells us otherwise through response headers, we assume a fresh window of that size.
+TWITTER_TIMELINE_WINDOW_REQUESTS = 900
+TWITTER_TIMELINE_WINDOW_SEC = 15 * 60
+
+# Bounds on how often a single user gets polled, regardless of how chatty they are.
+MIN_POLL_INTERVAL_SEC = 60
+MAX_POLL_INTERVAL_SEC = 30 * 60
+
+# Users we don't know anything about yet get polled at the old fixed sweep period.
+DEFAULT_POLL_INTERVAL_SEC = 100
+
+# We aim to see about this many new tweets per poll of a user.
+TARGET_TWEETS_PER_POLL = 1.0
+
+# How much weight the latest observation gets in the tweet rate's moving average.
+TWEET_RATE_SMOOTHING = 0.3
+
+# The scheduler never sleeps longer than this, so that it notices new subscriptions and rate limit changes.
+MAX_TICK_SEC = 60
+MIN_TICK_SEC = 1
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def poll_interval_for_tweet_rate(tweets_per_day: Optional[float]) -> float:
+    if tweets_per_day is None:
+        return DEFAULT_POLL_INTERVAL_SEC
+
+    if tweets_per_day <= 0:
+        return MAX_POLL_INTERVAL_SEC
+
+    interval = TARGET_TWEETS_PER_POLL * SECONDS_PER_DAY / tweets_per_day
+    return min(max(interval, MIN_POLL_INTERVAL_SEC), MAX_POLL_INTERVAL_SEC)
+
+
+def estimate_tweet_rate(
+    previous_tweets_per_day: Optional[float],
+    new_tweet_count: int,
+    elapsed_sec: float,
+) -> Optional[float]:
+    """Folds one observation (``new_tweet_count`` tweets over ``elapsed_sec``) into an exponentially weighted
+    moving average of the user's tweets per day.
+    """
+    if elapsed_sec <= 0:
+        return previous_tweets_per_day
+
+    observed = new_tweet_count * SECONDS_PER_DAY / elapsed_sec
+    if previous_tweets_per_day is None:
+        return observed
+
+    return TWEET_RATE_SMOOTHING * observed + (1 - TWEET_RATE_SMOOTHING) * previous_tweets_per_day
+
+
+class _UserSchedule:
+    __slots__ = ('tweets_per_day', 'last_polled_at', 'next_poll_at')
+
+    def __init__(
+        self,
+        tweets_per_day: Optional[float],
+        last_polled_at: Optional[float],
+        next_poll_at: float,
+    ) -> None:
+        self.tweets_per_day = tweets_per_day
+        self.last_polled_at = last_polled_at
+        self.next_poll_at = next_poll_at
+
+
+class PollScheduler:
+    """Decides which users to poll and when.
+
+    Every user has a next-poll time derived from their observed tweet rate, kept in a min-heap. Due users are
+    only handed out as fast as the remaining rate limit budget allows, so the window gets used up evenly
+    instead of in bursts. With several credentials, the budget is what's left of all of their windows.
+    """
+    _users: Dict[int, _UserSchedule]
+    _heap: List[Tuple[float, int]]
+    _credential_count: int
+    # Keyed by credential, for the credentials we've heard from.
+    _rate_limits: Dict[int, RateLimit]
+    _allowance: float
+    _refilled_at: Optional[float]
+
+    def __init__(self, credential_count: int = 1) -> None:
+        self._users = {}
+        self._heap = []
+        self._credential_count = credential_count
+        self._rate_limits = {}
+        self._allowance = 0.0
+        self._refilled_at = None
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def sync(self, subscriptions: Iterable[ActiveSubscription], now: float) -> None:
+        """Starts scheduling newly active subscriptions and forgets about inactive ones.
+        """
+        active_user_ids = set()
+        for subscription in subscriptions:
+            active_user_ids.add(subscription.user_id)
+            if subscription.user_id in self._users:
+                continue
+
+            last_polled_at = subscription.refreshed_latest_tweet_id_at
+            next_poll_at = now
+            if last_polled_at is not None:
+                next_poll_at = max(now, last_polled_at + poll_interval_for_tweet_rate(subscription.tweets_per_day))
+
+            self._users[subscription.user_id] = _UserSchedule(
+                tweets_per_day=subscription.tweets_per_day,
+                last_polled_at=last_polled_at,
+                next_poll_at=next_poll_at,
+            )
+            heapq.heappush(self._heap, (next_poll_at, subscription.user_id))
+
+        for user_id in set(self._users) - active_user_ids:
+            # Stale heap entries get skipped when they're popped.
+            del self._users[user_id]
+
+    def add(self, user_id: int, now: float) -> None:
+        if user_id in self._users:
+            return
+
+        self._users[user_id] = _UserSchedule(tweets_per_day=None, last_polled_at=None, next_poll_at=now)
+        heapq.heappush(self._heap, (now, user_id))
+
+    def remove(self, user_id: int) -> None:
+        # Like ``sync``, this leaves a stale heap entry to be skipped when it's popped.
+        self._users.pop(user_id, None)
+
+    @property
+    def user_ids(self) -> KeysView[int]:
+        return self._users.keys()
+
+    def tweets_per_day(self, user_id: int) -> Optional[float]:
+        schedule = self._users.get(user_id)
+        return schedule.tweets_per_day if schedule is not None else None
+
+    def update_rate_limit(self, rate_limit: RateLimit) -> None:
+        current = self._rate_limits.get(rate_limit.credential)
+        if current is not None and current.reset_at == rate_limit.reset_at:
+            # Responses can arrive out of order, so within a window the lowest remaining count is the freshest.
+            rate_limit = rate_limit._replace(remaining=min(current.remaining, rate_limit.remaining))
+
+        if current is None or rate_limit.reset_at >= current.reset_at:
+            self._rate_limits[rate_limit.credential] = rate_limit
+
+    def pop_due(self, now: float, skip: Container[int] = frozenset()) -> List[int]:
+        """Returns the users that are due to be polled, as many as the allowance lets through.
+
+        Due users in ``skip`` (for example, those the stream is keeping up with) are rescheduled as if they'd been
+        polled, without spending any allowance.
+        """
+        self._refill(now)
+
+        due = []
+        while self._heap and self._allowance >= 1:
+            next_poll_at, user_id = self._heap[0]
+            if next_poll_at > now:
+                break
+
+            heapq.heappop(self._heap)
+            schedule = self._users.get(user_id)
+            if schedule is None or schedule.next_poll_at != next_poll_at:
+                continue
+
+            if user_id in skip:
+                schedule.next_poll_at = now + poll_interval_for_tweet_rate(schedule.tweets_per_day)
+                heapq.heappush(self._heap, (schedule.next_poll_at, user_id))
+                continue
+
+            due.append(user_id)
+            self._allowance -= 1
+
+        self._spend(len(due))
+        return due
+
+    def spare_allowance(self, cost: int = 1) -> int:
+        """Says how many units of work that cost ``cost`` requests each fit in whatever allowance ``pop_due`` left
+        over, for work that should never delay polls. Nothing is taken until ``take_spare_allowance``.
+        """
+        return max(int(self._allowance // cost), 0)
+
+    def take_spare_allowance(self, count: int, cost: int = 1) -> None:
+        """Takes ``count`` units of work that cost ``cost`` requests each out of the spare allowance.
+        """
+        if count <= 0:
+            return
+
+        self._allowance -= count * cost
+        self._spend(count * cost)
+
+    def record_poll(self, user_id: int, new_tweet_count: Optional[int], now: float) -> Optional[float]:
+        """Reschedules a user after a poll, and returns their updated tweet rate.
+
+        ``new_tweet_count`` is None when the poll can't tell us anything about the rate (for example, it
+        was the first fetch of the user, or the poll failed).
+        """
+        schedule = self._users.get(user_id)
+        if schedule is None:
+            # The user was unsubscribed while we were polling them.
+            return None
+
+        if new_tweet_count is not None and schedule.last_polled_at is not None:
+            schedule.tweets_per_day = estimate_tweet_rate(
+                schedule.tweets_per_day,
+                new_tweet_count,
+                now - schedule.last_polled_at,
+            )
+
+        if new_tweet_count is not None:
+            schedule.last_polled_at = now
+
+        schedule.next_poll_at = now + poll_interval_for_tweet_rate(schedule.tweets_per_day)
+        heapq.heappush(self._heap, (schedule.next_poll_at, user_id))
+
+        return schedule.tweets_per_day
+
+    def seconds_until_next(self, now: float) -> float:
+        wait: float = MAX_TICK_SEC
+        if self._heap:
+            wait = min(wait, self._heap[0][0] - now)
+
+        if self._allowance < 1:
+            rate = self._request_rate(now)
+            if rate > 0:
+                wait = max(wait, (1 - self._allowance) / rate)
+
+        return min(max(wait, MIN_TICK_SEC), MAX_TICK_SEC)
+
+    def _request_rate(self, now: float) -> float:
+        rate = 0.0
+        for credential in range(self._credential_count):
+            rate_limit = self._rate_limits.get(credential)
+            if rate_limit is None or now >= rate_limit.reset_at:
+                rate += TWITTER_TIMELINE_WINDOW_REQUESTS / TWITTER_TIMELINE_WINDOW_SEC
+            else:
+                rate += rate_limit.remaining / max(rate_limit.reset_at - now, 1)
+        return rate
+
+    def _remaining(self, now: float) -> int:
+        remaining = 0
+        for credential in range(self._credential_count):
+            rate_limit = self._rate_limits.get(credential)
+            if rate_limit is None or now >= rate_limit.reset_at:
+                remaining += TWITTER_TIMELINE_WINDOW_REQUESTS
+            else:
+                remaining += rate_limit.remaining
+        return remaining
+
+    def _spend(self, count: int) -> None:
+        """Takes requests that are about to be sent out of the rate limits, so that we don't count on them before
+        Twitter's response headers catch up. Like the client, it picks whichever credential has the most left.
+        """
+        for _ in range(count):
+            if not self._rate_limits:
+                return
+            credential = max(self._rate_limits, key=lambda credential: self._rate_limits[credential].remaining)
+            rate_limit = self._rate_limits[credential]
+            self._rate_limits[credential] = rate_limit._replace(remaining=max(rate_limit.remaining - 1, 0))
+
+    def _refill(self, now: float) -> None:
+        if self._refilled_at is None:
+            self._refilled_at = now
+
+        rate = self._request_rate(now)
+        self._allowance = min(
+            self._allowance + rate * (now - self._refilled_at),
+            max(rate * MAX_TICK_SEC, 1),
+        )
+        self._refilled_at = now
+        self._allowance = min(self._allowance, self._remaining(now))
+
+
+class CatchUpScheduler:
+    """Decides which users' backfills to catch up on, taking turns so that one huge backfill doesn't hold up
+    the others. It doesn't decide how many, since catching up only gets whatever budget the polls leave over.
+    """
+    _backfills: 'OrderedDict[int, Backfill]'
+
+    def __init__(self) -> None:
+        self._backfills = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._backfills)
+
+    def get(self, user_id: int) -> Optional[Backfill]:
+        return self._backfills.get(user_id)
+
+    def sync(self, backfills: Iterable[Backfill]) -> None:
+        self._backfills = OrderedDict((backfill.user_id, backfill) for backfill in backfills)
+
+    def update(self, backfill: Backfill) -> None:
+        if backfill.is_done():
+            self._backfills.pop(backfill.user_id, None)
+        else:
+            self._backfills[backfill.user_id] = backfill
+
+    def remove(self, user_id: int) -> None:
+        self._backfills.pop(user_id, None)
+
+    def pop_due(self, count: int, exclude: Set[int]) -> List[Backfill]:
+        """Returns up to ``count`` backfills, skipping the users in ``exclude`` (who are being polled, and whose
+        backfills might change under us). The backfills stay scheduled until they're updated as done.
+        """
+        due: List[Backfill] = []
+        for user_id, backfill in list(self._backfills.items()):
+            if len(due) >= count:
+                break
+            if user_id in exclude:
+                continue
+
+            due.append(backfill)
+            # To the back of the line.
+            self._backfills.move_to_end(user_id)
+
+        return due
@@ -0,0 +1,179 @@
+import datetime
+import logging
+import math
+import random
+import zlib
+from typing import Dict
+from typing import Set
+
+from databases.core import Connection
+
+from tothc import managers
+
+
+log = logging.getLogger(__name__)
+
+# Every instance sharing a DB must split the subscriptions into the same number of partitions.
+DEFAULT_PARTITION_COUNT = 64
+
+# Instances renew their leases this often. A lease that isn't renewed for LEASE_TTL_SEC is up for grabs, so that
+# the partitions of an instance that died get picked up by the others.
+HEARTBEAT_PERIOD_SEC = 10
+LEASE_TTL_SEC = 30
+
+LEADER_LEASE_NAME = 'leader'
+
+
+def partition_of(user_id: int, partition_count: int) -> int:
+    """Twitter user IDs aren't evenly spread out modulo small numbers, so they get hashed first.
+    """
+    return zlib.crc32(user_id.to_bytes(8, 'little')) % partition_count
+
+
+def _partition_lease_name(partition: int) -> str:
+    return f'partition-{partition}'
+
+
+class ShardCoordinator:
+    """Keeps track of which partitions of the subscriptions this instance polls, and whether it's the leader.
+
+    Each heartbeat, an instance claims free partitions until it has its fair share of them, given how many
+    instances are alive. Partitions beyond its fair share (because another instance joined) are first only
+    marked as draining, and released by ``apply_changes`` once the poller isn't in the middle of polling them,
+    so that no two instances ever poll the same user at the same time.
+    """
+    instance_id: str
+    partition_count: int
+    # The partitions we hold and may poll.
+    _partitions: Set[int]
+    # The partitions we hold but have stopped polling, waiting to be released.
+    _draining_partitions: Set[int]
+    _is_leader: bool
+    # In seconds since the epoch. If we fail to heartbeat, we stop acting on our leases before they expire.
+    _leases_valid_until: float
+    _changed: bool
+
+    def __init__(
+        self,
+        *,
+        instance_id: str,
+        partition_count: int = DEFAULT_PARTITION_COUNT,
+    ) -> None:
+        self.instance_id = instance_id
+        self.partition_count = partition_count
+        self._partitions = set()
+        self._draining_partitions = set()
+        self._is_leader = False
+        self._leases_valid_until = 0.0
+        self._changed = False
+
+    def holds_leases(self, now: float) -> bool:
+        return now < self._leases_valid_until
+
+    def owns(self, user_id: int, now: float) -> bool:
+        return self.holds_leases(now) and partition_of(user_id, self.partition_count) in self._partitions
+
+    def is_leader(self, now: float) -> bool:
+        return self.holds_leases(now) and self._is_leader
+
+    async def heartbeat(self, connection: Connection, now: float) -> None:
+        now_dt = datetime.datetime.utcfromtimestamp(now)
+        expires_at = now_dt + datetime.timedelta(seconds=LEASE_TTL_SEC)
+        partition_lease_names = [_partition_lease_name(partition) for partition in range(self.partition_count)]
+
+        async with connection.transaction():
+            await managers.LeaseManager.record_heartbeat(connection, instance_id=self.instance_id, now=now_dt)
+            live_since = now_dt - datetime.timedelta(seconds=LEASE_TTL_SEC)
+            await managers.LeaseManager.delete_instances_before(connection, before=live_since)
+            live_instance_ids = await managers.LeaseManager.list_live_instance_ids(connection, since=live_since)
+            fair_share = math.ceil(self.partition_count / max(len(live_instance_ids), 1))
+
+            leases = await managers.LeaseManager.list_leases(connection, names=partition_lease_names + [LEADER_LEASE_NAME])
+            held = self._held_partitions(leases, now_dt)
+            lost = (self._partitions | self._draining_partitions) - held
+            if lost:
+                log.warning('Lost the leases of partitions %s', sorted(lost))
+
+            partitions = held - self._draining_partitions
+            claimable = [
+                partition
+                for partition in range(self.partition_count)
+                if partition not in held and self._is_free(leases[_partition_lease_name(partition)], now_dt)
+            ]
+            # Instances joining at the same time shouldn't all go for the same partitions.
+            random.shuffle(claimable)
+            wanted = claimable[:max(fair_share - len(partitions), 0)]
+
+            await managers.LeaseManager.acquire_leases(
+                connection,
+                names=[_partition_lease_name(partition) for partition in held | set(wanted)] + [LEADER_LEASE_NAME],
+                holder=self.instance_id,
+                now=now_dt,
+                expires_at=expires_at,
+            )
+            leases = await managers.LeaseManager.list_leases(connection, names=partition_lease_names + [LEADER_LEASE_NAME])
+
+        held = self._held_partitions(leases, now_dt)
+        draining = self._draining_partitions & held
+        partitions = held - draining
+        if len(partitions) > fair_share:
+            excess = sorted(partitions)[fair_share:]
+            log.info('Draining partitions %s to make room for other instances', excess)
+            draining |= set(excess)
+            partitions -= set(excess)
+
+        if partitions != self._partitions:
+            log.info('Now polling %s of %s partitions', len(partitions), self.partition_count)
+            self._changed = True
+
+        is_leader = leases[LEADER_LEASE_NAME].holder == self.instance_id
+        if is_leader != self._is_leader:
+            log.info('Instance %s is %s the leader', self.instance_id, 'now' if is_leader else 'no longer')
+
+        self._partitions = partitions
+        self._draining_partitions = draining
+        self._is_leader = is_leader
+        self._leases_valid_until = now + LEASE_TTL_SEC - HEARTBEAT_PERIOD_SEC
+
+    async def apply_changes(self, connection: Connection) -> bool:
+        """Releases draining partitions, and returns whether the partitions we poll changed since the last call.
+
+        This must only be called when none of the draining partitions' users are being polled.
+        """
+        if self._draining_partitions:
+            await managers.LeaseManager.release_leases(
+                connection,
+                names=[_partition_lease_name(partition) for partition in self._draining_partitions],
+                holder=self.instance_id,
+            )
+            log.info('Released partitions %s', sorted(self._draining_partitions))
+            self._draining_partitions = set()
+
+        changed = self._changed
+        self._changed = False
+        return changed
+
+    async def release_all(self, connection: Connection) -> None:
+        names = [_partition_lease_name(partition) for partition in self._partitions | self._draining_partitions]
+        await managers.LeaseManager.release_leases(
+            connection,
+            names=names + [LEADER_LEASE_NAME],
+            holder=self.instance_id,
+        )
+        self._partitions = set()
+        self._draining_partitions = set()
+        self._is_leader = False
+        self._leases_valid_until = 0.0
+
+    def _held_partitions(self, leases: Dict[str, managers.Lease], now: datetime.datetime) -> Set[int]:
+        return {
+            partition
+            for partition in range(self.partition_count)
+            if self._holds(leases[_partition_lease_name(partition)], now)
+        }
+
+    def _holds(self, lease: managers.Lease, now: datetime.datetime) -> bool:
+        return lease.holder == self.instance_id and lease.expires_at > now
+
+    def _is_free(self, lease: managers.Lease, now: datetime.datetime) -> bool:
+        return lease.holder is None or lease.expires_at <= now
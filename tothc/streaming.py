@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable
+from typing import Callable
+from typing import FrozenSet
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+
+from tothc import metrics
+from tothc.clients import twitter
+
+
+log = logging.getLogger(__name__)
+
+# Twitter doesn't like clients that reconnect often, so the stream is opened at most this often, whether it's
+# because the follow set changed or because the last attempt failed.
+RECONNECT_INTERVAL_SEC = 60
+
+# Streamed tweets wait here to be handled, in batches of up to BATCH_SIZE. If handling falls behind, reading the
+# stream stops, and if that goes on for long enough, Twitter disconnects us and polling takes over.
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+
+
+class StreamIngester:
+    """Keeps one filtered stream open, following a set of users, and hands their tweets to a handler in batches.
+
+    The stream knows nothing about the tweets from before it connected, so a user is only covered by it once
+    they've been polled since then. Covered users don't need to be polled, and everyone else (which is everyone,
+    while the stream is down) gets polled as usual.
+    """
+    _twitter_client: twitter.Client
+    _queue: 'asyncio.Queue[twitter.Tweet]'
+    # Who the stream should follow, and who the current connection follows.
+    _follow_user_ids: FrozenSet[int]
+    _streamed_user_ids: FrozenSet[int]
+    _follows_changed: asyncio.Event
+    _opened_at: Optional[float]
+    _connected: bool
+    # Bumped whenever the stream connects or disconnects, so that a poll can tell whether it covered the
+    # connection that's current when it finishes.
+    _generation: int
+    _covered_user_ids: Set[int]
+
+    def __init__(
+        self,
+        twitter_client: twitter.Client,
+        handler: Callable[[List[twitter.Tweet]], Awaitable[None]],
+    ) -> None:
+        self._twitter_client = twitter_client
+        self._handler: Callable[[List[twitter.Tweet]], Awaitable[None]] = handler
+        self._queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self._follow_user_ids = frozenset()
+        self._streamed_user_ids = frozenset()
+        self._follows_changed = asyncio.Event()
+        self._opened_at = None
+        self._connected = False
+        self._generation = 0
+        self._covered_user_ids = set()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def covered_user_ids(self) -> Set[int]:
+        return self._covered_user_ids
+
+    def covers(self, user_id: int) -> bool:
+        return user_id in self._covered_user_ids
+
+    def follow(self, user_ids: Iterable[int]) -> None:
+        """Sets who the stream follows. If that's a change, the stream reconnects (but no sooner than
+        RECONNECT_INTERVAL_SEC after it last did), and until then, the new users are polled.
+        """
+        user_ids = sorted(user_ids)
+        if len(user_ids) > twitter.STREAM_FOLLOW_LIMIT:
+            log.warning(
+                'Only streaming %s of %s users, and polling the rest',
+                twitter.STREAM_FOLLOW_LIMIT,
+                len(user_ids),
+            )
+            user_ids = user_ids[:twitter.STREAM_FOLLOW_LIMIT]
+
+        follow_user_ids = frozenset(user_ids)
+        if follow_user_ids != self._follow_user_ids:
+            self._follow_user_ids = follow_user_ids
+            self._follows_changed.set()
+
+    def mark_polled(self, user_id: int, generation: int) -> None:
+        """Records that the user was polled, with a poll that started while ``generation`` was current.
+        """
+        if self._connected and generation == self._generation and user_id in self._streamed_user_ids:
+            self._covered_user_ids.add(user_id)
+            metrics.TWITTER_STREAM_COVERED_USERS.set(len(self._covered_user_ids))
+
+    def uncover(self, user_ids: Iterable[int]) -> None:
+        """Makes the users get polled again before the stream covers them, for when their streamed tweets might
+        have been lost.
+        """
+        self._covered_user_ids.difference_update(user_ids)
+        metrics.TWITTER_STREAM_COVERED_USERS.set(len(self._covered_user_ids))
+
+    async def run(self) -> None:
+        await asyncio.gather(self._run_stream(), self._run_handler())
+
+    async def _run_stream(self) -> None:
+        while True:
+            if not self._follow_user_ids:
+                self._follows_changed.clear()
+                await self._follows_changed.wait()
+                continue
+
+            if self._opened_at is not None:
+                await asyncio.sleep(self._opened_at + RECONNECT_INTERVAL_SEC - time.monotonic())
+
+            self._follows_changed.clear()
+            self._opened_at = time.monotonic()
+            log.info('Opening the stream to follow %s users', len(self._follow_user_ids))
+
+            reader = asyncio.create_task(self._read(self._follow_user_ids))
+            follows_changed = asyncio.create_task(self._follows_changed.wait())
+            tasks: Set[asyncio.Task] = {reader, follows_changed}
+            try:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                reader.cancel()
+                follows_changed.cancel()
+                await asyncio.gather(reader, follows_changed, return_exceptions=True)
+                self._set_disconnected()
+
+    async def _read(self, user_ids: FrozenSet[int]) -> None:
+        try:
+            async for event in self._twitter_client.iter_filtered_stream(user_ids):
+                if event.tweet is not None:
+                    if event.tweet.user_id in user_ids:
+                        await self._queue.put(event.tweet)
+                elif event.connected:
+                    self._set_connected(user_ids)
+                else:
+                    self._set_disconnected()
+        except Exception:
+            log.exception('The stream failed, polling everyone until it reconnects')
+
+    async def _run_handler(self) -> None:
+        while True:
+            tweets = [await self._queue.get()]
+            while len(tweets) < BATCH_SIZE and not self._queue.empty():
+                tweets.append(self._queue.get_nowait())
+
+            try:
+                await self._handler(tweets)
+            except Exception:
+                log.exception('Failed to handle %s streamed tweets', len(tweets))
+                self.uncover(tweet.user_id for tweet in tweets)
+
+    def _set_connected(self, user_ids: FrozenSet[int]) -> None:
+        if self._connected and user_ids == self._streamed_user_ids:
+            return
+
+        log.info('The stream is connected, following %s users', len(user_ids))
+        self._connected = True
+        self._streamed_user_ids = user_ids
+        self._generation += 1
+        metrics.TWITTER_STREAM_CONNECTED.set(1)
+
+    def _set_disconnected(self) -> None:
+        if not self._connected:
+            return
+
+        log.warning('The stream disconnected, polling its %s users until it reconnects', len(self._streamed_user_ids))
+        self._connected = False
+        self._streamed_user_ids = frozenset()
+        self._generation += 1
+        self._covered_user_ids = set()
+        metrics.TWITTER_STREAM_CONNECTED.set(0)
+        metrics.TWITTER_STREAM_COVERED_USERS.set(0)